@@ -831,7 +831,19 @@ class style:
     RES_BLINK = '\x1b[25m'
     RES_REVERSE = '\x1b[27m'
     RES_HIDDEN = '\x1b[28m'
-    
+
+class cursor:
+    HOME = '\x1b[H'
+    ERASE_DOWN = '\x1b[J'  # Erase from the cursor to the end of the screen
+    ERASE_LINE = '\x1b[2K'
+    HIDE = '\x1b[?25l'
+    SHOW = '\x1b[?25h'
+
+    @staticmethod
+    def up(lines):
+        """Moves the cursor up to the start of the line `lines` lines above."""
+        return f'\x1b[{lines}F'
+
 def show_colors():
     for i, color in enumerate(colors):
         print(getattr(fore, color), i, color, style.RESET)
@@ -0,0 +1,461 @@
+"""
+bench - Measures a pysockethub hub's throughput, latency and fan-out
+scaling on loopback.
+
+Starts a hub listening on 127.0.0.1 (as a subprocess, or with --in-process
+in this process) and drives it with N producer and M consumer processes.
+Each producer sends fixed size messages, as fast as it can or at --rate
+messages/sec, and every consumer receives every message.  Each message
+starts with a header holding the time it was sent (time.monotonic_ns(),
+which is system wide), the producer's index and a sequence number, so
+consumers can measure end-to-end latency and count lost messages.
+
+Measurements cover the --duration seconds after --warmup:
+    throughput      Messages and bytes/sec received by the consumers, and
+                    bytes/sec forwarded by the hub (to consumers and, as
+                    the hub sends everything to everyone, other producers).
+    latency         p50/p99/p99.9/max from send to receive, to within ~3%.
+    hub cpu         User + system CPU seconds used by the hub (and its
+                    --workers), and per GB forwarded.
+    hub memory      Resident set size at the start and end, and growth.
+Hub CPU and memory are read from /proc, so are only reported on Linux.
+
+With more than one producer, the hub is run with --framing fixed:SIZE
+(unless --hub-args has a --framing option) so that messages from different
+producers aren't interleaved mid-message.
+
+The results are written as JSON, for comparing runs.
+
+Operation:
+    python bench.py -p 1 -c 8 --size 1024 --duration 10 -o baseline.json
+    python bench.py -p 4 -c 4 --rate 10000 --hub-args "--engine asyncio"
+
+"""
+
+# System imports
+import _thread
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+# Local imports
+import colorlog
+import pysockethub
+
+# Globals
+MESSAGE_HEADER = struct.Struct('>QII')  # send time (ns), producer index, sequence number
+BATCH_BYTES = 64 * 1024  # Messages gathered per send
+RECV_SIZE = 256 * 1024
+STARTUP_TIME = 1.0  # Seconds for the hub to start and every driver to connect
+DRAIN_TIME = 1.0  # Seconds consumers keep reading after producers stop
+LOG_LEVEL = logging.DEBUG
+
+def setup_log():
+    global log
+    logging.setLoggerClass(colorlog.ColorLog)
+    log = logging.getLogger(__name__)
+    log_handler = logging.StreamHandler()
+    log_formatter = colorlog.ColorFormatter()
+    log_handler.setFormatter(log_formatter)
+    log.addHandler(log_handler)
+    log.setLevel(LOG_LEVEL)
+
+setup_log()
+
+def new_histogram():
+    return pysockethub.Histogram(sub_bits=5, max_bits=40)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def connect(address, deadline_ns):
+    """
+    Connects to the hub, retrying until it is up or deadline_ns passes.
+    """
+    while True:
+        try:
+            sock = socket.create_connection(address)
+        except OSError:
+            if time.monotonic_ns() > deadline_ns:
+                raise
+            time.sleep(0.05)
+            continue
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+def sleep_until(time_ns):
+    delay = time_ns - time.monotonic_ns()
+    if delay > 0:
+        time.sleep(delay / 1_000_000_000)
+
+def produce(index, address, size, rate, window, results):
+    """
+    Producer process: sends messages from window start - warmup until
+    window end.  Also reads (and discards) what the hub sends it.
+    """
+    start_ns, window_start, window_end = window
+    try:
+        sock = connect(address, start_ns)
+    except OSError as exc:
+        results.put(('error', f'Producer {index} could not connect ({exc})'))
+        return
+
+    received = [0]
+
+    def drain():
+        try:
+            while True:
+                nbytes = len(sock.recv(RECV_SIZE))
+                if not nbytes:
+                    return
+                if window_start <= time.monotonic_ns() < window_end:
+                    received[0] += nbytes
+        except OSError:
+            pass
+
+    threading.Thread(target=drain, daemon=True).start()
+
+    batch_size = max(1, BATCH_BYTES // size)
+    batch = bytearray(batch_size * size)
+    pack_into = MESSAGE_HEADER.pack_into
+    seq = 0
+    sent = 0
+    sleep_until(start_ns)
+    try:
+        while True:
+            now = time.monotonic_ns()
+            if now >= window_end:
+                break
+            count = batch_size
+            if rate:
+                count = min(batch_size, (now - start_ns) * rate // 1_000_000_000 - seq)
+                if count <= 0:
+                    time.sleep(0.001)
+                    continue
+            for n in range(count):
+                pack_into(batch, n * size, now, index, seq + n)
+            sock.sendall(memoryview(batch)[:count * size])
+            seq += count
+            if now >= window_start:
+                sent += count
+    except OSError as exc:
+        results.put(('error', f'Producer {index} lost its connection ({exc})'))
+        return
+    finally:
+        sock.close()
+
+    results.put(('producer', {'sent': sent, 'received_bytes': received[0]}))
+
+def consume(index, address, size, window, results):
+    """
+    Consumer process: receives messages until DRAIN_TIME after window end,
+    recording the latency of those received within the window.
+    """
+    start_ns, window_start, window_end = window
+    try:
+        sock = connect(address, start_ns)
+    except OSError as exc:
+        results.put(('error', f'Consumer {index} could not connect ({exc})'))
+        return
+
+    message = struct.Struct(f'{MESSAGE_HEADER.format}{size - MESSAGE_HEADER.size}x')
+    latency = new_histogram()
+    record = latency.record
+    next_seq = {}  # producer index -> sequence number expected next
+    lost = 0
+    received = 0
+    pending = bytearray()
+    stop_ns = window_end + int(DRAIN_TIME * 1_000_000_000)
+    sock.settimeout(0.1)
+    try:
+        while time.monotonic_ns() < stop_ns:
+            try:
+                data = sock.recv(RECV_SIZE)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            now = time.monotonic_ns()
+            pending += data
+            end = len(pending) - len(pending) % size
+            if not end:
+                continue
+            messages = pending[:end]
+            del pending[:end]
+            in_window = window_start <= now < window_end
+            for sent_ns, producer, seq in message.iter_unpack(messages):
+                expected = next_seq.get(producer, seq)
+                if seq > expected:
+                    lost += seq - expected
+                next_seq[producer] = seq + 1
+                if in_window:
+                    record(now - sent_ns)
+            if in_window:
+                received += end
+    except OSError as exc:
+        results.put(('error', f'Consumer {index} lost its connection ({exc})'))
+        return
+    finally:
+        sock.close()
+
+    results.put(('consumer', {'received_bytes': received, 'lost': lost, 'latency': latency}))
+
+def hub_pids(pid, exclude):
+    """
+    Returns [pid] plus the pids of its child processes (--workers), other
+    than those in exclude.
+    """
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    return [pid] + [child for child in children if child not in exclude]
+
+def hub_usage(pid, exclude=()):
+    """
+    Returns (cpu_seconds, rss_kb) of the hub process pid and its children
+    (other than the pids in exclude), or (None, None) if /proc isn't
+    available.
+    """
+    cpu_ticks = 0
+    rss_kb = 0
+    try:
+        for hub_pid in hub_pids(pid, exclude):
+            with open(f'/proc/{hub_pid}/stat') as f:
+                # Fields after the command name, which may contain spaces
+                fields = f.read().rpartition(')')[2].split()
+            cpu_ticks += int(fields[11]) + int(fields[12])  # utime, stime
+            with open(f'/proc/{hub_pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss_kb += int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        return None, None
+    return cpu_ticks / os.sysconf('SC_CLK_TCK'), rss_kb
+
+def measure(args, hub_pid, window, results, drivers):
+    """
+    Samples the hub's usage at the start and end of the window, then
+    collects every driver's results.  Returns the report.
+    """
+    start_ns, window_start, window_end = window
+    # (In-process, the drivers are children of the hub's process too)
+    exclude = {driver.pid for driver in drivers}
+    sleep_until(window_start)
+    cpu_start, rss_start = hub_usage(hub_pid, exclude)
+    sleep_until(window_end)
+    cpu_end, rss_end = hub_usage(hub_pid, exclude)
+
+    sent = 0
+    received = 0
+    forwarded = 0
+    lost = 0
+    latency = new_histogram()
+    timeout = time.monotonic() + DRAIN_TIME + 10
+    for _ in drivers:
+        try:
+            kind, result = results.get(timeout=max(0, timeout - time.monotonic()))
+        except queue.Empty:
+            log.error("Timed out waiting for results")
+            sys.exit(1)
+        if kind == 'error':
+            log.error("%s", result)
+            sys.exit(1)
+        if kind == 'producer':
+            sent += result['sent']
+            forwarded += result['received_bytes']
+        else:
+            received += result['received_bytes']
+            forwarded += result['received_bytes']
+            lost += result['lost']
+            latency.merge(result['latency'])
+
+    duration = args.duration
+    report = {
+        'config': {
+            'producers': args.producers,
+            'consumers': args.consumers,
+            'size': args.size,
+            'rate': args.rate,
+            'duration': duration,
+            'warmup': args.warmup,
+            'hub': 'in-process' if args.in_process else 'subprocess',
+            'hub_args': args.hub_args,
+        },
+        'sent_messages': sent,
+        'received_messages': received // args.size,
+        'lost_messages': lost,
+        'throughput': {
+            'messages_per_sec': received / args.size / duration,
+            'mb_per_sec': received / duration / 1e6,
+            'forwarded_mb_per_sec': forwarded / duration / 1e6,
+        },
+        'latency_us': {
+            'p50': latency.percentile(50) / 1000,
+            'p99': latency.percentile(99) / 1000,
+            'p999': latency.percentile(99.9) / 1000,
+            'max': latency.max / 1000,
+            'mean': latency.total / latency.count / 1000 if latency.count else 0,
+        },
+        'hub': {
+            'cpu_sec': None,
+            'cpu_sec_per_gb': None,
+            'rss_start_kb': rss_start,
+            'rss_end_kb': rss_end,
+            'rss_growth_kb': None,
+        },
+    }
+    if cpu_start is not None and cpu_end is not None:
+        hub = report['hub']
+        hub['cpu_sec'] = cpu_end - cpu_start
+        hub['cpu_sec_per_gb'] = hub['cpu_sec'] / (forwarded / 1e9) if forwarded else None
+        hub['rss_growth_kb'] = rss_end - rss_start
+    return report
+
+def hub_argv(args, port):
+    hub_args = shlex.split(args.hub_args)
+    max_connections = args.producers + args.consumers
+    argv = ['-l', f'127.0.0.1:{port}:{max_connections}', '--color', 'false'] + hub_args
+    if args.producers > 1 and not any(arg.startswith('--framing') for arg in hub_args):
+        argv += ['--framing', f'fixed:{args.size}']
+    return argv
+
+def run(args):
+    port = free_port()
+    address = ('127.0.0.1', port)
+    argv = hub_argv(args, port)
+
+    start_ns = time.monotonic_ns() + int(STARTUP_TIME * 1_000_000_000)
+    window_start = start_ns + int(args.warmup * 1_000_000_000)
+    window_end = window_start + int(args.duration * 1_000_000_000)
+    window = (start_ns, window_start, window_end)
+
+    log.info("Benchmarking %d producer(s) -> %d consumer(s), %d byte messages at %s, "
+             "hub: %s", args.producers, args.consumers, args.size,
+             f'{args.rate} messages/sec' if args.rate else 'full speed',
+             ' '.join(argv))
+
+    results = multiprocessing.Queue()
+    drivers = [multiprocessing.Process(target=produce,
+                                       args=(n, address, args.size, args.rate, window, results))
+               for n in range(args.producers)]
+    drivers += [multiprocessing.Process(target=consume,
+                                        args=(n, address, args.size, window, results))
+                for n in range(args.consumers)]
+    for driver in drivers:
+        driver.daemon = True
+        driver.start()
+
+    if args.in_process:
+        # The hub runs in the main thread (it handles ^C there), and is
+        # interrupted once the results are in.
+        report = {}
+
+        def measure_and_stop():
+            try:
+                report.update(measure(args, os.getpid(), window, results, drivers))
+            finally:
+                _thread.interrupt_main()
+
+        pysockethub.log.setLevel(logging.WARNING)
+        thread = threading.Thread(target=measure_and_stop)
+        thread.start()
+        pysockethub.main(pysockethub.parse_args(argv))
+        thread.join()
+        if not report:
+            sys.exit(1)
+    else:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pysockethub.py')
+        hub = subprocess.Popen([sys.executable, script] + argv,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            report = measure(args, hub.pid, window, results, drivers)
+        finally:
+            hub.terminate()
+            hub.wait()
+
+    for driver in drivers:
+        driver.join()
+    return report
+
+def show_report(report):
+    throughput = report['throughput']
+    latency = report['latency_us']
+    hub = report['hub']
+    log.info("Received %d messages (%.0f/sec, %.1f MB/sec); hub forwarded %.1f MB/sec",
+             report['received_messages'], throughput['messages_per_sec'],
+             throughput['mb_per_sec'], throughput['forwarded_mb_per_sec'])
+    if report['lost_messages']:
+        log.warning("Lost %d messages", report['lost_messages'])
+    log.info("Latency: p50 %.1f us, p99 %.1f us, p99.9 %.1f us, max %.1f us",
+             latency['p50'], latency['p99'], latency['p999'], latency['max'])
+    if hub['cpu_sec'] is not None:
+        per_gb = hub['cpu_sec_per_gb']
+        log.info("Hub: %.2f CPU sec (%s per GB forwarded), RSS %d -> %d KB",
+                 hub['cpu_sec'], f'{per_gb:.2f} sec' if per_gb is not None else 'n/a',
+                 hub['rss_start_kb'], hub['rss_end_kb'])
+
+def parse_args():
+    descr = "Benchmarks pysockethub's throughput, latency and fan-out on loopback."
+    parser = argparse.ArgumentParser(description=descr,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-p", "--producers", default=1, type=int,
+                        help="Number of connections sending messages.")
+    parser.add_argument("-c", "--consumers", default=4, type=int,
+                        help="Number of connections only receiving messages.")
+    parser.add_argument("-s", "--size", default=256, type=int,
+                        help=f"Message size in bytes (at least {MESSAGE_HEADER.size}).")
+    parser.add_argument("--rate", default=0, type=int,
+                        help="Messages/sec sent by each producer.  0 sends as fast as possible.")
+    parser.add_argument("-d", "--duration", default=10.0, type=float,
+                        help="Seconds to measure for.")
+    parser.add_argument("--warmup", default=2.0, type=float,
+                        help="Seconds to run before measuring.")
+    parser.add_argument("--in-process", action='store_true',
+                        help="Run the hub in this process instead of as a subprocess.")
+    parser.add_argument("--hub-args", default='--slow-policy backpressure',
+                        help="Extra pysockethub options, e.g. \"--engine asyncio\".")
+    parser.add_argument("-o", "--output",
+                        help="File to write the JSON results to.  Default is stdout.")
+
+    args = parser.parse_args()
+
+    if args.producers < 1 or args.consumers < 1:
+        parser.error("--producers and --consumers must be at least 1")
+    if args.size < MESSAGE_HEADER.size:
+        parser.error(f"--size must be at least {MESSAGE_HEADER.size}")
+    if args.rate < 0 or args.duration <= 0 or args.warmup < 0:
+        parser.error("--rate and --warmup must be 0 or more, and --duration more than 0")
+
+    return args
+
+def main(args):
+    try:
+        report = run(args)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+    show_report(report)
+    text = json.dumps(report, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,803 @@
+"""
+Capture file handling for pysockethub's file loggers.
+
+RotatingFile is a binary file that the loggers write to.  It can start a
+new segment once the current one reaches a size or age, keep only the
+newest segments, and compress each segment as it is written.
+
+To use:
+>>> import capturefile
+>>> options = capturefile.RotationOptions(max_bytes=1024 ** 3, interval=3600,
+...                                       keep=24, compress='zstd')
+>>> f = capturefile.RotatingFile('capture.bin', options)
+>>> f.write(b'...')
+>>> f.close()
+
+With rotation enabled, segments are named <root>.<NNNNNN><ext>[.<codec
+suffix>], e.g. capture.000001.bin.zst; otherwise the file is just
+<filename>[.<codec suffix>].  Numbering carries on after the highest
+segment already on disk, and those segments count towards keep, so a
+restarted logger doesn't overwrite (or forget to delete) the previous
+run's.  A write() is never split across segments, so a logger that writes
+whole records per call gets segments that can each be read on their own.
+
+Compression codecs:
+    none            Uncompressed
+    gzip, bz2, xz   Python standard library
+    zstd            Requires the zstandard package
+    lz4             Requires the lz4 package
+
+Capture format, version 2 (written by CaptureWriter, --logfmt capture).  All
+integers are unsigned big-endian, and times are nanoseconds since the epoch.
+A frame's time is when the hub received its data, not when it was written.
+Each segment is a complete capture on its own:
+    File header:    <magic:4 'PSHC'> <version:2> <flags:2> <created:8>
+    Then records, each starting with a type byte:
+    Peer (1):       <type:1> <peer_id:4> <port:2> <addr_len:2> <addr:addr_len>
+    Frame (2):      <type:1> <peer_id:4> <time:8> <data_len:4> <data:data_len>
+    A peer record precedes the first frame from that peer in each segment.
+    An id always means the same peer within a capture, but a peer can be
+    given a new id in a later segment (e.g. after a segment in which it
+    sent nothing).
+
+Index, written to <segment>.idx as the segment grows:
+    File header:    <magic:4 'PSHI'> <version:2> <flags:2> <created:8>
+    Then peer records (as above) and entries:
+    Entry (3):      <type:1> <peer_id:4> <time:8> <offset:8>
+    offset is where a frame record starts in the (uncompressed) segment.
+    Each peer's first frame in a segment gets an entry, and after that
+    there is one whenever INDEX_SPACING bytes have been written since the
+    peer's last entry.  See CaptureIndex.seek().  Compressed segments have
+    to be decompressed up to the offset, so random access is only fast
+    for uncompressed captures.
+
+Version 1 (FrameLogger, --logfmt frames) has no file header, one-second
+times and the address in every frame:
+    <sync:2 EB90> <time:4> <addr_len:4> <addr:addr_len> <port:2> <data_len:4> <data:data_len>
+
+Both versions are read by read_frames(), which memory-maps uncompressed
+files and yields Frames whose data is a memoryview into the map:
+>>> for frame in capturefile.read_frames('capture.000001.bin', port=1234):
+...     print(frame.time_ns, frame.addr, frame.port, len(frame.data))
+
+For analysis, frame_table() loads just the frame headers into a NumPy
+structured array (NumPy is only needed for this).
+
+See capturetool.py for a command line interface.
+"""
+
+import bisect
+import bz2
+import collections
+import gzip
+import lzma
+import mmap
+import os
+import re
+import struct
+import time
+
+RotationOptions = collections.namedtuple(
+    'RotationOptions',
+    ['max_bytes', 'interval', 'keep', 'compress'],
+    defaults=[0, 0, 0, 'none'])
+RotationOptions.__doc__ = """
+max_bytes: start a new segment after this many bytes (before compression),
+           0 for no limit
+interval:  start a new segment after this many seconds, 0 for no limit
+keep:      delete the oldest segments so that at most this many remain,
+           0 to keep them all
+compress:  codec name (see CODECS)
+"""
+
+CAPTURE_MAGIC = b'PSHC'
+INDEX_MAGIC = b'PSHI'
+VERSION = 2
+INDEX_SUFFIX = '.idx'
+INDEX_SPACING = 64 * 1024  # Max bytes between a peer's index entries
+WRITER_PEERS_MAX = 65536  # Peers a CaptureWriter keeps ids for
+
+FILE_HEADER = struct.Struct('>4sHHQ')
+RECORD_PEER = 1
+RECORD_FRAME = 2
+RECORD_ENTRY = 3
+PEER_HEADER = struct.Struct('>BIHH')
+FRAME_HEADER = struct.Struct('>BIQI')
+ENTRY = struct.Struct('>BIQQ')
+V1_SYNC = b'\xEB\x90'
+V1_HEADER = struct.Struct('>2sII')  # sync, time, addr_len
+V1_TRAILER = struct.Struct('>HI')  # port, data_len
+
+Frame = collections.namedtuple('Frame', ['time_ns', 'addr', 'port', 'data'])
+
+CODECS = {  # name -> file suffix
+    'none': '',
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'xz': '.xz',
+    'zstd': '.zst',
+    'lz4': '.lz4',
+}
+
+class CodecError(ValueError):
+    """
+    Raised when a codec is unknown or its package isn't installed.
+    """
+
+def check_codec(codec):
+    """
+    Raises CodecError if codec can't be used.
+    """
+    if codec not in CODECS:
+        raise CodecError(f'Unknown codec {codec!r} (choose from {", ".join(CODECS)})')
+    try:
+        if codec == 'zstd':
+            import zstandard  # noqa: F401
+        elif codec == 'lz4':
+            import lz4.frame  # noqa: F401
+    except ImportError:
+        package = 'zstandard' if codec == 'zstd' else 'lz4'
+        raise CodecError(f'{codec} compression requires the {package} package')
+
+def compressor(codec, raw):
+    """
+    Returns a writable file object that compresses into the open binary
+    file raw.
+    """
+    if codec == 'none':
+        return raw
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb')
+    if codec == 'bz2':
+        return bz2.BZ2File(raw, 'wb')
+    if codec == 'xz':
+        return lzma.LZMAFile(raw, 'wb')
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(raw)
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(raw, 'wb')
+    raise CodecError(f'Unknown codec {codec!r}')
+
+def decompressor(path):
+    """
+    Opens a capture file (or segment) for reading, decompressing it
+    according to its suffix.
+    """
+    raw = open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(raw, 'rb')
+    if path.endswith('.xz'):
+        return lzma.LZMAFile(raw, 'rb')
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    if path.endswith('.lz4'):
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(raw, 'rb')
+    return raw
+
+class RotatingFile:
+    """
+    A binary, write-only file split into segments as described in the module
+    docstring.  The first segment is created by the first write().
+    """
+    def __init__(self, filename, options=RotationOptions(), sidecar_suffixes=()):
+        check_codec(options.compress)
+        self.filename = filename
+        self.options = options
+        # Files named <segment><suffix> that are deleted along with a segment
+        self.sidecar_suffixes = sidecar_suffixes
+        self.rotating = bool(options.max_bytes or options.interval)
+        self.raw = None  # Current segment, as written to disk
+        self.file = None  # What's written to; raw, or a compressor around it
+        self.name = None  # Current segment's name
+        self.segment = 0
+        self.segment_bytes = 0  # Bytes written to the segment, before compression
+        self.segment_start = 0
+        self.closed_segments = collections.deque()  # Names, oldest first
+
+    def segment_name(self, segment):
+        suffix = CODECS[self.options.compress]
+        if not self.rotating:
+            return self.filename + suffix
+        root, ext = os.path.splitext(self.filename)
+        return f'{root}.{segment:06d}{ext}{suffix}'
+
+    @property
+    def offset(self):
+        """
+        Position in the current segment (before compression).
+        """
+        return self.segment_bytes
+
+    def segment_due(self):
+        """
+        Returns True if a segment is open and due to be rotated.  A writer
+        that may go quiet checks this now and then and calls close() so the
+        segment is finished on time; the next write() starts a new one.
+        """
+        return self.file is not None and self._segment_full()
+
+    def start_segment_if_due(self):
+        """
+        Opens the first segment, or the next one if the current one is full.
+        Returns True if a segment was opened.
+        """
+        if self.file is None:
+            self._open()
+            return True
+        if self._segment_full():
+            self._close_segment()
+            self._open()
+            return True
+        return False
+
+    def write(self, data, rotate=True):
+        """
+        Writes data to the current segment, first starting a new one if
+        it is due.  With rotate=False the caller decides when segments
+        start (see start_segment_if_due()).
+        """
+        if rotate or self.file is None:
+            self.start_segment_if_due()
+        self.file.write(data)
+        self.segment_bytes += len(data)
+
+    def _segment_full(self):
+        options = self.options
+        if options.max_bytes and self.segment_bytes >= options.max_bytes:
+            return True
+        return bool(options.interval
+                    and time.monotonic() - self.segment_start >= options.interval)
+
+    def _existing_segments(self):
+        """
+        Returns [(number, name), ...] for the segments of this file already
+        on disk, with any codec suffix, oldest first.
+        """
+        root, ext = os.path.splitext(self.filename)
+        pattern = re.compile(re.escape(os.path.basename(root)) + r'\.(\d{6,})' + re.escape(ext)
+                             + '(' + '|'.join(map(re.escape, CODECS.values())) + ')$')
+        directory = os.path.dirname(root)
+        try:
+            names = os.listdir(directory or '.')
+        except OSError:
+            return []
+        segments = []
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                segments.append((int(match.group(1)), os.path.join(directory, name)))
+        return sorted(segments)
+
+    def _open(self):
+        if self.rotating and self.segment == 0:
+            existing = self._existing_segments()
+            if existing:
+                self.segment = existing[-1][0]
+                self.closed_segments.extend(name for _, name in existing)
+
+        keep = self.options.keep
+        if keep:
+            # The segment being opened counts as one of the kept ones
+            while len(self.closed_segments) >= keep:
+                name = self.closed_segments.popleft()
+                for path in [name] + [name + suffix for suffix in self.sidecar_suffixes]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+        self.segment += 1
+        self.name = self.segment_name(self.segment)
+        self.raw = open(self.name, 'wb')
+        self.file = compressor(self.options.compress, self.raw)
+        self.segment_bytes = 0
+        self.segment_start = time.monotonic()
+
+    def _close_segment(self):
+        self.file.close()
+        if not self.raw.closed:
+            self.raw.close()
+        self.file = self.raw = None
+        self.closed_segments.append(self.name)
+
+    def flush(self):
+        """
+        Pushes buffered (and, if compressing, pending compressed) data to
+        the OS.
+        """
+        if self.file is not None:
+            self.file.flush()
+            if self.file is not self.raw:
+                self.raw.flush()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def fsync(self):
+        if self.file is not None:
+            self.flush()
+            os.fsync(self.raw.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self._close_segment()
+
+class CaptureWriter:
+    """
+    Writes version 2 captures (see the module docstring) to a RotatingFile,
+    with an index alongside each segment.
+
+    Frames are added to an in-memory batch with add() and written by
+    flush(); a new segment is only started at the beginning of a batch, so
+    a batch (and the peer records and index entries it needs) always lands
+    in one segment.
+
+    So that a long capture of short-lived connections doesn't keep every
+    peer it has seen, peers that sent nothing in a segment are forgotten
+    when the next one starts, and all of them once there are more than
+    WRITER_PEERS_MAX.  A forgotten peer gets a new id if it sends again;
+    ids are never reused.
+    """
+    def __init__(self, filename, options=RotationOptions()):
+        self.file = RotatingFile(filename, options, sidecar_suffixes=[INDEX_SUFFIX])
+        self.index = None
+        self.batch = bytearray()
+        self.batch_offset = 0  # Segment offset where the batch will be written
+        self.entries = bytearray()  # Index records for the batch
+        self.peer_ids = {}  # (addr, port) -> peer id
+        self.peer_records = {}  # peer id -> peer record
+        self.next_peer_id = 0
+        self.segment_peers = set()  # Ids with a peer record in this segment
+        self.last_entry = {}  # peer id -> segment offset of its last index entry
+
+    def _new_peer(self, peer):
+        """
+        Assigns an id to peer, an (addr, port) tuple, and returns it.
+        """
+        if len(self.peer_ids) >= WRITER_PEERS_MAX:
+            self.peer_ids.clear()
+            self.peer_records.clear()
+            self.segment_peers.clear()
+            self.last_entry.clear()
+        addr, port = peer
+        peer_id = self.next_peer_id
+        self.next_peer_id += 1
+        self.peer_ids[peer] = peer_id
+        addr_bytes = addr.encode()
+        self.peer_records[peer_id] = (PEER_HEADER.pack(RECORD_PEER, peer_id, port, len(addr_bytes))
+                                      + addr_bytes)
+        return peer_id
+
+    def add(self, peer, data, time_ns):
+        """
+        Adds a frame from peer, an (addr, port) tuple, to the batch.
+        time_ns is when the data was received (time.time_ns()), which may
+        be well before add() is called if the caller queues data.
+        """
+        batch = self.batch
+        if not batch:
+            self._start_batch()
+
+        peer_id = self.peer_ids.get(peer)
+        if peer_id is None:
+            peer_id = self._new_peer(peer)
+
+        if peer_id not in self.segment_peers:
+            self.segment_peers.add(peer_id)
+            batch += self.peer_records[peer_id]
+            self.entries += self.peer_records[peer_id]
+
+        offset = self.batch_offset + len(batch)
+        last = self.last_entry.get(peer_id)
+        if last is None or offset - last >= INDEX_SPACING:
+            self.last_entry[peer_id] = offset
+            self.entries += ENTRY.pack(RECORD_ENTRY, peer_id, time_ns, offset)
+
+        batch += FRAME_HEADER.pack(RECORD_FRAME, peer_id, time_ns, len(data))
+        batch += data
+
+    def __len__(self):
+        """
+        Bytes waiting in the batch.
+        """
+        return len(self.batch)
+
+    def segment_due(self):
+        """
+        See RotatingFile.segment_due().  close() writes the batch to the
+        segment before closing it.
+        """
+        return self.file.segment_due()
+
+    def _start_batch(self):
+        if self.file.start_segment_if_due():
+            if self.index is not None:
+                self.index.close()
+            header = FILE_HEADER.pack(CAPTURE_MAGIC, VERSION, 0, time.time_ns())
+            self.file.write(header, rotate=False)
+            self.index = open(self.file.name + INDEX_SUFFIX, 'wb')
+            self.index.write(FILE_HEADER.pack(INDEX_MAGIC, VERSION, 0, time.time_ns()))
+            # Forget the peers that sent nothing in the last segment
+            segment_peers = self.segment_peers
+            self.peer_ids = {peer: peer_id for peer, peer_id in self.peer_ids.items()
+                             if peer_id in segment_peers}
+            self.peer_records = {peer_id: self.peer_records[peer_id]
+                                 for peer_id in self.peer_ids.values()}
+            self.segment_peers = set()
+            self.last_entry.clear()
+        self.batch_offset = self.file.offset
+
+    def flush(self):
+        """
+        Writes the batch and its index entries.  Returns True if there was
+        anything to write.
+        """
+        if not self.batch:
+            return False
+        self.file.write(self.batch, rotate=False)
+        self.file.flush()
+        self.batch.clear()
+        self.index.write(self.entries)
+        self.index.flush()
+        self.entries.clear()
+        return True
+
+    def fsync(self):
+        self.file.fsync()
+        if self.index is not None:
+            os.fsync(self.index.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+class CaptureIndex:
+    """
+    The index of one version 2 segment, read from <segment>.idx.
+
+    peers maps peer id -> (addr, port).  entries is a list of
+    (offset, time_ns, peer_id) in file order.  A truncated last record (the
+    index is read while it is still being written) is ignored.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < FILE_HEADER.size:
+            raise ValueError(f'{path}: not a capture index')
+        magic, version, _, self.created = FILE_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != VERSION:
+            raise ValueError(f'{path}: not a version {VERSION} capture index')
+
+        self.peers = {}
+        self.entries = []
+        pos = FILE_HEADER.size
+        while pos < len(data):
+            kind = data[pos]
+            if kind == RECORD_ENTRY:
+                if pos + ENTRY.size > len(data):
+                    break
+                _, peer_id, time_ns, offset = ENTRY.unpack_from(data, pos)
+                self.entries.append((offset, time_ns, peer_id))
+                pos += ENTRY.size
+            elif kind == RECORD_PEER:
+                if pos + PEER_HEADER.size > len(data):
+                    break
+                _, peer_id, port, addr_len = PEER_HEADER.unpack_from(data, pos)
+                pos += PEER_HEADER.size
+                if pos + addr_len > len(data):
+                    break
+                self.peers[peer_id] = (data[pos:pos + addr_len].decode(), port)
+                pos += addr_len
+            else:
+                raise ValueError(f'{path}: bad record type {kind} at offset {pos}')
+        self.times = [time_ns for _, time_ns, _ in self.entries]
+
+    def peer_ids(self, addr=None, port=None):
+        """
+        Returns the set of ids of peers matching addr and/or port.
+        """
+        return {peer_id for peer_id, (peer_addr, peer_port) in self.peers.items()
+                if (addr is None or peer_addr == addr) and (port is None or peer_port == port)}
+
+    def seek(self, start_ns=None, peer_ids=None):
+        """
+        Returns an offset in the segment from which reading forward finds
+        every frame at or after start_ns from the peers in peer_ids (all
+        peers if None), skipping as much as the index allows.  Returns None
+        if no such frames can be in the segment.
+        """
+        if not self.entries:
+            return None
+        if peer_ids is not None and not peer_ids & {peer_id for _, _, peer_id in self.entries}:
+            return None
+
+        start = self.entries[0][0]
+        if start_ns is not None:
+            # Frames before the last entry older than start_ns are all older
+            n = bisect.bisect_left(self.times, start_ns)
+            if n:
+                start = self.entries[n - 1][0]
+
+        if peer_ids is not None:
+            # Don't read from before the point where these peers' frames could be
+            candidates = []
+            for peer_id in peer_ids:
+                offsets = [offset for offset, time_ns, entry_peer in self.entries
+                           if entry_peer == peer_id
+                           and (start_ns is None or time_ns < start_ns)]
+                if offsets:
+                    candidates.append(offsets[-1])
+                else:
+                    first = next((offset for offset, _, entry_peer in self.entries
+                                  if entry_peer == peer_id), None)
+                    if first is not None:
+                        candidates.append(first)
+            start = max(start, min(candidates))
+        return start
+
+def map_file(path):
+    """
+    Returns the contents of a capture file as a buffer: an mmap if it is
+    uncompressed, otherwise the decompressed bytes.
+    """
+    if any(path.endswith(suffix) for suffix in CODECS.values() if suffix):
+        with decompressor(path) as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_frames(path, start_ns=None, end_ns=None, addr=None, port=None):
+    """
+    Yields the Frames in a version 1 or 2 capture file (or segment) received
+    from start_ns up to end_ns, from peers matching addr and/or port.
+
+    Frames are assumed to be in time order, so reading stops at the first
+    frame after end_ns.  For version 2 files, the index (if there is one) is
+    used to skip to the first frame that can match.  A truncated last frame
+    (the file is still being written) is ignored.
+    """
+    buf = map_file(path)
+    if not len(buf):
+        return
+    view = memoryview(buf)
+    if buf[:len(CAPTURE_MAGIC)] == CAPTURE_MAGIC:
+        frames = _read_v2(path, view, start_ns, addr, port)
+    elif buf[:len(V1_SYNC)] == V1_SYNC:
+        frames = _read_v1(path, view, start_ns, addr, port)
+    else:
+        raise ValueError(f'{path}: not a capture file')
+
+    for frame in frames:
+        if end_ns is not None and frame.time_ns > end_ns:
+            break
+        yield frame
+
+def _read_v2(path, view, start_ns, addr, port):
+    magic, version, _, _ = FILE_HEADER.unpack_from(view)
+    if version != VERSION:
+        raise ValueError(f'{path}: unsupported capture version {version}')
+
+    peers = {}  # peer id -> (addr, port)
+    wanted = set()  # Ids of peers matching addr/port
+    filtered = addr is not None or port is not None
+
+    def add_peer(peer_id, peer):
+        peers[peer_id] = peer
+        if (addr is None or peer[0] == addr) and (port is None or peer[1] == port):
+            wanted.add(peer_id)
+
+    pos = FILE_HEADER.size
+    index_path = path + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        index = CaptureIndex(index_path)
+        for peer_id, peer in index.peers.items():
+            add_peer(peer_id, peer)
+        if index.entries:
+            offset = index.seek(start_ns, wanted if filtered else None)
+            if offset is None:
+                return
+            pos = offset
+
+    end = len(view)
+    while pos < end:
+        kind = view[pos]
+        if kind == RECORD_FRAME:
+            if pos + FRAME_HEADER.size > end:
+                return
+            _, peer_id, time_ns, length = FRAME_HEADER.unpack_from(view, pos)
+            pos += FRAME_HEADER.size
+            if pos + length > end:
+                return
+            if ((start_ns is None or time_ns >= start_ns)
+                    and (not filtered or peer_id in wanted)):
+                peer_addr, peer_port = peers[peer_id]
+                yield Frame(time_ns, peer_addr, peer_port, view[pos:pos + length])
+            pos += length
+        elif kind == RECORD_PEER:
+            if pos + PEER_HEADER.size > end:
+                return
+            _, peer_id, peer_port, addr_len = PEER_HEADER.unpack_from(view, pos)
+            pos += PEER_HEADER.size
+            if pos + addr_len > end:
+                return
+            add_peer(peer_id, (bytes(view[pos:pos + addr_len]).decode(), peer_port))
+            pos += addr_len
+        else:
+            raise ValueError(f'{path}: bad record type {kind} at offset {pos}')
+
+def _read_v1(path, view, start_ns, addr, port):
+    end = len(view)
+    pos = 0
+    while pos < end:
+        if pos + V1_HEADER.size > end:
+            return
+        sync, time_s, addr_len = V1_HEADER.unpack_from(view, pos)
+        if sync != V1_SYNC:
+            raise ValueError(f'{path}: lost frame sync at offset {pos}')
+        pos += V1_HEADER.size
+        if pos + addr_len + V1_TRAILER.size > end:
+            return
+        frame_addr = bytes(view[pos:pos + addr_len]).decode()
+        pos += addr_len
+        frame_port, length = V1_TRAILER.unpack_from(view, pos)
+        pos += V1_TRAILER.size
+        if pos + length > end:
+            return
+        time_ns = time_s * 1_000_000_000
+        if ((start_ns is None or time_ns >= start_ns)
+                and (addr is None or frame_addr == addr)
+                and (port is None or frame_port == port)):
+            yield Frame(time_ns, frame_addr, frame_port, view[pos:pos + length])
+        pos += length
+
+FRAME_TABLE_FIELDS = [('time_ns', '<u8'), ('peer', '<u4'), ('size', '<u4')]
+
+def frame_table(path, start_ns=None, end_ns=None, addr=None, port=None):
+    """
+    Returns (table, peers) for the frames read_frames() would yield, where
+    table is a NumPy structured array with FRAME_TABLE_FIELDS, one row per
+    frame, and peers maps table['peer'] values to (addr, port).
+
+    Only the record lengths are read one by one, to find where each frame
+    starts (each record's position depends on the length of the one before
+    it, so this walk can't be done as array operations; it takes about
+    0.25 us per frame); the header fields are then gathered from the map
+    and filtered as whole arrays.  Requires NumPy.
+    """
+    import numpy as np
+
+    buf = map_file(path)
+    if not len(buf):
+        return np.zeros(0, dtype=FRAME_TABLE_FIELDS), {}
+    data = np.frombuffer(buf, dtype=np.uint8)
+
+    def gather(offsets, width):
+        # Big-endian unsigned integers of width bytes at each offset
+        value = np.zeros(len(offsets), dtype=np.uint64)
+        for i in range(width):
+            value = (value << np.uint64(8)) | data[offsets + i]
+        return value
+
+    if buf[:len(CAPTURE_MAGIC)] == CAPTURE_MAGIC:
+        offsets, peers = _frame_offsets_v2(path, buf, start_ns, addr, port)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        table = np.zeros(len(offsets), dtype=FRAME_TABLE_FIELDS)
+        table['peer'] = gather(offsets + 1, 4)
+        table['time_ns'] = gather(offsets + 5, 8)
+        table['size'] = gather(offsets + 13, 4)
+    elif buf[:len(V1_SYNC)] == V1_SYNC:
+        # The data length follows the variable-length address, so it is
+        # collected along with the offsets.
+        offsets, (peer_ids, lengths), peers = _frame_offsets_v1(path, buf)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        table = np.zeros(len(offsets), dtype=FRAME_TABLE_FIELDS)
+        table['time_ns'] = gather(offsets + 2, 4) * np.uint64(1_000_000_000)
+        table['peer'] = peer_ids
+        table['size'] = lengths
+    else:
+        raise ValueError(f'{path}: not a capture file')
+
+    keep = np.ones(len(table), dtype=bool)
+    if start_ns is not None:
+        keep &= table['time_ns'] >= start_ns
+    if end_ns is not None:
+        keep &= table['time_ns'] <= end_ns
+    if addr is not None or port is not None:
+        wanted = [peer_id for peer_id, (peer_addr, peer_port) in peers.items()
+                  if (addr is None or peer_addr == addr) and (port is None or peer_port == port)]
+        keep &= np.isin(table['peer'], wanted)
+    return table[keep], peers
+
+def _frame_offsets_v2(path, buf, start_ns, addr, port):
+    """
+    Returns (offsets of the frame records, peers).  The index is used to
+    skip ahead like _read_v2(); filtering is left to the caller.
+    """
+    magic, version, _, _ = FILE_HEADER.unpack_from(buf)
+    if version != VERSION:
+        raise ValueError(f'{path}: unsupported capture version {version}')
+
+    peers = {}
+    pos = FILE_HEADER.size
+    index_path = path + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        index = CaptureIndex(index_path)
+        peers.update(index.peers)
+        if index.entries:
+            wanted = None
+            if addr is not None or port is not None:
+                wanted = index.peer_ids(addr, port)
+            offset = index.seek(start_ns, wanted)
+            if offset is None:
+                return [], peers
+            pos = offset
+
+    offsets = []
+    length_at = struct.Struct('>I').unpack_from
+    frame_header_size = FRAME_HEADER.size
+    end = len(buf)
+    while pos < end:
+        kind = buf[pos]
+        if kind == RECORD_FRAME:
+            if pos + frame_header_size > end:
+                break
+            stop = pos + frame_header_size + length_at(buf, pos + 13)[0]
+            if stop > end:
+                break
+            offsets.append(pos)
+            pos = stop
+        elif kind == RECORD_PEER:
+            if pos + PEER_HEADER.size > end:
+                break
+            _, peer_id, peer_port, addr_len = PEER_HEADER.unpack_from(buf, pos)
+            pos += PEER_HEADER.size
+            if pos + addr_len > end:
+                break
+            peers[peer_id] = (bytes(buf[pos:pos + addr_len]).decode(), peer_port)
+            pos += addr_len
+        else:
+            raise ValueError(f'{path}: bad record type {kind} at offset {pos}')
+    return offsets, peers
+
+def _frame_offsets_v1(path, buf):
+    """
+    Returns (frame offsets, (peer ids, data lengths), peers), with peer ids
+    assigned in order of appearance.
+    """
+    offsets = []
+    frame_peers = []
+    lengths = []
+    peer_ids = {}  # (addr bytes, port) -> id
+    end = len(buf)
+    pos = 0
+    while pos + V1_HEADER.size <= end:
+        sync, _, addr_len = V1_HEADER.unpack_from(buf, pos)
+        if sync != V1_SYNC:
+            raise ValueError(f'{path}: lost frame sync at offset {pos}')
+        addr_at = pos + V1_HEADER.size
+        trailer_at = addr_at + addr_len
+        if trailer_at + V1_TRAILER.size > end:
+            break
+        frame_port, length = V1_TRAILER.unpack_from(buf, trailer_at)
+        stop = trailer_at + V1_TRAILER.size + length
+        if stop > end:
+            break
+        key = (buf[addr_at:trailer_at], frame_port)
+        peer_id = peer_ids.setdefault(key, len(peer_ids))
+        offsets.append(pos)
+        frame_peers.append(peer_id)
+        lengths.append(length)
+        pos = stop
+    peers = {peer_id: (addr.decode(), frame_port) for (addr, frame_port), peer_id in peer_ids.items()}
+    return offsets, (frame_peers, lengths), peers
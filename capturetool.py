@@ -0,0 +1,400 @@
+"""
+capturetool - Reads the capture files written by pysockethub's frames and
+capture log formats (see capturefile.py).
+
+Commands:
+    frames      List the frames: time, source address:port and length
+                (optionally with a hexdump of the data).
+    dump        Write the frames' data to stdout or a file.
+    replay      Send the frames' data to a hub (or anything else) over TCP,
+                at the original pace, N times faster, or as fast as possible.
+    stats       Per-peer byte rates, inter-arrival gaps and top talkers, and
+                frame size and gap histograms.  Requires NumPy.
+
+Every command takes one or more capture files (segments are read in the
+order given) and the same filters: --start/--end (times as
+'YYYY-MM-DD HH:MM:SS[.ffffff]' in local time, or seconds since the epoch),
+--addr and --port (of the peer the data was received from).
+
+Operation:
+    python capturetool.py frames capture.000001.bin --port 5000
+    python capturetool.py replay capture.*.bin -r localhost:1234 --speed 10
+
+"""
+
+# System imports
+import argparse
+import datetime
+import logging
+import socket
+import sys
+import time
+
+# Third-party imports
+import prettytable
+
+# Local imports
+import capturefile
+import colorlog
+import hexformat
+
+# Globals
+REPLAY_BATCH_BYTES = 256 * 1024  # Data gathered per send when not pacing
+LOG_LEVEL = logging.DEBUG
+
+def setup_log():
+    global log
+    logging.setLoggerClass(colorlog.ColorLog)
+    log = logging.getLogger(__name__)
+    log_handler = logging.StreamHandler()
+    log_formatter = colorlog.ColorFormatter()
+    log_handler.setFormatter(log_formatter)
+    log.addHandler(log_handler)
+    log.setLevel(LOG_LEVEL)
+
+setup_log()
+
+def validate_time(arg):
+    """
+    Converts a local date/time string or seconds since the epoch to
+    nanoseconds since the epoch.
+    """
+    try:
+        return int(float(arg) * 1_000_000_000)
+    except ValueError:
+        pass
+    try:
+        moment = datetime.datetime.fromisoformat(arg)
+    except ValueError:
+        log.error("Time must be 'YYYY-MM-DD HH:MM:SS[.ffffff]' or seconds since the epoch "
+                  "(got %s)", repr(arg))
+        sys.exit(1)
+    return int(moment.timestamp() * 1_000_000) * 1000
+
+def validate_address_arg(arg):
+    """
+    Splits host:port.
+    """
+    host, _, port = arg.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        port = -1
+    if not host or not 0 < port < 65536:
+        log.error('Address must be host:port (got %s)', repr(arg))
+        sys.exit(1)
+    return host, port
+
+def validate_bucket(arg):
+    """
+    Converts a --bucket time in seconds, which must be positive.
+    """
+    try:
+        bucket = float(arg)
+    except ValueError:
+        bucket = 0
+    if not 0 < bucket < float('inf'):
+        log.error('Bucket must be a positive number of seconds (got %s)', repr(arg))
+        sys.exit(1)
+    return bucket
+
+def format_time(time_ns):
+    seconds, nanoseconds = divmod(time_ns, 1_000_000_000)
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds)) + f'.{nanoseconds:09d}'
+
+def read_frames(args):
+    """
+    Yields the frames selected by args from every file in args.files.
+    """
+    for path in args.files:
+        try:
+            yield from capturefile.read_frames(path, args.start, args.end, args.addr, args.port)
+        except (OSError, ValueError) as exc:
+            log.error("Couldn't read %s (%s)", path, str(exc))
+            sys.exit(1)
+
+def list_frames(args):
+    out = sys.stdout
+    for frame in read_frames(args):
+        out.write(f'{format_time(frame.time_ns)} {frame.addr}:{frame.port} {len(frame.data)}\n')
+        if args.hexdump:
+            out.write(hexformat.hexdump_bytes(frame.data, '\t').decode())
+
+def dump_frames(args):
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for frame in read_frames(args):
+            out.write(frame.data)
+    finally:
+        if args.output:
+            out.close()
+
+def connect(args):
+    """
+    Returns a socket connected as requested by args: to args.remote, or the
+    first connection accepted on args.local.
+    """
+    if args.remote:
+        host, port = args.remote
+        log.info("Connecting to %s:%d", host, port)
+        return socket.create_connection((host, port))
+
+    host, port = args.local
+    with socket.create_server((host, port)) as server:
+        log.info("Waiting for a connection on %s:%d", host, port)
+        sock, addr = server.accept()
+    log.info("Accepted connection from: %s", addr)
+    return sock
+
+def replay(args):
+    speed = args.speed
+    if speed < 0:
+        log.error('--speed must be 0 or more (got %s)', speed)
+        sys.exit(1)
+    sock = connect(args)
+    sent = 0
+    frames = 0
+    first_ns = None
+    started = time.monotonic_ns()
+    batch = bytearray()
+
+    try:
+        for frame in read_frames(args):
+            frames += 1
+            sent += len(frame.data)
+            if not speed:
+                batch += frame.data
+                if len(batch) >= REPLAY_BATCH_BYTES:
+                    sock.sendall(batch)
+                    batch.clear()
+                continue
+
+            if first_ns is None:
+                first_ns = frame.time_ns
+            due = started + (frame.time_ns - first_ns) / speed
+            delay = due - time.monotonic_ns()
+            if delay > 0:
+                time.sleep(delay / 1_000_000_000)
+            sock.sendall(frame.data)
+
+        if batch:
+            sock.sendall(batch)
+    except OSError as exc:
+        log.error("Connection lost (%s)", str(exc))
+        sys.exit(1)
+    finally:
+        sock.close()
+
+    elapsed = (time.monotonic_ns() - started) / 1_000_000_000
+    log.info("Replayed %d frames (%d bytes) in %.3f sec", frames, sent, elapsed)
+
+def load_table(args):
+    """
+    Returns (table, peers) for the frames selected by args from every file
+    in args.files, as from capturefile.frame_table(), with peer ids made
+    consistent across files.  A frame from a peer id that isn't in its
+    file's peer records means the file is corrupt.
+    """
+    import numpy as np
+
+    tables = []
+    peer_ids = {}  # (addr, port) -> id
+    for path in args.files:
+        try:
+            table, peers = capturefile.frame_table(path, args.start, args.end,
+                                                   args.addr, args.port)
+        except (OSError, ValueError) as exc:
+            log.error("Couldn't read %s (%s)", path, str(exc))
+            sys.exit(1)
+        if len(table):
+            # Peer ids needn't be dense, so are looked up in sorted order
+            file_ids = np.array(sorted(peers) or [0], dtype=np.uint32)
+            where = np.minimum(np.searchsorted(file_ids, table['peer']), len(file_ids) - 1)
+            unknown = (file_ids[where] != table['peer']) | (not peers)
+            if unknown.any():
+                log.error("Couldn't read %s (corrupt file: frame from unknown peer id %d)",
+                          path, table['peer'][unknown][0])
+                sys.exit(1)
+            new_ids = np.array([peer_ids.setdefault(peers[peer_id], len(peer_ids))
+                                for peer_id in file_ids.tolist()], dtype=np.uint32)
+            table['peer'] = new_ids[where]
+        tables.append(table)
+
+    table = np.concatenate(tables)
+    table = table[np.argsort(table['time_ns'], kind='stable')]
+    return table, {peer_id: peer for peer, peer_id in peer_ids.items()}
+
+def format_count(value, unit=''):
+    for prefix in ('', 'K', 'M', 'G'):
+        if abs(value) < 1000:
+            break
+        value /= 1000
+    else:
+        prefix = 'T'
+    return f'{value:.1f} {prefix}{unit}' if prefix else f'{value:.0f} {unit}'.rstrip()
+
+def format_ns(value):
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if value >= scale:
+            return f'{value / scale:.3g} {unit}'
+    return f'{value:.0f} ns'
+
+def log2_histogram(values):
+    """
+    Returns [(low, high, count, sum), ...] for power-of-two buckets of
+    values, skipping empty buckets.  Values under 1 go in the first bucket.
+    """
+    import numpy as np
+
+    exponents = np.floor(np.log2(np.maximum(values, 1))).astype(np.int64)
+    counts = np.bincount(exponents)
+    sums = np.bincount(exponents, weights=values)
+    return [(2 ** exponent if exponent else 0, 2 ** (exponent + 1) - 1, count, total)
+            for exponent, (count, total) in enumerate(zip(counts, sums)) if count]
+
+def show_stats(args):
+    try:
+        import numpy as np
+    except ImportError:
+        log.error("The stats command requires NumPy (pip install numpy)")
+        sys.exit(1)
+
+    table, peers = load_table(args)
+    if not len(table):
+        log.info("No frames selected")
+        return
+
+    times = table['time_ns'].astype(np.int64)
+    sizes = table['size'].astype(np.int64)
+    # Compact peer indexes, 0 .. npeers - 1
+    peer_list, peer_index = np.unique(table['peer'], return_inverse=True)
+    npeers = len(peer_list)
+
+    frames = np.bincount(peer_index, minlength=npeers)
+    total = np.bincount(peer_index, weights=sizes, minlength=npeers)
+
+    # Frames by peer, then time (and so by time bucket within each peer)
+    order = np.lexsort((times, peer_index))
+    sorted_peers = peer_index[order]
+    same_peer = sorted_peers[1:] == sorted_peers[:-1]
+
+    # Bytes per peer per time bucket, summed over just the (peer, bucket)
+    # pairs that have frames, as a peers x buckets array can be huge
+    bucket_ns = int(args.bucket * 1e9)
+    buckets = (times[order] - times[0]) // bucket_ns
+    nbuckets = int((times[-1] - times[0]) // bucket_ns) + 1
+    starts = np.flatnonzero(np.concatenate(([True], ~same_peer | (buckets[1:] != buckets[:-1]))))
+    per_bucket = np.add.reduceat(sizes[order], starts)
+    peak = np.zeros(npeers)
+    np.maximum.at(peak, sorted_peers[starts], per_bucket)
+    mean_rate = total / (nbuckets * args.bucket)
+    peak_rate = peak / args.bucket
+
+    # Gaps between consecutive frames from the same peer
+    gaps = np.diff(times[order])[same_peer]
+    gap_groups = np.split(gaps, np.cumsum(np.bincount(sorted_peers[1:][same_peer],
+                                                      minlength=npeers))[:-1])
+
+    duration = (times[-1] - times[0]) / 1e9
+    print(f'{len(table)} frames, {format_count(sizes.sum(), "B")} from {npeers} peers '
+          f'in {duration:.3f} sec ({format_time(int(times[0]))} to {format_time(int(times[-1]))})')
+
+    report = prettytable.PrettyTable()
+    report.field_names = ['addr', 'port', 'frames', 'bytes', 'share', 'mean rate',
+                          f'peak rate ({args.bucket:g}s)', 'gap p50', 'gap p99', 'gap max']
+    for n in np.argsort(-total, kind='stable')[:args.top]:
+        addr, port = peers[int(peer_list[n])]
+        group = gap_groups[n]
+        if len(group):
+            p50, p99 = np.percentile(group, [50, 99])
+            gap_columns = [format_ns(p50), format_ns(p99), format_ns(group.max())]
+        else:
+            gap_columns = ['-'] * 3
+        report.add_row([addr, port, frames[n], format_count(total[n], 'B'),
+                        f'{100 * total[n] / sizes.sum():.1f}%',
+                        format_count(mean_rate[n], 'B/s'), format_count(peak_rate[n], 'B/s')]
+                       + gap_columns)
+    print(f'\nTop {min(args.top, npeers)} peers by bytes:')
+    print(report.get_string())
+
+    report = prettytable.PrettyTable()
+    report.field_names = ['frame size', 'frames', 'bytes']
+    for low, high, count, size_sum in log2_histogram(sizes):
+        report.add_row([f'{low}-{high}', count, format_count(size_sum, 'B')])
+    print('\nFrame sizes:')
+    print(report.get_string())
+
+    if len(gaps):
+        report = prettytable.PrettyTable()
+        report.field_names = ['gap', 'count']
+        for low, high, count, _ in log2_histogram(gaps):
+            report.add_row([f'{format_ns(low)} - {format_ns(high)}', count])
+        print('\nGaps between frames from the same peer:')
+        print(report.get_string())
+
+def parse_args():
+    descr = "Lists, extracts and replays pysockethub capture files."
+    parser = argparse.ArgumentParser(description=descr,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument("files", nargs='+',
+                         help="Capture files (or segments), read in the order given.")
+    filters.add_argument("--start", type=validate_time,
+                         help="Only frames received at or after this time.")
+    filters.add_argument("--end", type=validate_time,
+                         help="Only frames received at or before this time.")
+    filters.add_argument("--addr",
+                         help="Only frames received from this address.")
+    filters.add_argument("--port", type=int,
+                         help="Only frames received from this port.")
+
+    formatter = argparse.ArgumentDefaultsHelpFormatter
+    command = commands.add_parser('frames', parents=[filters], formatter_class=formatter,
+                                  help="List frames.")
+    command.add_argument("--hexdump", action='store_true',
+                         help="Also show a hexdump of each frame's data.")
+    command.set_defaults(func=list_frames)
+
+    command = commands.add_parser('dump', parents=[filters], formatter_class=formatter,
+                                  help="Write the frames' data to a file.")
+    command.add_argument("-o", "--output",
+                         help="Output filename.  Default is stdout.")
+    command.set_defaults(func=dump_frames)
+
+    command = commands.add_parser('replay', parents=[filters], formatter_class=formatter,
+                                  help="Send the frames' data over TCP.")
+    target = command.add_mutually_exclusive_group(required=True)
+    target.add_argument("-r", "--remote", type=validate_address_arg,
+                        help="host:port to connect to, e.g. a pysockethub -l port.")
+    target.add_argument("-l", "--local", type=validate_address_arg,
+                        help="host:port to listen on for one connection, e.g. from a \
+                        pysockethub -r.")
+    command.add_argument("--speed", default=1.0, type=float,
+                         help="Replay speed: 1 is the original pace, 10 is ten times faster, \
+                         0 is as fast as possible.")
+    command.set_defaults(func=replay)
+
+    command = commands.add_parser('stats', parents=[filters], formatter_class=formatter,
+                                  help="Show traffic statistics (requires NumPy).")
+    command.add_argument("--bucket", default=1.0, type=validate_bucket,
+                         help="Time bucket in seconds for peak rates.")
+    command.add_argument("--top", default=10, type=int,
+                         help="Number of peers to show, busiest first.")
+    command.set_defaults(func=show_stats)
+
+    return parser.parse_args()
+
+def main(args):
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # Output piped into e.g. head, which exited
+        pass
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,304 @@
+"""
+Incremental frame decoders for pysockethub.
+
+A decoder is fed the bytes received on one connection, in whatever pieces
+recv() returned them, and hands back only complete frames.  Frames include
+their header, delimiter or sync word, so distributing them reproduces the
+original stream exactly; only the chunking changes.
+
+To use:
+>>> import framing
+>>> new_decoder = framing.decoder_factory('line')
+>>> decoder = new_decoder()
+>>> [bytes(frame) for frame in decoder.feed(b'abc\\nde')]
+[b'abc\\n']
+>>> [bytes(frame) for frame in decoder.feed(b'f\\n')]
+[b'def\\n']
+
+feed() takes bytes or a bytearray and returns a list of frames.  A frame
+that lies entirely within the data passed to feed() is returned as a
+memoryview slice of it (no copy), and is only valid for as long as that
+data is.  A frame that was reassembled from several feed() calls is
+returned as bytes.
+
+Framing specs accepted by decoder_factory():
+    none            No framing; data is distributed as it arrives.
+    length:N[:little]
+                    N-byte (1, 2, 4 or 8) unsigned length header, big-endian
+                    unless :little is given, followed by that many bytes.
+    line            Frames end with b'\\n'.
+    crlf            Frames end with b'\\r\\n'.
+    delim:HEX       Frames end with the given delimiter, e.g. delim:00
+    fixed:N         Every frame is N bytes.
+    sync:HEX[:N]    Sync word, then an N-byte (default 2) big-endian length,
+                    then that many bytes, e.g. sync:EB90:4.  Bytes that
+                    don't start with the sync word are discarded until it
+                    is found again.
+"""
+
+import struct
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Bytes; larger frames are a FrameError
+
+class FrameError(ValueError):
+    """
+    Raised by feed() when the stream can't be framed (e.g. a length header
+    larger than MAX_FRAME_SIZE, or no delimiter within MAX_FRAME_SIZE bytes).
+    """
+
+class FrameBuffer:
+    """
+    Holds the bytes of a partially received frame.
+
+    Consumed bytes are skipped over with an offset rather than deleted, and
+    the buffer is only compacted when the consumed prefix is at least half
+    of it, so appends and consumes are amortized O(1) instead of copying
+    the pending data every time.
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.start = 0
+
+    def __len__(self):
+        return len(self.data) - self.start
+
+    def append(self, data):
+        if self.start and self.start >= len(self.data) // 2:
+            del self.data[:self.start]
+            self.start = 0
+        self.data += data
+
+    def consume(self, nbytes):
+        self.start += nbytes
+        if self.start == len(self.data):
+            self.data.clear()
+            self.start = 0
+
+class FrameDecoder:
+    """
+    Base class for decoders.  Subclasses implement _parse().
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.pending = FrameBuffer()
+
+    def feed(self, data, end=None):
+        """
+        Feeds the next received bytes, data[:end], and returns a list of the
+        frames completed by them.  end lets a partly filled recv buffer be
+        passed without slicing it.
+        """
+        if end is None:
+            end = len(data)
+        spans = []
+
+        if not self.pending:
+            # Nothing left over from earlier calls, so frames can be parsed
+            # in place and returned as views of data.
+            pos = self._parse(data, 0, end, spans)
+            if pos < end:
+                self._check_pending(end - pos)
+                self.pending.append(memoryview(data)[pos:end])
+            if not spans:
+                return []
+            view = memoryview(data)
+            return [view[start:stop] for start, stop in spans]
+
+        pending = self.pending
+        pending.append(memoryview(data)[:end])
+        pos = self._parse(pending.data, pending.start, len(pending.data), spans)
+        # (The view must be released before the bytearray is resized.)
+        with memoryview(pending.data) as view:
+            frames = [view[start:stop].tobytes() for start, stop in spans]
+        pending.consume(pos - pending.start)
+        self._check_pending(len(pending))
+        return frames
+
+    def _check_pending(self, nbytes):
+        if nbytes > self.max_frame_size:
+            raise FrameError(f'No complete frame in {nbytes} bytes '
+                             f'(max frame size is {self.max_frame_size})')
+
+    def _parse(self, buf, pos, end, spans):
+        """
+        Appends (start, stop) for each complete frame in buf[pos:end] to
+        spans.  Returns the position of the first byte not consumed.
+        """
+        raise NotImplementedError
+
+class LengthPrefixDecoder(FrameDecoder):
+    """
+    <length:header_size> <data:length>, where length counts only the data.
+    With strip_header, frames are just the data.
+    """
+    FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+    def __init__(self, header_size=4, byteorder='big', strip_header=False,
+                 max_frame_size=MAX_FRAME_SIZE):
+        super().__init__(max_frame_size)
+        try:
+            fmt = self.FORMATS[header_size]
+        except KeyError:
+            raise ValueError(f'Length header must be 1, 2, 4 or 8 bytes (got {header_size})')
+        self.header = struct.Struct(('>' if byteorder == 'big' else '<') + fmt)
+        self.strip_header = strip_header
+
+    def _parse(self, buf, pos, end, spans):
+        header_size = self.header.size
+        while end - pos >= header_size:
+            (length,) = self.header.unpack_from(buf, pos)
+            if length > self.max_frame_size:
+                raise FrameError(f'Frame length {length} exceeds max frame size '
+                                 f'{self.max_frame_size}')
+            stop = pos + header_size + length
+            if stop > end:
+                break
+            spans.append((pos + header_size if self.strip_header else pos, stop))
+            pos = stop
+        return pos
+
+class DelimiterDecoder(FrameDecoder):
+    """
+    Frames end with delimiter (included in the frame).
+
+    The search for the delimiter resumes where the last one left off
+    (scanned bytes into the pending data), so a long frame arriving in many
+    pieces is scanned once rather than from its start on every feed().
+    """
+    def __init__(self, delimiter=b'\n', max_frame_size=MAX_FRAME_SIZE):
+        super().__init__(max_frame_size)
+        if not delimiter:
+            raise ValueError('Delimiter must not be empty')
+        self.delimiter = delimiter
+        self.scanned = 0  # Bytes of pending data known not to start a delimiter
+
+    def _parse(self, buf, pos, end, spans):
+        delimiter = self.delimiter
+        search = pos + self.scanned
+        while True:
+            index = buf.find(delimiter, search, end)
+            if index < 0:
+                # What's left becomes the pending data; a delimiter split
+                # across feeds can start in its last len(delimiter) - 1 bytes.
+                self.scanned = max(0, end - pos - len(delimiter) + 1)
+                return pos
+            stop = index + len(delimiter)
+            spans.append((pos, stop))
+            pos = search = stop
+
+class FixedSizeDecoder(FrameDecoder):
+    """
+    Every frame is frame_size bytes.
+    """
+    def __init__(self, frame_size, max_frame_size=MAX_FRAME_SIZE):
+        super().__init__(max(frame_size, max_frame_size))
+        if frame_size < 1:
+            raise ValueError(f'Frame size must be positive (got {frame_size})')
+        self.frame_size = frame_size
+
+    def _parse(self, buf, pos, end, spans):
+        size = self.frame_size
+        while end - pos >= size:
+            spans.append((pos, pos + size))
+            pos += size
+        return pos
+
+class SyncDecoder(FrameDecoder):
+    """
+    <sync> <length:length_size> <data:length>, big-endian length.
+
+    If the bytes at a frame boundary aren't the sync word, the decoder
+    discards bytes up to the next occurrence of it (counted in
+    discarded_bytes) and carries on from there.
+    """
+    def __init__(self, sync=b'\xEB\x90', length_size=2, max_frame_size=MAX_FRAME_SIZE):
+        super().__init__(max_frame_size)
+        if not sync:
+            raise ValueError('Sync word must not be empty')
+        try:
+            fmt = LengthPrefixDecoder.FORMATS[length_size]
+        except KeyError:
+            raise ValueError(f'Length field must be 1, 2, 4 or 8 bytes (got {length_size})')
+        self.sync = sync
+        self.length = struct.Struct('>' + fmt)
+        self.discarded_bytes = 0
+
+    def _parse(self, buf, pos, end, spans):
+        sync = self.sync
+        header_size = len(sync) + self.length.size
+        while end - pos >= len(sync):
+            if not buf.startswith(sync, pos):
+                # Lost sync.  Skip ahead to the next sync word, keeping any
+                # trailing bytes that could be the start of one.
+                index = buf.find(sync, pos + 1, end)
+                if index < 0:
+                    index = end - len(sync) + 1
+                self.discarded_bytes += index - pos
+                pos = index
+                continue
+
+            if end - pos < header_size:
+                break
+            (length,) = self.length.unpack_from(buf, pos + len(sync))
+            if length > self.max_frame_size:
+                # Most likely a false sync in the middle of data
+                self.discarded_bytes += 1
+                pos += 1
+                continue
+            stop = pos + header_size + length
+            if stop > end:
+                break
+            spans.append((pos, stop))
+            pos = stop
+        return pos
+
+def decoder_factory(spec):
+    """
+    Parses a framing spec (see the module docstring) and returns a callable
+    that creates a new decoder, or None for 'none'.  Raises ValueError if
+    the spec is invalid.
+    """
+    parts = spec.split(':')
+    kind = parts[0].lower()
+    args = parts[1:]
+
+    try:
+        if kind == 'none' and not args:
+            return None
+
+        if kind == 'length' and len(args) in (1, 2):
+            header_size = int(args[0])
+            byteorder = 'big'
+            if len(args) == 2:
+                if args[1].lower() not in ('big', 'little'):
+                    raise ValueError(f'Byte order must be big or little (got {args[1]!r})')
+                byteorder = args[1].lower()
+            LengthPrefixDecoder(header_size, byteorder)
+            return lambda: LengthPrefixDecoder(header_size, byteorder)
+
+        if kind == 'line' and not args:
+            return lambda: DelimiterDecoder(b'\n')
+
+        if kind == 'crlf' and not args:
+            return lambda: DelimiterDecoder(b'\r\n')
+
+        if kind == 'delim' and len(args) == 1:
+            delimiter = bytes.fromhex(args[0])
+            DelimiterDecoder(delimiter)
+            return lambda: DelimiterDecoder(delimiter)
+
+        if kind == 'fixed' and len(args) == 1:
+            frame_size = int(args[0])
+            FixedSizeDecoder(frame_size)
+            return lambda: FixedSizeDecoder(frame_size)
+
+        if kind == 'sync' and len(args) in (1, 2):
+            sync = bytes.fromhex(args[0])
+            length_size = int(args[1]) if len(args) == 2 else 2
+            SyncDecoder(sync, length_size)
+            return lambda: SyncDecoder(sync, length_size)
+
+    except ValueError as exc:
+        raise ValueError(f'Invalid framing {spec!r}: {exc}')
+
+    raise ValueError(f'Invalid framing {spec!r}')
@@ -0,0 +1,120 @@
+"""
+Hexdump formatting for pysockethub.
+
+Produces the same layout as the hexdump package's hexdump():
+
+    00000000: 48 65 6C 6C 6F 2C 20 77  6F 72 6C 64 21 0D 0A     Hello, world!..
+
+but formats a whole chunk at once rather than a line and a byte at a
+time: one hex() call for the hex columns and one translate() for the
+ASCII column.  Whole lines of a large chunk are then laid out column by
+column, with strided slice assignments into a template of blank lines, so
+the per-line work is done in C; a few lines are just sliced out.  Only the
+last, partial line is padded.
+
+To use:
+>>> import hexformat
+>>> print(hexformat.hexdump(b'Hello, world!\\r\\n'))
+00000000: 48 65 6C 6C 6F 2C 20 77  6F 72 6C 64 21 0D 0A     Hello, world!..
+"""
+
+BYTES_PER_LINE = 16
+HEX_DIGITS = b'0123456789ABCDEF'
+
+# Printable ASCII (0x20 to 0x7E) is shown as is, everything else as '.'
+ASCII_TABLE = bytes(byte if 0x20 <= byte <= 0x7E else ord('.') for byte in range(256))
+
+# A whole line: 8 digit address, ': ', 16 hex bytes (with an extra space
+# after the 8th), 2 spaces, 16 ASCII characters
+ASCII_COLUMN = 10 + 3 * BYTES_PER_LINE + 2
+LINE_TEMPLATE = b'00000000: ' + b' ' * (ASCII_COLUMN - 10 + BYTES_PER_LINE) + b'\n'
+
+STRIDED_MIN_LINES = 32  # Below this, slicing out each line is faster
+
+def hex_column(index):
+    """Returns the column of the hex digits of byte index in a line."""
+    return 10 + 3 * index + (index >= 8)
+
+def address_digits(digit, nlines):
+    """
+    Returns the given hex digit (0 = least significant) of the line
+    numbers 0 to nlines - 1, as bytes.
+    """
+    repeat = 1 << (4 * digit)
+    runs = (nlines - 1) // repeat + 1
+    if runs > len(HEX_DIGITS):
+        cycle = b''.join(HEX_DIGITS[i:i + 1] * repeat for i in range(len(HEX_DIGITS)))
+        return (cycle * (nlines // len(cycle) + 1))[:nlines]
+    return b''.join(HEX_DIGITS[i:i + 1] * repeat for i in range(runs))[:nlines]
+
+def strided_lines(data, prefix):
+    """
+    Returns the hexdump of data, a whole number of lines long, as bytes.
+    """
+    nlines = len(data) // BYTES_PER_LINE
+    width = len(prefix) + len(LINE_TEMPLATE)
+    start = len(prefix)
+    out = bytearray((prefix + LINE_TEMPLATE) * nlines)
+
+    # Address: the offset's last digit is always 0, the rest are the line number's
+    digit = 0
+    while (nlines - 1) >> (4 * digit):
+        out[start + 6 - digit::width] = address_digits(digit, nlines)
+        digit += 1
+
+    hex_text = data.hex().upper().encode()
+    for index in range(BYTES_PER_LINE):
+        column = start + hex_column(index)
+        out[column::width] = hex_text[2 * index::2 * BYTES_PER_LINE]
+        out[column + 1::width] = hex_text[2 * index + 1::2 * BYTES_PER_LINE]
+
+    ascii_text = data.translate(ASCII_TABLE)
+    for index in range(BYTES_PER_LINE):
+        out[start + ASCII_COLUMN + index::width] = ascii_text[index::BYTES_PER_LINE]
+    return out
+
+def sliced_lines(data, prefix, offset=0):
+    """
+    Returns the hexdump of data, starting at address offset, as a list of
+    lines (str, without line endings).
+    """
+    hex_text = data.hex(' ').upper()  # 3 characters per byte
+    ascii_text = data.translate(ASCII_TABLE).decode('ascii')
+    whole = len(data) - len(data) % BYTES_PER_LINE
+
+    lines = [f'{prefix}{offset + pos:08X}: {hex_text[3 * pos:3 * pos + 23]}  '
+             f'{hex_text[3 * pos + 24:3 * pos + 47]}  '
+             f'{ascii_text[pos:pos + BYTES_PER_LINE]}'
+             for pos in range(0, whole, BYTES_PER_LINE)]
+
+    if whole < len(data):
+        hex_part = hex_text[3 * whole:]
+        if len(data) - whole > 8:
+            hex_part = hex_part[:23] + '  ' + hex_part[24:]
+        lines.append(f'{prefix}{offset + whole:08X}: {hex_part:<{ASCII_COLUMN - 12}}  '
+                     f'{ascii_text[whole:]}')
+    return lines
+
+def hexdump_bytes(data, prefix=''):
+    """
+    Returns the hexdump of data (bytes-like) as bytes, each line starting
+    with prefix and ending with b'\\n'.
+    """
+    data = bytes(data)
+    whole = len(data) - len(data) % BYTES_PER_LINE
+    if whole // BYTES_PER_LINE < STRIDED_MIN_LINES:
+        lines = sliced_lines(data, prefix)
+        lines.append('')
+        return '\n'.join(lines).encode()
+
+    out = strided_lines(data[:whole], prefix.encode())
+    if whole < len(data):
+        out += (sliced_lines(data[whole:], prefix, whole)[0] + '\n').encode()
+    return bytes(out)
+
+def hexdump(data, prefix=''):
+    """
+    Returns the hexdump of data (bytes-like) as a str, each line starting
+    with prefix, lines separated by '\\n'.
+    """
+    return hexdump_bytes(data, prefix)[:-1].decode()
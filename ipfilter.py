@@ -0,0 +1,196 @@
+"""
+IP address allow and deny lists for pysockethub's listen ports.
+
+Rules are networks in CIDR notation, IPv4 or IPv6 (a bare address is a /32
+or /128), one per line.  Blank lines and text after '#' are ignored.
+
+An address is judged by the most specific rule that contains it, with
+deny winning if the same network is in both lists:
+    deny rule       Rejected.
+    allow rule      Accepted.
+    no rule         Accepted, unless there is an allow list, in which case
+                    only the addresses it contains are accepted (even if
+                    it is empty).
+So e.g. 10.0.0.0/8 can be allowed except for a denied 10.1.0.0/16, except
+for an allowed 10.1.2.0/24.
+
+The rules are compiled into sorted, non-overlapping address ranges for
+each IP version, each with the verdict of the most specific rule covering
+it, so checking an address is one binary search however many rules there
+are.  IPv4-mapped IPv6 addresses (::ffff:a.b.c.d) are checked as IPv4.
+
+To use:
+>>> import ipfilter
+>>> rules = ipfilter.IPFilter(allow=['10.0.0.0/8'], deny=['10.1.0.0/16'])
+>>> rules.allowed('10.2.3.4'), rules.allowed('10.1.2.3'), rules.allowed('192.168.1.1')
+(True, False, False)
+"""
+
+import bisect
+import ipaddress
+import os
+import socket
+
+ALLOW = True
+DENY = False
+
+def parse_networks(lines, source='<rules>'):
+    """
+    Returns the ipaddress networks in lines (see the module docstring).
+    Raises ValueError, naming source and the line, for an invalid one.
+    """
+    networks = []
+    for number, line in enumerate(lines, 1):
+        text = line.split('#', 1)[0].strip()
+        if not text:
+            continue
+        try:
+            networks.append(ipaddress.ip_network(text, strict=False))
+        except ValueError as exc:
+            raise ValueError(f'{source}:{number}: {exc}')
+    return networks
+
+def compile_ranges(rules):
+    """
+    Given [(first address, last address, verdict), ...] for networks (which
+    are either nested or disjoint), returns (starts, verdicts): the start
+    of each range of addresses with the same verdict, in order, and that
+    verdict (None where no rule applies).
+    """
+    starts = []
+    verdicts = []
+
+    def mark(position, verdict):
+        if starts and starts[-1] == position:
+            verdicts[-1] = verdict
+        else:
+            starts.append(position)
+            verdicts.append(verdict)
+
+    # Enclosing networks sort before the networks inside them, and a deny
+    # after an allow of the same network, so that it ends up on top.
+    stack = []  # (last address, verdict) of the networks containing the position
+    for first, last, verdict in sorted(rules, key=lambda rule: (rule[0], -rule[1],
+                                                                rule[2] is DENY)):
+        while stack and stack[-1][0] < first:
+            end, _ = stack.pop()
+            mark(end + 1, stack[-1][1] if stack else None)
+        mark(first, verdict)
+        stack.append((last, verdict))
+    while stack:
+        end, _ = stack.pop()
+        mark(end + 1, stack[-1][1] if stack else None)
+
+    # Merge neighbouring ranges with the same verdict
+    merged_starts = []
+    merged_verdicts = []
+    for start, verdict in zip(starts, verdicts):
+        if not merged_verdicts or merged_verdicts[-1] != verdict:
+            merged_starts.append(start)
+            merged_verdicts.append(verdict)
+    return merged_starts, merged_verdicts
+
+class IPFilter:
+    """
+    Compiled allow and deny lists.  allow and deny are lists of CIDR
+    strings or ipaddress networks.  default is the verdict for addresses
+    no rule applies to; by default, DENY if there are allow rules, else
+    ALLOW.
+    """
+    def __init__(self, allow=(), deny=(), default=None):
+        allow = [ipaddress.ip_network(network, strict=False) for network in allow]
+        deny = [ipaddress.ip_network(network, strict=False) for network in deny]
+        self.allow_count = len(allow)
+        self.deny_count = len(deny)
+        self.default = default if default is not None else not allow
+        self.tables = {}  # IP version -> (starts, verdicts)
+        for version in (4, 6):
+            rules = [(int(network.network_address), int(network.broadcast_address), verdict)
+                     for networks, verdict in ((allow, ALLOW), (deny, DENY))
+                     for network in networks if network.version == version]
+            self.tables[version] = compile_ranges(rules)
+
+    def allowed(self, addr):
+        """
+        Returns True if connections from addr (an IPv4 or IPv6 address
+        string) are allowed.
+        """
+        try:
+            packed = socket.inet_pton(socket.AF_INET6 if ':' in addr else socket.AF_INET, addr)
+        except OSError:
+            # Not an IP address (e.g. a scope ID we don't handle); no rule applies
+            return self.default
+        value = int.from_bytes(packed, 'big')
+        version = 4 if len(packed) == 4 else 6
+        if version == 6 and value >> 32 == 0xFFFF:
+            version = 4
+            value &= 0xFFFFFFFF
+
+        starts, verdicts = self.tables[version]
+        index = bisect.bisect_right(starts, value) - 1
+        verdict = verdicts[index] if index >= 0 else None
+        if verdict is None:
+            return self.default
+        return verdict
+
+class IPFilterFiles:
+    """
+    An IPFilter loaded from an allow file and a deny file (either may be
+    None), that reload_if_changed() re-reads when either file changes.
+
+    If there is an allow file, addresses it doesn't contain are rejected
+    even when it has no rules.  On reload, an allow file that has gone
+    from having rules to having none is refused, as it is more likely to
+    be in the middle of being rewritten than meant to shut everyone out.
+    """
+    def __init__(self, allow_path=None, deny_path=None):
+        self.allow_path = allow_path
+        self.deny_path = deny_path
+        self.versions = self.changed = self._versions()
+        self.filter = self._load()
+
+    def allowed(self, addr):
+        return self.filter.allowed(addr)
+
+    def reload_if_changed(self):
+        """
+        Reloads the files if either has changed since it was last read and
+        has then stayed the same since the previous call (so that a file
+        isn't read while it is being written), returning True if it did.
+        If a file can't be read or has an invalid rule, raises OSError or
+        ValueError and keeps the old rules (until the file changes again).
+
+        Loading takes a while for long lists, so this is meant to be
+        called from a thread other than the one checking addresses; the
+        new IPFilter replaces the old in a single assignment.
+        """
+        versions = self._versions()
+        changed, self.changed = self.changed, versions
+        if versions == self.versions or versions != changed:
+            return False
+        self.versions = versions
+        new_filter = self._load()
+        if self.filter.allow_count and not new_filter.allow_count:
+            raise ValueError(f'{self.allow_path} has no rules')
+        self.filter = new_filter
+        return True
+
+    def _versions(self):
+        versions = []
+        for path in (self.allow_path, self.deny_path):
+            try:
+                stat = os.stat(path) if path else None
+            except OSError:
+                stat = None
+            versions.append((stat.st_mtime_ns, stat.st_size) if stat else None)
+        return versions
+
+    def _load(self):
+        networks = []
+        for path in (self.allow_path, self.deny_path):
+            if path:
+                with open(path) as f:
+                    networks.append(parse_networks(f, path))
+            else:
+                networks.append([])
+        return IPFilter(*networks, default=DENY if self.allow_path else ALLOW)
@@ -13,12 +13,25 @@ Features:
     x Option to specify log format
         x raw: binary, all data as it arrives goes into a file
         x frames: binary, but has a frame with some header information indicating the source of the data
+          (buffered, with --log-flush / --log-fsync policies)
+        x capture: like frames, with ns timestamps, a peer table and an index for seeking
         x hex: similar to frames but header is in readable ascii and data is in hex
         x plugin: calls user-supplied function (specify plugin module name on cmdline)
+    x Log file rotation by size/time, retention and compression (--log-rotate-*, --log-compress)
+    x Logging runs on a writer thread behind a bounded queue (--log-queue, --log-overflow)
     x Option to enable debug output to screen with hex or ascii + timestamps
+        x Limited to a budget of bytes / lines per second, with sampling (--hex-*)
     x Option to output summary stats table at fixed rate
-    - Option to restrict incoming connections by IP range (whitelist / blacklist)
-    - Option to make connections recv only (no tx)
+    x Non-blocking sends with a per-connection send queue limit and a
+      policy for slow consumers (drop oldest/newest, disconnect, backpressure)
+    x Optional asyncio engine (--engine asyncio), using uvloop if installed
+    x Multi-process mode (--workers N) using SO_REUSEPORT listen sockets
+    x Option to distribute whole frames instead of bytes (--framing)
+    x Prometheus metrics endpoint (--metrics)
+    x Routing rules by source, peer address and frame prefix/topic (--route)
+    x Option to restrict incoming connections by IP range (--ip-allow / --ip-deny)
+    x Option to make connections recv only (no tx) or send only (no rx)
+      (host:port[:...]:recv / :send)
 
 tests:
     - plugin path resolution (may need to add option to specify path to plugin module?)
@@ -27,45 +40,84 @@ tests:
     - hostnames vs. IPs (particularly in the binary loggers that include this info)
 
 todo:
-    - consider distributing frames, not bytes
-        Could be done in service_readable() by passing recv'd data to a class that does frame sync
     - docstrings
     - diagrams
     - logo
     - mention socat / netcat in docs (http://www.dest-unreach.org/socat/)
     - add .reg file for windows users
-    - ability to make some connections recv only (don't accept any data from the remote side)
     - pip installer - adds to python scripts path
 
 """
 
 # System imports
 import argparse
+import asyncio
 import collections
+import errno
+import heapq
 import importlib
+import itertools
+import json
 import logging
+import math
 import os
 import pkgutil
-import select
+import selectors
+import shutil
+import signal
 import socket
 import struct
 import sys
 import threading
 import time
 
-
-# Third-party imports
-import hexdump
-import prettytable
-
 # Local imports
 import ansicolor
+import capturefile
 import colorlog
+import framing
+import hexformat
+import ipfilter
 
 # Globals
 MAX_CONNECTIONS_DEFAULT = 10
 AUTO_RECONNECT_DEFAULT = True
-LOCK = threading.Lock()  # Protects access to socket lists between threads
+# Which way data flows on a -l or -r endpoint's connections: both ways, only
+# received from them (sources), or only sent to them (subscribers)
+DIRECTIONS = ['both', 'recv', 'send']
+DIRECTION_DEFAULT = 'both'
+RECONNECT_DELAY_MAX = 10  # Seconds
+RELISTEN_DELAY = 1  # Seconds between attempts to listen again after a failed bind (asyncio)
+SEND_HWM_DEFAULT = 1024 * 1024  # Bytes queued per connection
+SLOW_POLICIES = ['drop-oldest', 'drop-newest', 'disconnect', 'backpressure']
+SLOW_POLICY_DEFAULT = 'disconnect'
+RECV_SIZE_DEFAULT = 4096  # Bytes per recv(); the starting size in adaptive mode
+RECV_SIZE_MAX = 256 * 1024  # Largest recv() size adaptive mode grows to
+READ_BUDGET_DEFAULT = 256 * 1024  # Bytes drained from one socket per wakeup
+BUFFER_POOL_MAX_BYTES = 64 * 1024 * 1024  # Idle recv buffers kept for reuse
+COPY_FRACTION = 4  # Data under 1/COPY_FRACTION of its recv buffer is copied out of it
+SENDMSG_MAX_CHUNKS = 64  # Chunks gathered into one sendmsg() call
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')  # Not available on Windows
+LOG_BATCH_DEFAULT = 1024 * 1024  # Bytes of log frames buffered before writing
+LOG_FLUSH_DEFAULT = 'interval:1'
+LOG_FSYNC_DEFAULT = 'none'
+LOG_QUEUE_DEFAULT = 16 * 1024 * 1024  # Bytes waiting for the log writer thread
+LOG_OVERFLOW_POLICIES = ['block', 'drop']
+LOG_ROTATE_CHECK_INTERVAL = 1  # Seconds between checks for a time-rotated segment that's due
+STATS_HISTORY_MAX = 1024  # Closed connections whose final stats are kept
+RATE_INTERVAL = 1  # Seconds between updates of the per-connection rates
+RATE_TIME_CONSTANT = 5  # Seconds; smoothing of the per-connection rates (EWMA)
+HEX_LINES_PER_SEC_DEFAULT = 2000  # Lines of hexdump shown each second
+HEX_QUEUE_MAX = 1024 * 1024  # Bytes waiting for the hexdump display thread
+IP_FILTER_CHECK_INTERVAL = 1  # Seconds between checks for changed --ip-allow/--ip-deny files
+SEND_ONLY_CHECK_INTERVAL = 1  # Seconds between checks for closed send-only connections
+SEND_ONLY_DISCARD = 64 * 1024  # Bytes from a send-only connection's peer discarded per check
+ROUTE_CACHE_MAX = 4096  # Sources whose compiled --route rules are kept
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'  # Prometheus text format
+METRICS_LINES_PER_WRITE = 1000  # Lines rendered each time a scraper's socket is writable
+METRICS_CLIENTS_MAX = 16  # Concurrent --metrics connections
+METRICS_REQUEST_MAX = 8192  # Bytes of HTTP request headers accepted
+METRICS_TIMEOUT = 10  # Seconds a --metrics connection may stay open
 LOG_LEVEL = logging.DEBUG
 
 PALETTE = ['DEEP_SKY_BLUE_1', 'DARK_ORANGE', 'LIGHT_YELLOW', 'LIGHT_RED',
@@ -96,14 +148,85 @@ def validate_port(arg):
 def validate_bool(arg):
     return arg.lower() in ['true', '1']
 
+def validate_size(arg):
+    """
+    Converts a byte count with an optional K/M/G suffix (powers of 1024) to
+    an int.  e.g. '64K' -> 65536
+    """
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = arg.strip().upper().rstrip('B')
+    multiplier = 1
+    if text and text[-1] in multipliers:
+        multiplier = multipliers[text[-1]]
+        text = text[:-1]
+    try:
+        size = int(text) * multiplier
+    except ValueError:
+        size = 0
+    if size < 1:
+        log.error('Size must be a positive number of bytes, e.g. 4096 or 64K (got %s)', repr(arg))
+        sys.exit(1)
+    return size
+
+def validate_limit(arg):
+    """
+    As validate_size(), but also accepts 0 (for no limit).
+    """
+    if arg.strip() == '0':
+        return 0
+    return validate_size(arg)
+
+def validate_framing(arg):
+    """
+    Converts a --framing spec (see framing.py) to a decoder factory, or None
+    for 'none'.
+    """
+    try:
+        return framing.decoder_factory(arg)
+    except ValueError as exc:
+        log.error('%s', str(exc))
+        sys.exit(1)
+
+LogPolicy = collections.namedtuple('LogPolicy', ['kind', 'value'])
+
+def validate_log_policy(arg):
+    """
+    Converts a --log-flush/--log-fsync policy to a LogPolicy:
+    'none', 'interval:SECONDS' or 'frames:N'.
+    """
+    kind, _, value = arg.strip().lower().partition(':')
+    try:
+        if kind == 'none' and not value:
+            return LogPolicy('none', None)
+        if kind == 'interval' and float(value) > 0:
+            return LogPolicy('interval', float(value))
+        if kind == 'frames' and int(value) > 0:
+            return LogPolicy('frames', int(value))
+    except ValueError:
+        pass
+    log.error('Policy must be none, interval:SECONDS or frames:N (got %s)', repr(arg))
+    sys.exit(1)
+
+def validate_direction(arg_parts):
+    """
+    Removes a trailing direction (see DIRECTIONS) from the parts of a -l or
+    -r arg, if there is one, and returns it (or the default).
+    """
+    if len(arg_parts) > 2 and arg_parts[-1].lower() in DIRECTIONS:
+        return arg_parts.pop().lower()
+    return DIRECTION_DEFAULT
+
 def validate_listen_arg(arg):
     arg_parts = arg.split(':')
 
     if len(arg_parts) < 2:
-        msg = "Please specify listen arg in format host:port[:max_connections].  (got: %s)"
+        msg = ("Please specify listen arg in format host:port[:max_connections][:direction].  "
+               "(got: %s)")
         log.error(msg, arg)
         sys.exit(1)
 
+    direction = validate_direction(arg_parts)
+
     host = arg_parts[0]
 
     port = validate_port(arg_parts[1])
@@ -125,21 +248,104 @@ def validate_listen_arg(arg):
         # max_connections not specified; use default
         max_connections = MAX_CONNECTIONS_DEFAULT
 
-    return host, port, max_connections
+    return host, port, max_connections, direction
+
+def validate_metrics_arg(arg):
+    """
+    Converts a --metrics host:port arg to a (host, port) tuple.
+    """
+    host, sep, port = arg.rpartition(':')
+    if not sep:
+        log.error("Please specify metrics arg in format host:port. (got %s)", arg)
+        sys.exit(1)
+    return host, validate_port(port)
+
+def validate_route_arg(values):
+    """
+    Converts a --route DEST FILTER... list to a Route.  Each filter is
+    source=HOST:PORT, addr=IP, prefix=HEX or topic=TEXT.
+    """
+    dest, filters = values[0], values[1:]
+    sources = set()
+    addrs = set()
+    prefixes = set()
+    for item in filters:
+        key, sep, value = item.partition('=')
+        try:
+            if not sep or not value:
+                raise ValueError
+            if key == 'source':
+                sources.add(value)
+            elif key == 'addr':
+                addrs.add(value)
+            elif key == 'prefix':
+                prefixes.add(bytes.fromhex(value))
+            elif key == 'topic':
+                prefixes.add(value.encode())
+            else:
+                raise ValueError
+        except ValueError:
+            log.error("Route filters must be source=HOST:PORT, addr=IP, prefix=HEX or "
+                      "topic=TEXT (got %s)", repr(item))
+            sys.exit(1)
+    return Route(dest, sources or None, addrs or None, prefixes or None)
+
+def get_ip_filter(allow_path, deny_path):
+    """
+    Returns an ipfilter.IPFilterFiles for --ip-allow/--ip-deny, or None if
+    neither was given.
+    """
+    if not allow_path and not deny_path:
+        return None
+    try:
+        ip_filter = ipfilter.IPFilterFiles(allow_path, deny_path)
+    except (OSError, ValueError) as exc:
+        log.error("Couldn't load the IP allow/deny lists (%s)", str(exc))
+        sys.exit(1)
+    log.info("Loaded IP rules: %d allow, %d deny",
+             ip_filter.filter.allow_count, ip_filter.filter.deny_count)
+    if allow_path and not ip_filter.filter.allow_count:
+        log.warning("%s has no rules; all connections will be rejected", allow_path)
+    return ip_filter
+
+def reload_ip_filter(ip_filter):
+    """Re-reads the --ip-allow/--ip-deny files if they have changed."""
+    try:
+        if ip_filter.reload_if_changed():
+            log.info("Reloaded IP rules: %d allow, %d deny",
+                     ip_filter.filter.allow_count, ip_filter.filter.deny_count)
+    except (OSError, ValueError) as exc:
+        log.error("Couldn't reload the IP allow/deny lists; keeping the old ones (%s)", str(exc))
+
+def watch_ip_filter(ip_filter):
+    """
+    Starts a thread that calls reload_ip_filter() every
+    IP_FILTER_CHECK_INTERVAL seconds, so that reading and compiling long
+    lists doesn't hold up forwarding.
+    """
+    def run():
+        while True:
+            time.sleep(IP_FILTER_CHECK_INTERVAL)
+            reload_ip_filter(ip_filter)
+
+    threading.Thread(target=run, name='ip filter reload', daemon=True).start()
 
 def validate_remote_arg(arg):
     """
-    arg: host:port:auto_reconnect
+    arg: host:port:auto_reconnect:direction
     where:
         auto_reconnect: 0/1 or True/False
+        direction: both, recv or send (see DIRECTIONS)
     """
     arg_parts = arg.split(':')
 
     if len(arg_parts) < 2:
-        msg = "Please specify remote arg in format host:port[:auto_reconnect]. (got %s)"
+        msg = "Please specify remote arg in format host:port[:auto_reconnect][:direction]. (got %s)"
         log.error(msg, arg)
         sys.exit(1)
 
+    direction = validate_direction(arg_parts)
+
     host = arg_parts[0]
 
     port = validate_port(arg_parts[1])
@@ -154,21 +360,881 @@ def validate_remote_arg(arg):
         # auto_reconnect not specified; use default
         auto_reconnect = AUTO_RECONNECT_DEFAULT
 
-    return host, port, auto_reconnect
+    return host, port, auto_reconnect, direction
+
+class Histogram:
+    """
+    Log-bucketed histogram of non-negative integers (e.g. nanoseconds), in
+    the style of HdrHistogram.  Values below 2**sub_bits each have their own
+    bucket, and every power of 2 above that is split into 2**sub_bits
+    buckets, so a value's bucket is within 1/2**sub_bits of it.  Values of
+    2**max_bits or more go in the last bucket.
+
+    The bucket counts are a list allocated up front; record() only
+    increments them, so histograms can stay on in production.
+    """
+    __slots__ = ['sub_bits', 'counts', 'count', 'total', 'max']
+
+    def __init__(self, sub_bits=3, max_bits=48):
+        self.sub_bits = sub_bits
+        self.counts = [0] * ((max_bits - sub_bits + 1) << sub_bits)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        shift = value.bit_length() - self.sub_bits - 1
+        index = value if shift < 0 else (shift << self.sub_bits) + (value >> shift)
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds the values recorded by other (created with the same arguments)."""
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def bucket_range(self, index):
+        """Returns the (lowest, highest + 1) values that go in bucket index."""
+        if index < 1 << self.sub_bits:
+            return index, index + 1
+        shift = (index >> self.sub_bits) - 1
+        low = ((index & ((1 << self.sub_bits) - 1)) | (1 << self.sub_bits)) << shift
+        return low, low + (1 << shift)
+
+    def percentile(self, percent):
+        """
+        Returns the highest value that could be in the bucket holding the
+        given percentile (or 0 if nothing has been recorded).
+        """
+        if not self.count:
+            return 0
+        target = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_range(index)[1] - 1, self.max)
+        return self.max
+
+    def cumulative(self, start, stop):
+        """
+        Generates (limit, count of values below limit) for each power of 2
+        limit from start to stop.
+        """
+        mask = (1 << self.sub_bits) - 1
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if index < mask or (index & mask) != mask:
+                continue
+            limit = self.bucket_range(index)[1]
+            if limit > stop:
+                break
+            if limit >= start:
+                yield limit, seen
+
+class Timer:
+    """
+    Handle returned by Reactor.call_later() and Reactor.call_every().  Call
+    cancel() to stop the timer from firing.
+    """
+    def __init__(self, callback, interval=None):
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Reactor:
+    """
+    Event loop built on selectors.DefaultSelector (epoll on Linux, kqueue on
+    BSD/macOS, select on Windows).
+
+    Sockets stay registered across loop iterations, so there is no per-
+    iteration rebuild of the socket list and no FD_SETSIZE limit on platforms
+    with epoll/kqueue.  The loop sleeps until a registered socket is ready or
+    the next timer is due.
+
+    Callbacks registered with a socket are called as callback(sock, mask),
+    where mask is a combination of selectors.EVENT_READ/EVENT_WRITE.
+
+    If busy_times (a Histogram) is given, the time each loop iteration
+    spends running callbacks, in nanoseconds, is recorded in it.
+    """
+    def __init__(self, busy_times=None):
+        self.busy_times = busy_times
+        self.selector = selectors.DefaultSelector()
+        self.timers = []  # heap of (deadline, seq, Timer)
+        self.timer_seq = itertools.count()
+        self.keep_running = True
+
+    def register(self, sock, events, callback):
+        self.selector.register(sock, events, callback)
+
+    def modify(self, sock, events, callback):
+        self.selector.modify(sock, events, callback)
+
+    def update(self, sock, events, callback):
+        """
+        Registers, modifies or unregisters sock so that it is waiting on
+        exactly `events`.  An events value of 0 unregisters the socket.
+        """
+        key = self.selector.get_map().get(sock.fileno())
+        if not events:
+            if key is not None:
+                self.selector.unregister(sock)
+        elif key is None:
+            self.selector.register(sock, events, callback)
+        elif key.events != events:
+            self.selector.modify(sock, events, callback)
+
+    def unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            # Not registered, or already closed
+            pass
+
+    def call_later(self, delay, callback):
+        timer = Timer(callback)
+        self._schedule(timer, time.monotonic() + delay)
+        return timer
+
+    def call_every(self, interval, callback):
+        timer = Timer(callback, interval)
+        self._schedule(timer, time.monotonic() + interval)
+        return timer
+
+    def _schedule(self, timer, deadline):
+        heapq.heappush(self.timers, (deadline, next(self.timer_seq), timer))
+
+    def run_once(self):
+        timeout = None
+        if self.timers:
+            timeout = max(0, self.timers[0][0] - time.monotonic())
+
+        if self.selector.get_map():
+            ready = self.selector.select(timeout)
+        else:
+            # Nothing registered (e.g. all remotes are between reconnect
+            # attempts).  select() on an empty set is an error on Windows.
+            time.sleep(RECONNECT_DELAY_MAX if timeout is None else timeout)
+            ready = []
+
+        if self.busy_times is not None:
+            start = time.monotonic_ns()
+        fd_map = self.selector.get_map()
+        for key, mask in ready:
+            # An earlier callback in this batch may have closed this socket
+            # (and its fd may even have been reused), so skip stale keys.
+            if fd_map.get(key.fd) is key:
+                key.data(key.fileobj, mask)
+
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _deadline, _seq, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                self._schedule(timer, now + timer.interval)
+            timer.callback()
+
+        if self.busy_times is not None:
+            self.busy_times.record(time.monotonic_ns() - start)
+
+    def run(self):
+        while self.keep_running:
+            self.run_once()
+
+    def close(self):
+        self.selector.close()
+
+ConnectionOptions = collections.namedtuple(
+    'ConnectionOptions',
+    ['high_water_mark', 'slow_policy', 'recv_size', 'recv_adaptive', 'read_budget',
+     'framing'],
+    defaults=[SEND_HWM_DEFAULT, SLOW_POLICY_DEFAULT, RECV_SIZE_DEFAULT, True,
+              READ_BUDGET_DEFAULT, None])
+
+class SocketRegistry:
+    """
+    Central table mapping each connected/listening socket's fd to the
+    SocketServer or SocketClient that owns it.
+
+    Owners add their sockets on listen/accept/connect and remove them on
+    close, so the event callback can find the owner of a socket with a
+    single dict lookup instead of asking every server and client in turn.
+
+    The registry also decides which events each socket waits on: read
+    interest for every socket (unless reads are paused for backpressure, or
+    the socket was added with readable=False, for send-only connections),
+    plus write interest while the socket has queued outbound data.
+
+    Links to other --workers processes (added with link=True) get their
+    own flow control.  A congested link only pauses reads from local
+    connections, never from other links: if two workers congested toward
+    each other each stopped reading the other's link, neither link would
+    ever drain.  Link reads are still paused while a local connection's
+    queue is congested, as that queue drains whether or not anything is
+    read.
+    """
+    def __init__(self, reactor, on_readable):
+        self.reactor = reactor
+        self.on_readable = on_readable
+        self.owners = {}  # fd -> SocketServer/SocketClient
+        self.sockets = {}  # fd -> socket
+        self.listen_fds = set()
+        self.send_only_fds = set()  # fds never read from
+        self.writable_fds = set()  # fds with queued outbound data
+        self.link_fds = set()  # fds of links to other workers
+        self.congested_fds = set()  # fds over their high-water mark (backpressure policy)
+        self.congested_links = set()  # link fds over their high-water mark
+
+    def __len__(self):
+        return len(self.owners)
+
+    def add(self, sock, owner, listener=False, readable=True, link=False):
+        fd = sock.fileno()
+        self.owners[fd] = owner
+        self.sockets[fd] = sock
+        if listener:
+            self.listen_fds.add(fd)
+        if link:
+            self.link_fds.add(fd)
+        if not readable:
+            self.send_only_fds.add(fd)
+        self._update(fd)
+
+    def remove(self, sock):
+        """
+        Must be called before sock is closed; a closed socket no longer has
+        an fd to look up.
+        """
+        fd = sock.fileno()
+        self.owners.pop(fd, None)
+        self.sockets.pop(fd, None)
+        self.listen_fds.discard(fd)
+        self.send_only_fds.discard(fd)
+        self.writable_fds.discard(fd)
+        self.reactor.unregister(sock)
+        self.set_congested(sock, False, fd)
+        self.link_fds.discard(fd)
+
+    def owner(self, sock):
+        return self.owners.get(sock.fileno())
+
+    def want_write(self, sock, flag):
+        fd = sock.fileno()
+        if flag == (fd in self.writable_fds):
+            return
+        if flag:
+            self.writable_fds.add(fd)
+        else:
+            self.writable_fds.discard(fd)
+        self._update(fd)
+
+    def set_congested(self, sock, flag, fd=None):
+        """
+        Marks sock's send queue as over (or back under) its high-water mark.
+        While any queue is congested, reads are paused on all connections so
+        that sources are held back until the slowest consumer catches up
+        (see the class docstring for links).
+        """
+        if fd is None:
+            fd = sock.fileno()
+        congested = self.congested_links if fd in self.link_fds else self.congested_fds
+        was_paused = self._paused()
+        if flag:
+            congested.add(fd)
+        else:
+            congested.discard(fd)
+
+        if was_paused != self._paused():
+            if not self._paused():
+                log.info("Send queues drained; resuming reads")
+            elif not any(was_paused):
+                log.info("Send queue full; pausing reads (backpressure)")
+            for other_fd in self.sockets:
+                self._update(other_fd)
+
+    def _paused(self):
+        return bool(self.congested_fds), bool(self.congested_links)
+
+    def _update(self, fd):
+        events = 0
+        if fd in self.listen_fds:
+            events |= selectors.EVENT_READ
+        elif fd in self.link_fds:
+            if not self.congested_fds:
+                events |= selectors.EVENT_READ
+        elif not (self.congested_fds or self.congested_links or fd in self.send_only_fds):
+            events |= selectors.EVENT_READ
+        if fd in self.writable_fds:
+            events |= selectors.EVENT_WRITE
+        self.reactor.update(self.sockets[fd], events, self.dispatch)
+
+    def dispatch(self, sock, mask):
+        owner = self.owner(sock)
+        if owner is None:
+            return
+        if mask & selectors.EVENT_WRITE:
+            owner.service_writable(sock)
+            if self.owner(sock) is not owner:
+                # Connection was dropped while flushing
+                return
+        if mask & selectors.EVENT_READ:
+            self.on_readable(sock, mask)
+
+class BufferPool:
+    """
+    Free lists of preallocated recv buffers, one list per buffer size.
+    Buffers are handed out wrapped in Chunks and come back here when the
+    last reference to the Chunk is released.  At most max_bytes of idle
+    buffers are kept.
+    """
+    def __init__(self, max_bytes=BUFFER_POOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.free_bytes = 0
+        self.free = collections.defaultdict(list)  # size -> [bytearray, ...]
+
+    def get(self, size):
+        free = self.free[size]
+        if free:
+            self.free_bytes -= size
+            return free.pop()
+        return bytearray(size)
+
+    def put(self, buffer):
+        size = len(buffer)
+        if self.free_bytes + size <= self.max_bytes:
+            self.free[size].append(buffer)
+            self.free_bytes += size
+
+    def recv(self, sock, size):
+        """
+        recv()s up to size bytes into a pooled buffer.  Returns a Chunk, or
+        None if the peer closed the connection.  Raises the same exceptions
+        as recv_into().  A short read is copied out, so that the buffer goes
+        straight back to the pool instead of being held by send queues.
+        """
+        buffer = self.get(size)
+        try:
+            length = sock.recv_into(buffer)
+        except OSError:
+            self.put(buffer)
+            raise
+        if not length:
+            self.put(buffer)
+            return None
+        if length * COPY_FRACTION < size:
+            data = bytes(memoryview(buffer)[:length])
+            self.put(buffer)
+            return Chunk(None, data, length)
+        return Chunk(self, buffer, length)
+
+class Receiver:
+    """
+    Reads from one connection.
+
+    Each readable event drains the socket until it would block or
+    options.read_budget bytes have been read, so a busy socket gets fewer
+    wakeups but can't starve the others; anything left over is picked up on
+    the next loop iteration.
+
+    With options.recv_adaptive, the recv() size starts at options.recv_size
+    and doubles (up to RECV_SIZE_MAX) whenever reads keep filling the
+    buffer, then shrinks back once reads stay small.
+
+    With options.framing (a decoder factory from framing.decoder_factory()),
+    the received bytes are run through a decoder and only complete frames
+    are returned.
+    """
+    GROW_AFTER = 2  # Consecutive full reads before doubling
+    SHRINK_AFTER = 16  # Consecutive reads under 1/4 full before halving
+
+    def __init__(self, buffer_pool, options):
+        self.pool = buffer_pool
+        self.min_size = options.recv_size
+        self.max_size = max(options.recv_size, RECV_SIZE_MAX)
+        self.size = options.recv_size
+        self.adaptive = options.recv_adaptive
+        self.budget = options.read_budget
+        self.full_reads = 0
+        self.small_reads = 0
+        self.decoder = options.framing() if options.framing else None
+        self.received = 0  # Bytes read by the last call to recv()
+
+    def recv(self, sock):
+        """
+        Returns a list of Chunks, which may be empty if only part of a frame
+        was received.  If the connection closes or fails after some data has
+        been read, the data is returned and the close is seen on the next
+        call.  Raises BlockingIOError if there was nothing to read, EOFError
+        if the peer closed the connection, OSError if the connection failed
+        and framing.FrameError if the data can't be framed.
+        """
+        chunks = []
+        total = 0
+        self.received = 0
+        recv_ns = time.monotonic_ns()
+        while total < self.budget:
+            try:
+                chunk = self.pool.recv(sock, self.size)
+            except BlockingIOError:
+                if chunks:
+                    break
+                raise
+            except OSError:
+                if chunks:
+                    break
+                raise
+
+            if chunk is None:
+                if chunks:
+                    break
+                raise EOFError('Connection closed by peer')
+
+            chunk.recv_ns = recv_ns
+            chunks.append(chunk)
+            total += len(chunk)
+            full = len(chunk) == self.size
+            if self.adaptive:
+                self._adapt(len(chunk))
+            if not full:
+                # Socket is drained; don't spend a recv() just to get EAGAIN.
+                break
+
+        self.received = total
+        if self.decoder is not None:
+            return self._decode(chunks)
+        return chunks
+
+    def _decode(self, chunks):
+        """
+        Runs chunks through the decoder.  Frames that lie within a single
+        chunk share its buffer, unless they are under 1/COPY_FRACTION of
+        it; other frames are copied.
+        """
+        frames = []
+        try:
+            for chunk in chunks:
+                for frame in self.decoder.feed(chunk.buffer, len(chunk)):
+                    if isinstance(frame, memoryview):
+                        if len(frame) * COPY_FRACTION < chunk.footprint:
+                            frame = Chunk(None, bytes(frame), len(frame))
+                        else:
+                            frame = Chunk(None, frame, len(frame), parent=chunk)
+                    else:
+                        frame = Chunk(None, frame, len(frame))
+                    frame.recv_ns = chunk.recv_ns
+                    frames.append(frame)
+        except framing.FrameError:
+            for frame in frames:
+                frame.release()
+            raise
+        finally:
+            for chunk in chunks:
+                chunk.release()
+        return frames
+
+    def _adapt(self, length):
+        if length == self.size:
+            self.small_reads = 0
+            self.full_reads += 1
+            if self.full_reads >= self.GROW_AFTER and self.size < self.max_size:
+                self.size = min(self.size * 2, self.max_size)
+                self.full_reads = 0
+        elif length < self.size // 4:
+            self.full_reads = 0
+            self.small_reads += 1
+            if self.small_reads >= self.SHRINK_AFTER and self.size > self.min_size:
+                self.size = max(self.size // 2, self.min_size)
+                self.small_reads = 0
+        else:
+            self.full_reads = 0
+            self.small_reads = 0
+
+class Chunk:
+    """
+    A block of received data, shared by reference between every SendQueue
+    it is pushed to instead of being copied per peer.
+
+    The receiver holds the first reference; each SendQueue takes another
+    with incref() and drops it with release() once the data has been sent
+    (or dropped).  When the count reaches zero the buffer goes back to its
+    pool (if it came from one) and view must no longer be used.
+
+    A Chunk can also be a slice of a parent Chunk (e.g. one frame out of
+    a recv buffer), in which case it holds a reference to the parent until
+    it is released itself.  footprint is the size of the buffer it keeps
+    alive (its own or its parent's), which can be more than its length.
+
+    recv_ns is the time.monotonic_ns() when it was received (0 if it
+    wasn't), for the latency histograms.
+    """
+    __slots__ = ['pool', 'buffer', 'view', 'refs', 'parent', 'recv_ns', 'footprint']
+
+    def __init__(self, pool, buffer, length, parent=None):
+        self.pool = pool
+        self.buffer = buffer
+        self.view = memoryview(buffer)[:length]
+        self.refs = 1
+        self.parent = parent
+        self.recv_ns = 0
+        if parent is not None:
+            parent.incref()
+            self.footprint = parent.footprint
+        else:
+            self.footprint = len(buffer)
+
+    def __len__(self):
+        return len(self.view)
+
+    def incref(self):
+        self.refs += 1
+
+    def release(self):
+        """Drops a reference.  Returns True if it was the last one."""
+        self.refs -= 1
+        if self.refs == 0:
+            self.view = None
+            if self.pool is not None:
+                self.pool.put(self.buffer)
+            if self.parent is not None:
+                self.parent.release()
+                self.parent = None
+            return True
+        return False
+
+class Connection:
+    """
+    What the hub knows about one connection: its socket, the peer's address
+    and port, a name and color to show it with, and its stats counters.
+
+    A Connection is created when the connection is accepted or made (see
+    SocketStatsTable.add()), so the peer address is looked up once rather
+    than with getpeername() on every block of data, and it stays valid
+    after the socket is closed.  Loggers and plugins are given the
+    Connection in place of the socket; getpeername() is provided for them.
+
+    Times are time.monotonic_ns() values.  When the connection closes,
+    retire() drops the socket and records the time, and the stats table
+    keeps the Connection in a bounded history of closed connections.
+    endpoint is the Endpoint the connection was made through, if any.
+
+    rx_bps/tx_bps and rx_cps/tx_cps are bytes and chunks per second,
+    averaged over about RATE_TIME_CONSTANT seconds by update_rates().
+    send_wait is a Histogram of the nanoseconds from receiving each chunk
+    to sending the whole of it to this connection (its percentiles are
+    within 1/8 of the true value).  hexdump_chunks counts the chunks
+    HexdumpPrinter has seen from it, for --hex-sample.
+    """
+    __slots__ = ['sock', 'addr', 'port', 'name', 'color', 'endpoint',
+                 'rx_bytes', 'rx_chunks', 'tx_bytes', 'tx_chunks', 'tx_queued', 'tx_dropped',
+                 'log_dropped', 'connect_ns', 'last_rx_ns', 'last_tx_ns', 'disconnect_ns',
+                 'rx_bps', 'tx_bps', 'rx_cps', 'tx_cps', 'rate_counts', 'send_wait',
+                 'hexdump_chunks']
+    COUNTERS = ['rx_bytes', 'rx_chunks', 'tx_bytes', 'tx_chunks', 'tx_dropped', 'log_dropped']
+
+    def __init__(self, sock, addr, port, name=None, color=PALETTE[0], endpoint=None):
+        self.sock = sock
+        self.addr = addr
+        self.port = port
+        self.name = name if name is not None else f'{addr}:{port}'
+        self.color = color
+        self.endpoint = endpoint
+        self.rx_bytes = 0
+        self.rx_chunks = 0
+        self.tx_bytes = 0
+        self.tx_chunks = 0
+        self.tx_queued = 0
+        self.tx_dropped = 0
+        self.log_dropped = 0
+        self.connect_ns = self.last_rx_ns = self.last_tx_ns = time.monotonic_ns()
+        self.disconnect_ns = None
+        self.rx_bps = self.tx_bps = self.rx_cps = self.tx_cps = 0.0
+        self.rate_counts = (0, 0, 0, 0)  # Counters at the last update_rates()
+        self.send_wait = Histogram()
+        self.hexdump_chunks = 0
+
+    def getpeername(self):
+        return self.addr, self.port
+
+    def received(self, nbytes, nchunks):
+        self.rx_bytes += nbytes
+        self.rx_chunks += nchunks
+        self.last_rx_ns = time.monotonic_ns()
+
+    def sent(self, nbytes, nchunks):
+        self.tx_bytes += nbytes
+        self.tx_chunks += nchunks
+        self.last_tx_ns = time.monotonic_ns()
+
+    def update_rates(self, elapsed, alpha):
+        """
+        Folds the counts since the last call, elapsed seconds ago, into the
+        rates with smoothing factor alpha.
+        """
+        rx_bytes, tx_bytes, rx_chunks, tx_chunks = self.rate_counts
+        self.rx_bps += alpha * ((self.rx_bytes - rx_bytes) / elapsed - self.rx_bps)
+        self.tx_bps += alpha * ((self.tx_bytes - tx_bytes) / elapsed - self.tx_bps)
+        self.rx_cps += alpha * ((self.rx_chunks - rx_chunks) / elapsed - self.rx_cps)
+        self.tx_cps += alpha * ((self.tx_chunks - tx_chunks) / elapsed - self.tx_cps)
+        self.rate_counts = (self.rx_bytes, self.tx_bytes, self.rx_chunks, self.tx_chunks)
+
+    def retire(self):
+        """Called when the connection has closed."""
+        self.sock = None
+        self.tx_queued = 0
+        self.rx_bps = self.tx_bps = self.rx_cps = self.tx_cps = 0.0
+        self.disconnect_ns = time.monotonic_ns()
+
+class Endpoint:
+    """
+    Counters for one -l or -r argument (kind 'listen' or 'remote') that
+    outlive its connections: connections currently open, connections made
+    in total, reconnects, rejected connections, and the COUNTERS of its
+    closed connections, summed (closed).
+    """
+    __slots__ = ['kind', 'name', 'connections', 'connects', 'reconnects', 'rejected', 'closed']
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.connections = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.rejected = 0
+        self.closed = dict.fromkeys(Connection.COUNTERS, 0)
+
+    def connected(self):
+        if self.kind == 'remote' and self.connects:
+            self.reconnects += 1
+        self.connects += 1
+        self.connections += 1
+
+    def disconnected(self, conn):
+        self.connections -= 1
+        closed = self.closed
+        for name in Connection.COUNTERS:
+            closed[name] += getattr(conn, name)
+
+class SendQueue:
+    """
+    Outbound data for one connection, described by conn (a Connection).
+    Once a chunk has been sent, its time since being received is recorded
+    in conn.send_wait, and, if no other queue still holds it, in the
+    residency Histogram.
+
+    distribute() pushes Chunks here instead of calling a blocking send().
+    Queued data is written with non-blocking sends, immediately when
+    possible and otherwise when the reactor reports the socket writable, so
+    a slow consumer only delays itself.  Where available, up to
+    SENDMSG_MAX_CHUNKS queued chunks go out in a single sendmsg() call.
+
+    Once the queued chunks hold more than options.high_water_mark bytes of
+    buffers (their footprints, so that small chunks pinning large recv
+    buffers are counted as the memory they keep alive),
+    options.slow_policy decides what happens:
+        drop-oldest: discard the oldest queued chunks to make room
+        drop-newest: discard the data being pushed
+        disconnect: drop the connection
+        backpressure: queue it anyway and pause reads on all connections
+            until the queue drains to half the high-water mark
+    """
+    def __init__(self, sock, registry, conn, options, residency=None):
+        self.sock = sock
+        self.registry = registry
+        self.conn = conn
+        self.residency = residency
+        self.high_water_mark = options.high_water_mark
+        self.policy = options.slow_policy
+        self.chunks = collections.deque()
+        self.offset = 0  # Bytes of chunks[0] already sent
+        self.nbytes = 0  # Bytes queued, not counting those already sent
+        self.footprint = 0  # Bytes of buffers held by the queued chunks
+        self.dropping = False
+        self.congested = False
+
+    def __len__(self):
+        return self.nbytes
+
+    def push(self, chunks):
+        """
+        Queues a list of chunks and tries to send them.  Returns False if
+        the connection should be dropped.
+        """
+        was_empty = not self.chunks
+        for chunk in chunks:
+            length = len(chunk)
+            footprint = chunk.footprint
+            if self.footprint + footprint > self.high_water_mark:
+                if self.policy == 'disconnect':
+                    log.warning("Send queue to %s exceeded %d bytes; disconnecting",
+                                self.conn.name, self.high_water_mark)
+                    return False
+
+                if self.policy == 'drop-newest':
+                    self._dropped(length)
+                    continue
+
+                if self.policy == 'drop-oldest':
+                    self._drop_oldest(footprint)
+
+                elif not self.congested:
+                    # backpressure
+                    self.congested = True
+                    self.registry.set_congested(self.sock, True)
+
+            chunk.incref()
+            self.chunks.append(chunk)
+            self.nbytes += length
+            self.footprint += footprint
+
+        self.conn.tx_queued = self.nbytes
+        if was_empty and self.chunks:
+            # Otherwise we're already waiting for the socket to be writable
+            return self.flush()
+        return True
+
+    def _drop_oldest(self, footprint):
+        # A partially sent chunk can't be dropped without corrupting the
+        # stream, so set it aside while dropping.
+        head = None
+        if self.offset:
+            head = self.chunks.popleft()
+        while self.chunks and self.footprint + footprint > self.high_water_mark:
+            chunk = self.chunks.popleft()
+            self.nbytes -= len(chunk)
+            self.footprint -= chunk.footprint
+            self._dropped(len(chunk))
+            chunk.release()
+        if head is not None:
+            self.chunks.appendleft(head)
+
+    def clear(self):
+        """Releases all queued chunks.  Called when the connection closes."""
+        while self.chunks:
+            self.chunks.popleft().release()
+        self.nbytes = 0
+        self.footprint = 0
+        self.offset = 0
+
+    def _dropped(self, length):
+        if not self.dropping:
+            log.warning("Send queue to %s exceeded %d bytes; dropping data (%s)",
+                        self.conn.name, self.high_water_mark, self.policy)
+            self.dropping = True
+        self.conn.tx_dropped += length
+
+    def flush(self):
+        """
+        Sends as much queued data as the socket will take without blocking.
+        Returns False if the connection failed.
+        """
+        chunks = self.chunks
+        while chunks:
+            if HAVE_SENDMSG:
+                views = [chunk.view for chunk in itertools.islice(chunks, SENDMSG_MAX_CHUNKS)]
+            else:
+                views = [chunks[0].view]
+            if self.offset:
+                views[0] = views[0][self.offset:]
+            wanted = sum(len(view) for view in views)
+
+            try:
+                if HAVE_SENDMSG:
+                    sent = self.sock.sendmsg(views)
+                else:
+                    sent = self.sock.send(views[0])
+            except BlockingIOError:
+                break
+            except OSError as exc:
+                log.info("Send to %s failed (%s)", self.conn.name, str(exc))
+                return False
+
+            self.nbytes -= sent
+            short = sent < wanted
+            nbytes = sent
+
+            # Release the chunks that went out completely
+            nchunks = 0
+            sent += self.offset
+            if sent >= len(chunks[0]):
+                now = time.monotonic_ns()
+            while chunks and sent >= len(chunks[0]):
+                chunk = chunks.popleft()
+                sent -= len(chunk)
+                self.footprint -= chunk.footprint
+                nchunks += 1
+                if not chunk.recv_ns:
+                    chunk.release()
+                    continue
+                wait = now - chunk.recv_ns
+                self.conn.send_wait.record(wait)
+                if chunk.release() and self.residency is not None:
+                    self.residency.record(wait)
+            self.offset = sent
+            self.conn.sent(nbytes, nchunks)
+
+            if short:
+                # Socket buffer is full
+                break
+
+        self.conn.tx_queued = self.nbytes
+        self.registry.want_write(self.sock, bool(chunks))
+        if not chunks:
+            self.dropping = False
+        if self.congested and self.footprint <= self.high_water_mark // 2:
+            self.congested = False
+            self.registry.set_congested(self.sock, False)
+        return True
+
+def peer_closed(sock):
+    """
+    For connections that are never polled for reading (send-only): reads
+    and discards up to SEND_ONLY_DISCARD bytes that the peer sent, and
+    returns True if the peer has closed the connection or it has failed.
+    """
+    try:
+        return not sock.recv(SEND_ONLY_DISCARD)
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
 
 class SocketServer:
-    def __init__(self, host, port, max_connections, stats_table):
+    def __init__(self, host, port, max_connections, stats_table, registry, options, buffer_pool,
+                 reuse_port=False, direction=DIRECTION_DEFAULT, ip_filter=None):
         self.host = host
         self.port = port
         self.max_connections = max_connections
+        self.direction = direction
+        self.ip_filter = ip_filter  # Decides which peer addresses may connect
         self.stats_table = stats_table
-        self.connected_sockets = []
-        self.last_readable = None
+        self.registry = registry
+        self.options = options
+        self.buffer_pool = buffer_pool
+        self.reuse_port = reuse_port
+        self.endpoint = stats_table.endpoint('listen', f'{host}:{port}')
+        self.connected_sockets = {}  # socket -> SendQueue
+        self.receivers = {}  # socket -> Receiver
         self.listen_socket = None
         self._create_listen_socket()
 
     def shutdown(self):
         for sock in self.sockets():
+            self.registry.remove(sock)
             sock.close()
 
     def _create_listen_socket(self):
@@ -176,6 +1242,15 @@ class SocketServer:
         # Create a listen socket and remember the maximum number connections
         # it supports.
         self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if os.name != 'nt':
+            # Allows the listen socket to be re-created while connections
+            # accepted on this port are still open.  (On Windows,
+            # SO_REUSEADDR would allow other processes to steal the port.)
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Lets each --workers process bind its own listen socket to the
+            # same port; the kernel spreads incoming connections across them.
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             self.listen_socket.bind((self.host, self.port))
         except OSError as exc:
@@ -185,12 +1260,7 @@ class SocketServer:
 
         self.listen_socket.listen()
         self.listen_socket.setblocking(False)
-
-    def __contains__(self, item):
-        # if item in [self.listen_socket] + self.connected_sockets:
-        if item in self.sockets():
-            return True
-        return False
+        self.registry.add(self.listen_socket, self)
 
     def sockets(self):
         """
@@ -198,19 +1268,32 @@ class SocketServer:
         including both the listen socket and any connected client sockets.
         """
         if self.listen_socket:
-            return [self.listen_socket] + self.connected_sockets
-        return self.connected_sockets
+            return [self.listen_socket] + list(self.connected_sockets)
+        return list(self.connected_sockets)
 
     def service_readable(self, sock):
-        data = None
-
-        if not sock in self:
-            return None
-
+        """
+        Accepts a connection if sock is the listen socket, otherwise reads
+        from sock.  Returns a (possibly empty) list of received Chunks.
+        """
         if sock is self.listen_socket:
             # Accept incoming connection
-            connected_socket, addr = sock.accept()
-            self.connected_sockets.append(connected_socket)
+            try:
+                connected_socket, addr = sock.accept()
+            except BlockingIOError:
+                # Peer went away between readiness and accept()
+                return []
+            if self.ip_filter is not None and not self.ip_filter.allowed(addr[0]):
+                # Not allowed by --ip-allow/--ip-deny
+                self.endpoint.rejected += 1
+                connected_socket.close()
+                return []
+            connected_socket.setblocking(False)
+            conn = self.stats_table.add(connected_socket, addr, endpoint=self.endpoint)
+            self.connected_sockets[connected_socket] = SendQueue(
+                connected_socket, self.registry, conn, self.options, self.stats_table.residency)
+            self.receivers[connected_socket] = Receiver(self.buffer_pool, self.options)
+            self.registry.add(connected_socket, self, readable=self.direction != 'send')
             log.info('Accepted connection from: %s', addr)
             # listen_sockets_connections[sock].append(connected_socket)
 
@@ -225,46 +1308,72 @@ class SocketServer:
                 # opens up.
                 msg = "Maximum connections (%d) reached on port %d"
                 log.info(msg, self.max_connections, self.port)
+                self.registry.remove(sock)
                 sock.close()
                 self.listen_socket = None
 
-        else:
-            # Recv data
-            # A connected socket is readable.  recv the data.
-
-            self.last_readable = sock
+            return []
 
-            try:
-                data = sock.recv(4096)
-            except ConnectionResetError:
-                self._remove_connected_socket(sock)
+        # Recv data
+        # A connected socket is readable.  recv the data.
 
-            if not data:
-                # When recv() returns None or b'', that means the connection
-                # is closed.  Mark this socket for removal from the sockets
-                # list.
-                addr, port = sock.getpeername()
-                log.info("Client disconnected (%s:%d)", addr, port)
-                self._remove_connected_socket(sock)
+        receiver = self.receivers[sock]
+        conn = self.connected_sockets[sock].conn
+        try:
+            chunks = receiver.recv(sock)
+        except BlockingIOError:
+            return []
+        except EOFError:
+            # When recv() returns nothing, that means the connection is
+            # closed.  Mark this socket for removal from the sockets list.
+            log.info("Client disconnected (%s)", conn.name)
+            self._remove_connected_socket(sock)
+            return []
+        except framing.FrameError as exc:
+            log.warning("Framing error, disconnecting (%s) (%s)", conn.name, str(exc))
+            self._remove_connected_socket(sock)
+            return []
+        except OSError as exc:
+            log.info("Client disconnected (%s)", str(exc))
+            self._remove_connected_socket(sock)
+            return []
 
-            self.stats_table.update_rx(sock, len(data))
+        conn.received(receiver.received, len(chunks))
 
-        return data
+        return chunks
 
     def _remove_connected_socket(self, sock):
-        self.connected_sockets.remove(sock)
+        self.connected_sockets.pop(sock).clear()
+        del self.receivers[sock]
+        self.stats_table.remove(sock)
+        self.registry.remove(sock)
+        sock.close()
         # Re-open the listen socket if it had previously been closed due to
         # max connections.
         if self.listen_socket is None:
         # if len(self.connected_sockets) < self.max_connections:
             self._create_listen_socket()
 
-    def distribute(self, data):
-        for sock in self.connected_sockets:
-            if sock is not self.last_readable:
-                sock.send(data)
-                self.stats_table.update_tx(sock, len(data))
-        self.last_readable = None
+    def service_writable(self, sock):
+        if not self.connected_sockets[sock].flush():
+            self._remove_connected_socket(sock)
+
+    def check_send_only(self):
+        """
+        Closes send-only connections whose peer has gone away.  Called
+        every SEND_ONLY_CHECK_INTERVAL seconds, since they are never polled
+        for reading.
+        """
+        for sock, queue in list(self.connected_sockets.items()):
+            if peer_closed(sock):
+                log.info("Client disconnected (%s)", queue.conn.name)
+                self._remove_connected_socket(sock)
+
+    def distribute(self, chunks, source):
+        for sock, queue in list(self.connected_sockets.items()):
+            if sock is not source:
+                if not queue.push(chunks):
+                    self._remove_connected_socket(sock)
 
 
 def flatten(lst):
@@ -282,69 +1391,145 @@ def flatten(lst):
     return [item for sublist in lst for item in sublist]
 
 class SocketClient:
-    def __init__(self, host, port, stats_table, auto_reconnect=True):
+    def __init__(self, host, port, stats_table, registry, options, buffer_pool,
+                 auto_reconnect=True, direction=DIRECTION_DEFAULT):
         self.host = host
         self.port = port
+        self.direction = direction
         self.stats_table = stats_table
+        self.registry = registry
+        self.reactor = registry.reactor
+        self.options = options
+        self.buffer_pool = buffer_pool
         self.auto_reconnect = auto_reconnect
+        self.endpoint = stats_table.endpoint('remote', f'{host}:{port}')
         self.sockets = []  # Holds one socket when connected; otherwise empty.
-        self.last_readable = None
-        self.thread = None
+        self.send_queue = None
+        self.receiver = None
+        self.pending_socket = None  # Socket with a connect() in progress
+        self.timer = None  # Pending reconnect or connect-timeout timer
+        self.connect_attempts = 0
         self.keep_running = True
         self._connect()
 
-    def _do_connect(self):
-        # Create the socket and try to connect
+    def _connect(self):
+        """
+        Starts a non-blocking connect().  The reactor tells us when the
+        socket becomes writable, at which point the connection has either
+        completed or failed.
+        """
+        self.timer = None
+        if not self.keep_running:
+            return
 
-        connect_attempts = 1
-        while self.keep_running:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            # Initially retry quickly (10Hz), then back off (1/10Hz).  Note
-            # that connect() may timeout sooner than the specified timeout
-            # (e.g. after 2 seconds, despite the timeout being set to 10
-            # seconds).  An additional delay could be added to strictly limit
-            # the rate of connect() attempts.
-            timeout = min(10, (.1 * connect_attempts))
-            sock.settimeout(timeout)
-            connect_attempts += 1
+        # Initially retry quickly (10Hz), then back off (1/10Hz).
+        self.connect_attempts += 1
+        timeout = min(RECONNECT_DELAY_MAX, (.1 * self.connect_attempts))
 
-            try:
-                sock.connect((self.host, self.port))
-            except socket.timeout:
-                sock.close()
-                del sock
-                continue
-            except OSError:
-                sock.close()
-                del sock
-                continue
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            err = sock.connect_ex((self.host, self.port))
+        except OSError:
+            # e.g. name resolution failure
+            sock.close()
+            self._schedule_reconnect(timeout)
+            return
 
-            self.sockets.append(sock)
-            log.info("Connected to %s:%d", self.host, self.port)
-            break
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            sock.close()
+            self._schedule_reconnect(timeout)
+            return
 
-    def _connect(self):
-        # daemon=True allows ^C to shut down the application during connect
-        # (), but may leave a stale connection hanging around.
-        self.thread = threading.Thread(target=self._do_connect, daemon=True)
-        # self.thread = threading.Thread(target=self._do_connect)
-        self.thread.start()
+        self.pending_socket = sock
+        self.reactor.register(sock, selectors.EVENT_WRITE, self._on_connect)
+        self.timer = self.reactor.call_later(timeout, self._on_connect_timeout)
+
+    def _schedule_reconnect(self, delay):
+        if self.keep_running:
+            self.timer = self.reactor.call_later(delay, self._connect)
+
+    def _abort_pending(self):
+        sock = self.pending_socket
+        self.pending_socket = None
+        self.reactor.unregister(sock)
+        sock.close()
+
+    def _on_connect_timeout(self):
+        self.timer = None
+        if self.pending_socket is not None:
+            self._abort_pending()
+            self._connect()
+
+    def _on_connect(self, sock, mask):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if not err:
+            try:
+                peername = sock.getpeername()
+            except OSError as exc:
+                # Already reset by the peer
+                err = exc.errno
+        if err:
+            self._abort_pending()
+            timeout = min(RECONNECT_DELAY_MAX, (.1 * self.connect_attempts))
+            self._schedule_reconnect(timeout)
+            return
+
+        self.pending_socket = None
+        self.connect_attempts = 0
+        self.sockets.append(sock)
+        conn = self.stats_table.add(sock, peername, f'{self.host}:{self.port}', self.endpoint)
+        self.send_queue = SendQueue(sock, self.registry, conn, self.options,
+                                    self.stats_table.residency)
+        self.receiver = Receiver(self.buffer_pool, self.options)
+        self.reactor.unregister(sock)
+        self.registry.add(sock, self, readable=self.direction != 'send')
+        log.info("Connected to %s:%d", self.host, self.port)
+
+    def _disconnect(self, sock):
+        self.registry.remove(sock)
+        self.stats_table.remove(sock)
+        sock.close()
+        self.sockets.remove(sock)
+        self.send_queue.clear()
+        self.send_queue = None
+        self.receiver = None
+        if self.auto_reconnect:
+            self._connect()
 
     def shutdown(self):
         self.keep_running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending_socket is not None:
+            self._abort_pending()
         if self.sockets:
+            self.registry.remove(self.sockets[0])
             self.sockets[0].close()
 
     def service_readable(self, sock):
-        if not sock in self.sockets:
-            return None
-
-        self.last_readable = sock
-        data = None
-
+        """
+        Returns a (possibly empty) list of received Chunks.
+        """
         try:
-            data = sock.recv(4096)
+            chunks = self.receiver.recv(sock)
+        except BlockingIOError:
+            return []
+        except EOFError:
+            # When recv() returns nothing, that means the connection is
+            # closed.  Mark this socket for removal from the sockets list.
+            log.info("Client disconnected (%s:%d)", self.host, self.port)
+            self._disconnect(sock)
+            return []
+        except framing.FrameError as exc:
+            log.warning("Framing error, disconnecting (%s:%d) (%s)", self.host, self.port, str(exc))
+            self._disconnect(sock)
+            return []
         except (OSError, ConnectionResetError) as exc:
             # OSError means socket operation timed out while recv'ing.  And,
             # on Windows, it can also mean that the remote end closed the
@@ -352,208 +1537,1196 @@ class SocketClient:
             # disconnect.
             # if platform.system() == 'Windows':
             #     if exc.winerror is not None:
-            addr, port = sock.getpeername()
-            log.info("Client disconnected (exc) (%s:%d) (%s)", addr, port, str(exc))
-            sock.close()
-            self.sockets.remove(sock)
+            log.info("Client disconnected (exc) (%s:%d) (%s)", self.host, self.port, str(exc))
+            self._disconnect(sock)
+            return []
 
-            # Launch a thread to reconnect
-            if self.auto_reconnect:
-                self._connect()
-
-            return None
+        self.send_queue.conn.received(self.receiver.received, len(chunks))
 
-        if not data:
-            # When recv() returns None or b'', that means the connection is
-            # closed.  Mark this socket for removal from the sockets list.
-            addr, port = sock.getpeername()
-            log.info("Client disconnected (%s:%d)", addr, port)
-            sock.close()
-            self.sockets.remove(sock)
-            if self.auto_reconnect:
-                self._connect()
-            return None
+        return chunks
 
-        self.stats_table.update_rx(sock, len(data))
+    def service_writable(self, sock):
+        if not self.send_queue.flush():
+            self._disconnect(sock)
 
-        return data
+    def check_send_only(self):
+        """As SocketServer.check_send_only()."""
+        if self.sockets and peer_closed(self.sockets[0]):
+            log.info("Client disconnected (%s:%d)", self.host, self.port)
+            self._disconnect(self.sockets[0])
 
-    def distribute(self, data):
+    def distribute(self, chunks, source):
         if self.sockets:
-            if self.sockets[0] is not self.last_readable:
-                self.sockets[0].send(data)
-                self.stats_table.update_tx(self.sockets[0], len(data))
-        self.last_readable = None
+            sock = self.sockets[0]
+            if sock is not source:
+                if not self.send_queue.push(chunks):
+                    self._disconnect(sock)
 
-class HexdumpPrinter:
-    def __init__(self):
-        self.sock_to_color_map = {}
-        self.args = args
+class WorkerLink:
+    """
+    Connection to one of the other worker processes in --workers mode.
+
+    Data received from local connections is forwarded to every other worker
+    as <length:4> <data:length> messages so that their connections see it
+    too.  Data arriving on a link is only distributed to local connections,
+    never forwarded again.
+    """
+    HEADER = struct.Struct('>I')
+
+    def __init__(self, sock, peer_index, registry, options, buffer_pool):
+        self.sock = sock
+        self.peer_index = peer_index
+        self.registry = registry
+        self.closed = False
+        sock.setblocking(False)
+        # Never drop data between workers; a slow worker holds this one's
+        # local connections back (see SocketRegistry).
+        # (Links aren't shown in the stats table, so the Connection isn't
+        # added to it.)
+        conn = Connection(sock, 'worker', peer_index, f'worker {peer_index}')
+        self.send_queue = SendQueue(sock, registry, conn,
+                                    options._replace(slow_policy='backpressure'))
+        self.receiver = Receiver(buffer_pool, options._replace(
+            framing=lambda: framing.LengthPrefixDecoder(self.HEADER.size, strip_header=True)))
+        registry.add(sock, self, link=True)
+
+    def close(self):
+        if not self.closed:
+            log.error("Lost link to worker %d", self.peer_index)
+            self.closed = True
+            self.registry.remove(self.sock)
+            self.send_queue.clear()
+            self.sock.close()
 
-    def show(self, sock, data):
+    def service_readable(self, sock):
+        """
+        Returns the complete messages received so far as a list of Chunks.
+        """
         try:
-            color = self.sock_to_color_map[sock]
-        except KeyError:
-            color = PALETTE[len(self.sock_to_color_map) % len(PALETTE)]
-            self.sock_to_color_map[sock] = color
+            return self.receiver.recv(sock)
+        except BlockingIOError:
+            return []
+        except (EOFError, OSError, framing.FrameError):
+            self.close()
+            return []
+
+    def service_writable(self, sock):
+        if not self.send_queue.flush():
+            self.close()
+
+    def distribute(self, chunks, source):
+        if self.closed:
+            return
+        messages = []
+        for chunk in chunks:
+            header = self.HEADER.pack(len(chunk))
+            messages.append(Chunk(None, header, len(header)))
+            messages.append(chunk)
+        if not self.send_queue.push(messages):
+            self.close()
+
+class Route:
+    """
+    One --route rule: dest (a -l or -r host:port) gets the data received
+    through any of sources (-l or -r host:port), from any of addrs (peer IP
+    addresses), that starts with any of prefixes (bytes).  None matches
+    anything.
+    """
+    __slots__ = ['dest', 'sources', 'addrs', 'prefixes']
 
-        hdump = hexdump.hexdump(data, result='return')
-        if self.args.color:
-            hdump = getattr(ansicolor.fore, color) + hdump + ansicolor.style.RESET
-        addr, port = sock.getpeername()
-        log.info("Received %d bytes from %s:%d:\n%s",
-                 len(data), addr, port, hdump)
+    def __init__(self, dest, sources=None, addrs=None, prefixes=None):
+        self.dest = dest
+        self.sources = sources
+        self.addrs = addrs
+        self.prefixes = prefixes
+
+    def matches_source(self, source, addr):
+        return ((self.sources is None or source in self.sources) and
+                (self.addrs is None or addr in self.addrs))
+
+class RoutingTable:
+    """
+    Decides which owners (SocketServers and SocketClients) each received
+    chunk is distributed to, from the --route rules.  Owners with no rules
+    get everything; an owner with rules gets the data matching any of them.
+
+    The rules are compiled once per source (the endpoint and peer address
+    data is received from) into the owners that get all of its data, plus
+    a table of {prefix: owners} for each prefix length.  Routing a chunk is
+    then a dict lookup per prefix length, instead of testing every rule
+    against every connection.  With --framing, prefixes are matched at the
+    start of each frame; otherwise at the start of each chunk as received.
+    """
+    def __init__(self, routes, owners):
+        # (Recv-only endpoints are never sent anything, with or without rules.)
+        self.owners = [owner for owner in owners if owner.direction != 'recv']
+        self.rules = {}  # owner -> [Route]
+        self.compiled = {}  # (source endpoint name, addr) -> (owners, [(length, {prefix: owners})])
+        names = {owner.endpoint.name: owner for owner in owners}
+        for route in routes:
+            for name in [route.dest] + sorted(route.sources or []):
+                if name not in names:
+                    log.error("--route endpoint %s is not a -l or -r argument", name)
+                    sys.exit(1)
+            self.rules.setdefault(names[route.dest], []).append(route)
+
+    def route(self, conn, chunks):
+        """
+        Returns [(owner, chunks for it), ...] for chunks received on conn.
+        """
+        key = (conn.endpoint.name, conn.addr)
+        compiled = self.compiled.get(key)
+        if compiled is None:
+            if len(self.compiled) >= ROUTE_CACHE_MAX:
+                self.compiled.clear()
+            compiled = self.compiled[key] = self._compile(*key)
+        everything, prefix_tables = compiled
+
+        routed = [(owner, chunks) for owner in everything]
+        if not prefix_tables:
+            return routed
+
+        selected = {}  # owner -> [chunk]
+        for chunk in chunks:
+            for length, table in prefix_tables:
+                for owner in table.get(bytes(chunk.view[:length]), ()):
+                    owner_chunks = selected.setdefault(owner, [])
+                    # (An owner can match more than one prefix of a chunk.)
+                    if not owner_chunks or owner_chunks[-1] is not chunk:
+                        owner_chunks.append(chunk)
+        routed.extend(selected.items())
+        return routed
+
+    def _compile(self, source, addr):
+        everything = []
+        prefix_tables = {}  # length -> {prefix: [owner]}
+        for owner in self.owners:
+            rules = self.rules.get(owner)
+            if rules is None:
+                everything.append(owner)
+                continue
+            matched = [route for route in rules if route.matches_source(source, addr)]
+            if any(route.prefixes is None for route in matched):
+                everything.append(owner)
+                continue
+            for route in matched:
+                for prefix in route.prefixes:
+                    owners = prefix_tables.setdefault(len(prefix), {}).setdefault(prefix, [])
+                    if owner not in owners:
+                        owners.append(owner)
+        return everything, sorted(prefix_tables.items())
+
+class Worker:
+    """
+    One worker process in --workers mode: its index, its links to the
+    other workers (peer index -> socket), and a socket to the parent
+    process for reporting stats.
+    """
+    def __init__(self, index, count, link_sockets, stats_sock):
+        self.index = index
+        self.count = count
+        self.link_sockets = link_sockets
+        self.stats_sock = stats_sock
+
+    def owns_remote(self, n):
+        """Each remote (the nth -r arg) is connected to by one worker only."""
+        return n % self.count == self.index
+
+    def report(self, rows):
+        self.stats_sock.sendall((json.dumps(rows) + '\n').encode())
+
+class HexdumpPrinter:
+    """
+    Shows a hexdump of the chunks received (--statusfmt hexdump) without
+    holding up forwarding.
+
+    show() runs on the forwarding path and only decides whether a chunk is
+    shown: of each chunk, only the first head_bytes (--hex-head); of each
+    peer's chunks, only one in sample (--hex-sample); and in all, at most
+    --hex-bytes-per-sec and --hex-lines-per-sec.  Chunks that are shown are
+    copied onto a queue holding at most max_queued bytes, and a display
+    thread formats and logs them.  A chunk that doesn't fit in what is left
+    of the budgets or the queue is cut short to fit, or if nothing is left,
+    not shown; the bytes left out are counted, and summarized in one line
+    once a second.
+    """
+    def __init__(self, args, max_queued=HEX_QUEUE_MAX):
+        self.color = args.color
+        self.head_bytes = args.hex_head
+        self.sample = args.hex_sample
+        self.bytes_per_sec = args.hex_bytes_per_sec
+        self.lines_per_sec = args.hex_lines_per_sec
+        self.max_queued = max_queued
+        self.window_end = 0  # time.monotonic() when the budgets are next reset
+        self.window_bytes = 0
+        self.window_lines = 0
+        # (Only show() changes these; the display thread reports the increase.)
+        self.suppressed_chunks = 0
+        self.suppressed_bytes = 0
+        self.items = collections.deque()  # (conn, nbytes received, data shown)
+        self.queued_bytes = 0
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='hexdump display', daemon=True)
+        self.thread.start()
+
+    def show(self, conn, data):
+        conn.hexdump_chunks += 1
+        if self.sample > 1 and conn.hexdump_chunks % self.sample != 1:
+            return
+
+        nbytes = len(data)
+        if self.head_bytes:
+            data = data[:self.head_bytes]
+
+        now = time.monotonic()
+        if now >= self.window_end:
+            self.window_end = now + 1
+            self.window_bytes = 0
+            self.window_lines = 0
+        room = min(len(data), self.max_queued - self.queued_bytes)
+        if self.bytes_per_sec:
+            room = min(room, self.bytes_per_sec - self.window_bytes)
+        if self.lines_per_sec:
+            # Less the "Received" line
+            room = min(room, (self.lines_per_sec - self.window_lines - 1) * 16)
+        if room <= 0:
+            self.suppressed_chunks += 1
+            self.suppressed_bytes += nbytes
+            return
+        if room < len(data):
+            self.suppressed_bytes += len(data) - room
+            data = data[:room]
+        self.window_bytes += len(data)
+        self.window_lines += (len(data) + 15) // 16 + 1
+
+        with self.condition:
+            self.items.append((conn, nbytes, bytes(data)))
+            self.queued_bytes += len(data)
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+
+    def _print(self, conn, nbytes, data):
+        hdump = hexformat.hexdump(data)
+        if self.color:
+            hdump = getattr(ansicolor.fore, conn.color) + hdump + ansicolor.style.RESET
+        if len(data) < nbytes:
+            log.info("Received %d bytes from %s:%d (first %d shown):\n%s",
+                     nbytes, conn.addr, conn.port, len(data), hdump)
+        else:
+            log.info("Received %d bytes from %s:%d:\n%s",
+                     nbytes, conn.addr, conn.port, hdump)
+
+    def _run(self):
+        reported_chunks = 0
+        reported_bytes = 0
+        next_summary = time.monotonic() + 1
+        while True:
+            with self.condition:
+                timeout = next_summary - time.monotonic()
+                if not self.items and not self.closing and timeout > 0:
+                    self.condition.wait(timeout)
+                items = list(self.items)
+                self.items.clear()
+                closing = self.closing
+
+            for item in items:
+                self._print(*item)
+            if items:
+                with self.condition:
+                    self.queued_bytes -= sum(len(data) for _, _, data in items)
+
+            now = time.monotonic()
+            if now >= next_summary or closing:
+                next_summary = now + 1
+                chunks = self.suppressed_chunks - reported_chunks
+                nbytes = self.suppressed_bytes - reported_bytes
+                if chunks:
+                    log.info("Hexdump suppressed %d chunks / %d bytes (over --hex-* limits)",
+                             chunks, nbytes)
+                reported_chunks += chunks
+                reported_bytes += nbytes
+            if closing:
+                break
 
 class SocketStatsTable:
-    def __init__(self):
-        self.sock_to_color_map = {}
-        self.tx_bytes = collections.defaultdict(int)
-        self.rx_bytes = collections.defaultdict(int)
-        self.last_rx_time = {}
+    """
+    Holds a Connection for each connected socket (see add()) and shows
+    their counters as a table, or as metrics (see metrics()).  The last
+    history_size Connections to close are kept in history, oldest first.
+
+    residency and busy_times are Histograms (in nanoseconds) of the time
+    from receiving each chunk until it has been sent to every peer, and of
+    the time each Reactor loop iteration spends busy.
+    """
+    # (metric, type, Connection attribute, help).  Each is also reported per
+    # endpoint, as pysockethub_endpoint_*.
+    CONNECTION_METRICS = [
+        ('pysockethub_connection_rx_bytes_total', 'counter', 'rx_bytes',
+         'Bytes received.'),
+        ('pysockethub_connection_rx_chunks_total', 'counter', 'rx_chunks',
+         'Chunks received (frames, with --framing).'),
+        ('pysockethub_connection_tx_bytes_total', 'counter', 'tx_bytes',
+         'Bytes sent.'),
+        ('pysockethub_connection_tx_chunks_total', 'counter', 'tx_chunks',
+         'Chunks sent.'),
+        ('pysockethub_connection_tx_dropped_bytes_total', 'counter', 'tx_dropped',
+         'Bytes dropped by --slow-policy.'),
+        ('pysockethub_connection_log_dropped_bytes_total', 'counter', 'log_dropped',
+         'Bytes left out of the log file because the log queue was full.'),
+        ('pysockethub_connection_tx_queued_bytes', 'gauge', 'tx_queued',
+         'Bytes waiting in the send queue.'),
+        ('pysockethub_connection_rx_bytes_per_second', 'gauge', 'rx_bps',
+         'Bytes received per second (moving average).'),
+        ('pysockethub_connection_tx_bytes_per_second', 'gauge', 'tx_bps',
+         'Bytes sent per second (moving average).'),
+        ('pysockethub_connection_rx_chunks_per_second', 'gauge', 'rx_cps',
+         'Chunks received per second (moving average).'),
+        ('pysockethub_connection_tx_chunks_per_second', 'gauge', 'tx_cps',
+         'Chunks sent per second (moving average).'),
+    ]
+    # (metric, SocketStatsTable attribute, help)
+    HISTOGRAM_METRICS = [
+        ('pysockethub_residency_seconds', 'residency',
+         'Time from receiving a chunk until it has been sent to every peer.'),
+        ('pysockethub_loop_busy_seconds', 'busy_times',
+         'Time each event loop iteration spends running callbacks.'),
+    ]
+    # (metric, type, Endpoint attribute, help)
+    ENDPOINT_METRICS = [
+        ('pysockethub_endpoint_connections', 'gauge', 'connections',
+         'Connections currently open.'),
+        ('pysockethub_endpoint_connects_total', 'counter', 'connects',
+         'Connections accepted or made.'),
+        ('pysockethub_endpoint_reconnects_total', 'counter', 'reconnects',
+         'Connections made to a remote after the first.'),
+        ('pysockethub_endpoint_rejected_total', 'counter', 'rejected',
+         'Incoming connections rejected.'),
+    ]
+
+    def __init__(self, args, history_size=STATS_HISTORY_MAX):
+        self.connections = {}  # socket -> Connection
+        self.endpoints = []
+        self.history = collections.deque(maxlen=history_size)
+        self.residency = Histogram()
+        self.busy_times = Histogram()
+        self.last_rate_update = time.monotonic()
+        self.colors_assigned = 0
         self.args = args
+        self.renderer = TableRenderer(args.color, args.table_top)
+        self.in_place = None
+        if args.table_inplace:
+            handler = log.handlers[0]
+            if getattr(handler.stream, 'isatty', lambda: False)():
+                self.in_place = InPlaceDisplay(handler)
         self.last_show_time = 0
         self.show_delay = 1
         self.awaiting_flag = False
 
-    def update_tx(self, sock, length):
-        self.tx_bytes[sock] += length
+    def endpoint(self, kind, name):
+        """Returns a new Endpoint, which is reported by metrics()."""
+        endpoint = Endpoint(kind, name)
+        self.endpoints.append(endpoint)
+        return endpoint
 
-    def update_rx(self, sock, length):
-        self.rx_bytes[sock] += length
-        self.last_rx_time[sock] = time.time()
+    def add(self, sock, peername, name=None, endpoint=None):
+        """
+        Returns a new Connection for sock, which is connected to peername
+        (through endpoint, if given), and shows it in the table until
+        remove(sock) is called.
+        """
+        addr, port = peername[:2]
+        color = PALETTE[self.colors_assigned % len(PALETTE)]
+        self.colors_assigned += 1
+        conn = Connection(sock, addr, port, name, color, endpoint)
+        self.connections[sock] = conn
+        if endpoint is not None:
+            endpoint.connected()
+        return conn
+
+    def remove(self, sock):
+        conn = self.connections.pop(sock, None)
+        if conn is not None:
+            conn.retire()
+            if conn.endpoint is not None:
+                conn.endpoint.disconnected(conn)
+            self.history.append(conn)
+
+    def get(self, sock):
+        """Returns the Connection for sock, or None."""
+        return self.connections.get(sock)
+
+    def update_rates(self):
+        """Updates each connection's rates.  Called every RATE_INTERVAL seconds."""
+        now = time.monotonic()
+        elapsed = now - self.last_rate_update
+        if elapsed <= 0:
+            return
+        self.last_rate_update = now
+        alpha = 1 - math.exp(-elapsed / RATE_TIME_CONSTANT)
+        for conn in self.connections.values():
+            conn.update_rates(elapsed, alpha)
 
-    def show(self, sockets):
+    def show(self):
         now = time.time()
         if (now - self.last_show_time) < self.show_delay:
             return
 
         self.last_show_time = now
+        self.show_rows(self.rows())
 
-        lines = []
-
-        for sock in sockets:
-            try:
-                addr, port = sock.getpeername()
-            except OSError:
-                # Socket was a listening socket, not a remote connection
-                continue
-
-            try:
-                idle_sec = int(now - self.last_rx_time[sock])
-            except KeyError:
-                self.last_rx_time[sock] = now
-                idle_sec = 0
+    def rows(self, now=None):
+        """
+        Returns one [addr, port, tx_bytes, rx_bytes, tx_queued, tx_dropped,
+        log_dropped, rx_idle_sec, rate, color] row per connection, where rate
+        is tx + rx bytes/sec.  now is a time.monotonic_ns() value.
+        """
+        if now is None:
+            now = time.monotonic_ns()
 
-            # connected = sock in sockets
+        return [[conn.addr, conn.port, conn.tx_bytes, conn.rx_bytes, conn.tx_queued,
+                 conn.tx_dropped, conn.log_dropped, (now - conn.last_rx_ns) // 1000000000,
+                 int(conn.tx_bps + conn.rx_bps), conn.color]
+                for conn in self.connections.values()]
 
-            try:
-                color = self.sock_to_color_map[sock]
-            except KeyError:
-                color = PALETTE[len(self.sock_to_color_map) % len(PALETTE)]
-                self.sock_to_color_map[sock] = color
-
-            if self.args.color:
-                # line = f'{getattr(ansicolor.fore, color)}{addr}:{port}\t{rx_bytes}\t{connected}{ansicolor.style.RESET}'
-                line = [f'{getattr(ansicolor.fore, color)}{addr}', port,
-                        self.tx_bytes[sock],
-                        self.rx_bytes[sock],
-                        # f'{(now - self.last_rx_time[sock]).total_seconds()}{ansicolor.style.RESET}']
-                        f'{idle_sec}{ansicolor.style.RESET}']
+    def metrics(self):
+        """
+        Generates the stats as lines of the Prometheus text format.  Lines
+        are produced one at a time, so that a caller can spread rendering a
+        large response over several event loop iterations (see
+        MetricsServer).  Endpoint totals include closed connections.
+        """
+        conns = list(self.connections.values())
+        endpoints = list(self.endpoints)
+        # Taken now, so that a connection closing while the response is
+        # being rendered isn't counted twice
+        closed = {endpoint: dict(endpoint.closed) for endpoint in endpoints}
+        labels = []
+        totals = {}  # attribute -> {Endpoint: total}
+
+        for metric, kind, attr, help_text in self.CONNECTION_METRICS:
+            yield f'# HELP {metric} {help_text}\n# TYPE {metric} {kind}\n'
+            sums = totals[attr] = {endpoint: closed[endpoint].get(attr, 0)
+                                   for endpoint in endpoints}
+            for i, conn in enumerate(conns):
+                if i == len(labels):
+                    labels.append(self._metric_labels(conn))
+                value = getattr(conn, attr)
+                if conn.endpoint in sums:
+                    sums[conn.endpoint] += value
+                yield f'{metric}{{{labels[i]}}} {value}\n'
+
+        metric = 'pysockethub_connection_rx_idle_seconds'
+        yield f'# HELP {metric} Seconds since data was last received.\n# TYPE {metric} gauge\n'
+        now = time.monotonic_ns()
+        for i, conn in enumerate(conns):
+            yield f'{metric}{{{labels[i]}}} {(now - conn.last_rx_ns) / 1e9:.3f}\n'
+
+        metric = 'pysockethub_connection_send_wait_seconds'
+        yield (f'# HELP {metric} Time from receiving a chunk until it has been sent to '
+               f'this connection.\n# TYPE {metric} summary\n')
+        for i, conn in enumerate(conns):
+            send_wait = conn.send_wait
+            for quantile in (0.5, 0.99):
+                value = send_wait.percentile(quantile * 100) / 1e9
+                yield f'{metric}{{{labels[i]},quantile="{quantile}"}} {value:.9f}\n'
+            yield f'{metric}_sum{{{labels[i]}}} {send_wait.total / 1e9:.9f}\n'
+            yield f'{metric}_count{{{labels[i]}}} {send_wait.count}\n'
+
+        for metric, attr, help_text in self.HISTOGRAM_METRICS:
+            histogram = getattr(self, attr)
+            yield f'# HELP {metric} {help_text}\n# TYPE {metric} histogram\n'
+            # Buckets from about 1us to about 1 minute
+            for limit, count in histogram.cumulative(1 << 10, 1 << 36):
+                yield f'{metric}_bucket{{le="{limit / 1e9:.9g}"}} {count}\n'
+            yield f'{metric}_bucket{{le="+Inf"}} {histogram.count}\n'
+            yield f'{metric}_sum {histogram.total / 1e9:.9f}\n'
+            yield f'{metric}_count {histogram.count}\n'
+
+        endpoint_labels = [f'endpoint="{metric_label(endpoint.name)}",kind="{endpoint.kind}"'
+                           for endpoint in endpoints]
+        for metric, kind, attr, help_text in self.ENDPOINT_METRICS:
+            yield f'# HELP {metric} {help_text}\n# TYPE {metric} {kind}\n'
+            for endpoint, label in zip(endpoints, endpoint_labels):
+                yield f'{metric}{{{label}}} {getattr(endpoint, attr)}\n'
+        for metric, kind, attr, help_text in self.CONNECTION_METRICS:
+            metric = metric.replace('_connection_', '_endpoint_', 1)
+            yield f'# HELP {metric} {help_text}\n# TYPE {metric} {kind}\n'
+            for endpoint, label in zip(endpoints, endpoint_labels):
+                yield f'{metric}{{{label}}} {totals[attr][endpoint]}\n'
+
+    @staticmethod
+    def _metric_labels(conn):
+        labels = (f'name="{metric_label(conn.name)}",addr="{metric_label(conn.addr)}",'
+                  f'port="{conn.port}"')
+        if conn.endpoint is not None:
+            labels += f',endpoint="{metric_label(conn.endpoint.name)}"'
+        return labels
+
+    def show_rows(self, rows):
+        """
+        Shows rows (as returned by rows(), possibly gathered from several
+        worker processes) as a table: logged, or redrawn in place if
+        in_place is set (see InPlaceDisplay).
+        """
+        if rows:
+            text = self.renderer.render(rows)
+            if self.in_place is not None:
+                self.in_place.show(text, self.renderer.width)
             else:
-                # line = f'{addr}:{port}\t{rx_bytes}\t{connected}'
-                line = [addr, port, self.tx_bytes[sock], self.rx_bytes[sock], idle_sec]
-            lines.append(line)
-
-        if lines:
-            table = prettytable.PrettyTable()
-            table.field_names = ['addr', 'port', 'tx_bytes', 'rx_bytes', 'rx_idle_sec']
-            table.add_rows(lines)
-            # log.info('%s', '\n' + "\n".join(lines))
-            log.info('%s', '\n' + table.get_string())
+                log.info('%s', '\n' + text)
             self.awaiting_flag = False
         else:
             if not self.awaiting_flag:
                 log.info("Not showing statistics until connection established.")
                 self.awaiting_flag = True
 
-class RawLogger:
+class TableRenderer:
+    """
+    Formats stats table rows as a fixed-width text table.
+
+    The part of each row's line up to the rx_idle_sec column is cached
+    along with the counters it was formatted from, and only rows whose
+    counters changed since the last render are formatted again, so a table
+    of mostly idle connections is cheap to redraw.  rx_idle_sec and rate
+    change every second even on idle connections, so the rest of the line
+    is formatted on each render, once per distinct (rx_idle_sec, rate).
+    With top, only the top rows by rate are shown, busiest first.
+    """
+    # (heading, minimum width); addr widens (for IPv6) as needed
+    COLUMNS = [('addr', 15), ('port', 5), ('tx_bytes', 12), ('rx_bytes', 12), ('tx_queued', 10),
+               ('tx_dropped', 10), ('log_dropped', 11), ('rx_idle_sec', 11), ('rate', 9)]
+
+    def __init__(self, color=True, top=0):
+        self.color = color
+        self.top = top
+        self.cache = {}  # (addr, port, color) -> (counters, start of line)
+        self.widths = [width for _heading, width in self.COLUMNS]
+        self._layout()
+
+    def _layout(self):
+        self.border = '+' + '+'.join('-' * (width + 2) for width in self.widths) + '+'
+        self.header = '|' + '|'.join(f' {heading:^{width}} ' for (heading, _), width
+                                     in zip(self.COLUMNS, self.widths)) + '|'
+        self.head_format = '| {:<%d} | ' % self.widths[0] + ''.join(
+            '{:>%d} | ' % width for width in self.widths[1:-2])
+        self.tail_format = '{:>%d} | {:>%d} |' % tuple(self.widths[-2:])
+        self.width = len(self.border)
+        self.cache.clear()
+
+    def render(self, rows):
+        """
+        Returns rows (see SocketStatsTable.rows()) as the text of a table.
+        """
+        widest = max(len(row[0]) for row in rows)
+        if widest > self.widths[0]:
+            self.widths[0] = widest
+            self._layout()
+
+        shown = rows
+        if self.top and len(rows) > self.top:
+            shown = heapq.nlargest(self.top, rows, key=lambda row: row[-2])
+        elif self.top:
+            shown = sorted(rows, key=lambda row: row[-2], reverse=True)
+
+        cache = {}
+        tails = {}  # (rx_idle_sec, rate) -> end of line
+        lines = [self.border, self.header, self.border]
+        for row in shown:
+            key = (row[0], row[1], row[-1])
+            counters = row[2:-3]
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] == counters:
+                head = cached[1]
+            else:
+                head = self._format_head(row)
+            cache[key] = (counters, head)
+            tail_key = (row[-3], row[-2])
+            tail = tails.get(tail_key)
+            if tail is None:
+                tail = tails[tail_key] = self._format_tail(*tail_key)
+            lines.append(head + tail)
+        self.cache = cache
+        lines.append(self.border)
+        if len(shown) < len(rows):
+            lines.append(f'(top {len(shown)} of {len(rows)} connections by rate)')
+        return '\n'.join(lines)
+
+    def _format_head(self, row):
+        head = self.head_format.format(*row[:-3])
+        if self.color:
+            head = f'{getattr(ansicolor.fore, row[-1])}{head}'
+        return head
+
+    def _format_tail(self, idle, rate):
+        tail = self.tail_format.format(idle, format_rate(rate))
+        if self.color:
+            tail = f'{tail}{ansicolor.style.RESET}'
+        return tail
+
+def format_rate(rate):
+    """Formats bytes/sec with a K/M/G suffix (powers of 1024)."""
+    for suffix in ('', 'K', 'M', 'G'):
+        if rate < 1024 or suffix == 'G':
+            break
+        rate /= 1024
+    return f'{rate:.1f}{suffix}' if suffix else f'{rate:.0f}'
+
+class InPlaceDisplay:
+    """
+    --table-inplace: shows the stats table on a terminal by redrawing it
+    over the previous one with ansicolor.cursor codes, instead of logging a
+    new table each time.  If anything else was logged since the last
+    table, the new one is drawn below it instead.
+    """
+    def __init__(self, handler):
+        self.stream = handler.stream
+        self.height = 0  # Terminal lines taken by the table at the bottom of the screen
+        handler.addFilter(self)
+
+    def filter(self, record):
+        # Called for every message logged through the handler
+        self.height = 0
+        return True
+
+    def show(self, text, width):
+        columns = shutil.get_terminal_size().columns
+        prefix = ''
+        if self.height:
+            prefix = ansicolor.cursor.up(self.height) + ansicolor.cursor.ERASE_DOWN
+        time_str = time.strftime('%Y-%m-%d %H:%M:%S')
+        text = f'{time_str} (stats)\n{text}\n'
+        self.stream.write(prefix + text)
+        self.stream.flush()
+        # Lines wider than the terminal wrap onto more than one line
+        rows_per_line = -(-width // columns) if columns > 0 else 1
+        self.height = text.count('\n') * rows_per_line
+
+def metric_label(value):
+    """Escapes value for use as a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metrics_response(request, stats_table):
+    """
+    Handles an HTTP request (the request line and headers, as bytes) to
+    the --metrics endpoint.  Returns the response head as bytes and an
+    iterator of body lines (None for a HEAD request).  The body is
+    delimited by closing the connection.
+    """
+    parts = request.split(b'\r\n', 1)[0].split()
+    if len(parts) != 3 or not parts[2].startswith(b'HTTP/'):
+        status = '400 Bad Request'
+    elif parts[0] not in (b'GET', b'HEAD'):
+        status = '405 Method Not Allowed'
+    elif parts[1].partition(b'?')[0] not in (b'/', b'/metrics'):
+        status = '404 Not Found'
+    else:
+        status = '200 OK'
+
+    if status == '200 OK':
+        content_type = METRICS_CONTENT_TYPE
+        lines = stats_table.metrics()
+    else:
+        content_type = 'text/plain; charset=utf-8'
+        lines = iter([status + '\n'])
+    head = (f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n'
+            'Connection: close\r\n\r\n')
+    return head.encode(), None if parts[:1] == [b'HEAD'] else lines
+
+class MetricsClient:
+    """
+    A scraper's connection to the MetricsServer: the request received so
+    far, then the response still to be rendered and sent.
+    """
+    def __init__(self, timer):
+        self.timer = timer
+        self.request = bytearray()
+        self.response = memoryview(b'')  # Rendered but not yet sent
+        self.lines = None  # Body lines not yet rendered
+
+class MetricsServer:
+    """
+    --metrics: serves SocketStatsTable.metrics() over HTTP from the Reactor,
+    alongside the hub's own connections.
+
+    The response is rendered METRICS_LINES_PER_WRITE lines at a time, each
+    time the scraper's socket becomes writable, so scraping a hub with many
+    connections doesn't hold up forwarding for the whole response.
+    """
+    def __init__(self, host, port, stats_table, reactor):
+        self.stats_table = stats_table
+        self.reactor = reactor
+        self.clients = {}  # socket -> MetricsClient
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if os.name != 'nt':
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.listen_socket.bind((host, port))
+        except OSError as exc:
+            log.error("Couldn't bind to %s:%d (%s)", host, port, str(exc))
+            sys.exit(1)
+        self.listen_socket.listen()
+        self.listen_socket.setblocking(False)
+        reactor.register(self.listen_socket, selectors.EVENT_READ, self._on_accept)
+
+    def close(self):
+        for sock in list(self.clients):
+            self._close(sock)
+        self.reactor.unregister(self.listen_socket)
+        self.listen_socket.close()
+
+    def _on_accept(self, sock, mask):
+        try:
+            client_socket, _addr = sock.accept()
+        except BlockingIOError:
+            return
+        if len(self.clients) >= METRICS_CLIENTS_MAX:
+            client_socket.close()
+            return
+        client_socket.setblocking(False)
+        timer = self.reactor.call_later(METRICS_TIMEOUT, lambda: self._close(client_socket))
+        self.clients[client_socket] = MetricsClient(timer)
+        self.reactor.register(client_socket, selectors.EVENT_READ, self._on_readable)
+
+    def _close(self, sock):
+        client = self.clients.pop(sock, None)
+        if client is not None:
+            client.timer.cancel()
+            self.reactor.unregister(sock)
+            sock.close()
+
+    def _on_readable(self, sock, mask):
+        client = self.clients[sock]
+        try:
+            data = sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(sock)
+            return
+
+        client.request += data
+        if b'\r\n\r\n' not in client.request:
+            if len(client.request) > METRICS_REQUEST_MAX:
+                self._close(sock)
+            return
+
+        head, client.lines = metrics_response(bytes(client.request), self.stats_table)
+        client.response = memoryview(head)
+        self.reactor.modify(sock, selectors.EVENT_WRITE, self._on_writable)
+
+    def _on_writable(self, sock, mask):
+        client = self.clients[sock]
+        if not client.response and client.lines is not None:
+            text = ''.join(itertools.islice(client.lines, METRICS_LINES_PER_WRITE))
+            if text:
+                client.response = memoryview(text.encode())
+            else:
+                client.lines = None
+        if not client.response:
+            self._close(sock)
+            return
+
+        try:
+            sent = sock.send(client.response)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._close(sock)
+            return
+        client.response = client.response[sent:]
+
+async def serve_metrics(host, port, stats_table):
+    """
+    asyncio counterpart of MetricsServer.  Returns the asyncio Server.
+    """
+    async def on_connect(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), METRICS_TIMEOUT)
+            head, lines = metrics_response(request, stats_table)
+            writer.write(head)
+            while lines is not None:
+                text = ''.join(itertools.islice(lines, METRICS_LINES_PER_WRITE))
+                if not text:
+                    break
+                writer.write(text.encode())
+                await writer.drain()
+                # (drain() doesn't yield unless the transport is paused)
+                await asyncio.sleep(0)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connect, host, port, family=socket.AF_INET,
+                                      limit=METRICS_REQUEST_MAX)
+
+class Logger:
+    """
+    Base class for the file loggers.  log() is called with each block of
+    received data, the Connection it came from and time_ns, the
+    time.time_ns() it was received at.  (The file loggers run on a
+    LoggerThread, whose log() takes the time as the data is queued, so
+    they never read the clock themselves.)  If tick_interval is set,
+    tick() is called that often (for time-based flushing and rotation).
+    close() is called on shutdown.
+
+    The file loggers write to a capturefile.RotatingFile, so their output
+    can be split into segments and compressed (see RotationOptions).  A
+    segment rotated by time is closed from tick() once it is due, even if
+    nothing more is logged.
+    """
+    tick_interval = None
+
+    def log(self, conn, data, time_ns=None):
+        pass
+
+    def tick(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _rotation_tick_interval(self, rotation):
+        return LOG_ROTATE_CHECK_INTERVAL if rotation.interval else None
+
+    def _close_segment_if_due(self):
+        # (For loggers with a logfile.)  The next write starts a new segment.
+        if self.logfile is not None and self.logfile.segment_due():
+            self.logfile.close()
+
+class RawLogger(Logger):
     """
     Logger that writes bytes straight to disk as they arrive.
     No additional metadata is stored in the file.
     """
-    def __init__(self, outfilename):
+    def __init__(self, outfilename, rotation=capturefile.RotationOptions()):
         self.outfilename = outfilename
+        self.rotation = rotation
         self.logfile = None
+        self.tick_interval = self._rotation_tick_interval(rotation)
 
-    def log(self, sock, data):
+    def log(self, conn, data, time_ns):
         if self.logfile is None:
-            self.logfile = open(self.outfilename, 'wb')
+            self.logfile = capturefile.RotatingFile(self.outfilename, self.rotation)
             log.info("Opened '%s' for logging (logfmt=raw)", self.outfilename)
 
         self.logfile.write(data)
 
-class FrameLogger:
+    def tick(self):
+        self._close_segment_if_due()
+
+    def close(self):
+        if self.logfile is not None:
+            self.logfile.close()
+
+class FrameLogger(Logger):
     """
     Logger that writes frames with sync, header, and data.
 
     Format of frame is:
     <sync:2> <time:4> <addr_len:4> <addr:addr_len> <port:2> <data_len:4> <data:data_len>
+
+    Frames are appended to an in-memory batch that is written to the file
+    in one write() once it holds batch_size bytes, and otherwise according
+    to flush_policy (a LogPolicy): never ('none'), every N seconds
+    ('interval') or every N frames ('frames').  fsync_policy says when the
+    written data is also fsync()ed to disk.  The batch is always written on
+    close().
+
+    The whole header is packed with a struct.Struct built once for each
+    connection.
     """
-    def __init__(self, outfilename):
+    SYNC = 0xEB90
+    PEER_CACHE_MAX = 4096  # Connections whose header info is kept
+
+    def __init__(self, outfilename, batch_size=LOG_BATCH_DEFAULT,
+                 flush_policy=LogPolicy('interval', 1.0), fsync_policy=LogPolicy('none', None),
+                 rotation=capturefile.RotationOptions()):
         self.outfilename = outfilename
+        self.rotation = rotation
         self.logfile = None
-
-    def log(self, sock, data):
+        self.batch = bytearray()
+        self.batch_size = batch_size
+        self.flush_policy = flush_policy
+        self.fsync_policy = fsync_policy
+        self.peers = {}  # Connection -> (header struct, addr bytes, port)
+        self.unflushed_frames = 0
+        self.unsynced_frames = 0
+        self.unsynced = False  # Written but not yet fsync()ed
+        self.last_flush = self.last_fsync = time.monotonic()
+
+        intervals = [policy.value for policy in (flush_policy, fsync_policy)
+                     if policy.kind == 'interval']
+        if rotation.interval:
+            intervals.append(self._rotation_tick_interval(rotation))
+        if intervals:
+            self.tick_interval = min(intervals)
+
+    def _peer(self, conn):
+        try:
+            return self.peers[conn]
+        except KeyError:
+            pass
+        if len(self.peers) >= self.PEER_CACHE_MAX:
+            # Entries for closed connections are never removed individually
+            self.peers.clear()
+        addr = conn.addr.encode()
+        peer = (struct.Struct(f'>HII{len(addr)}sHI'), addr, conn.port)
+        self.peers[conn] = peer
+        return peer
+
+    def _open(self):
+        self.logfile = capturefile.RotatingFile(self.outfilename, self.rotation)
+        log.info("Opened '%s' for logging (logfmt=frames)", self.outfilename)
+
+    def _append(self, conn, data, time_ns):
+        header, addr, port = self._peer(conn)
+        batch = self.batch
+        batch += header.pack(self.SYNC, time_ns // 1_000_000_000, len(addr), addr, port,
+                             len(data))
+        batch += data
+
+    def _batched(self):
+        return len(self.batch)
+
+    def _write_batch(self):
+        if not self.batch:
+            return False
+        self.logfile.write(self.batch)
+        self.logfile.flush()
+        self.batch.clear()
+        return True
+
+    def log(self, conn, data, time_ns):
         if self.logfile is None:
-            self.logfile = open(self.outfilename, 'wb')
-            log.info("Opened '%s' for logging (logfmt=frames)", self.outfilename)
-
-        # Create a frame
-        self.logfile.write(b'\xEB\x90')                   # Frame sync
-        now = int(time.time())
-        self.logfile.write(struct.pack('>I', now))        # Time data was received
-        addr, port = sock.getpeername()
-        self.logfile.write(struct.pack('>I', len(addr)))  # Length of addr string
-        self.logfile.write(addr.encode())                 # addr
-        self.logfile.write(struct.pack('>H', port))       # Port number
-        self.logfile.write(struct.pack('>I', len(data)))  # Length of data
-        self.logfile.write(data)                          # Received data
-
-class HexLogger:
+            self._open()
+        self._append(conn, data, time_ns)
+
+        self.unflushed_frames += 1
+        self.unsynced_frames += 1
+        if self._batched() >= self.batch_size:
+            self.flush()
+        elif self.flush_policy.kind == 'frames' and self.unflushed_frames >= self.flush_policy.value:
+            self.flush()
+        if self.fsync_policy.kind == 'frames' and self.unsynced_frames >= self.fsync_policy.value:
+            self.fsync()
+
+    def tick(self):
+        now = time.monotonic()
+        if (self.flush_policy.kind == 'interval'
+                and now - self.last_flush >= self.flush_policy.value):
+            self.flush()
+        if (self.fsync_policy.kind == 'interval'
+                and now - self.last_fsync >= self.fsync_policy.value):
+            self.fsync()
+        self._close_segment_if_due()
+
+    def flush(self):
+        """
+        Writes the batch to the file.
+        """
+        self.last_flush = time.monotonic()
+        self.unflushed_frames = 0
+        if self.logfile is not None and self._write_batch():
+            self.unsynced = True
+
+    def fsync(self):
+        """
+        Writes the batch and makes sure everything written is on disk.
+        """
+        self.flush()
+        self.last_fsync = time.monotonic()
+        self.unsynced_frames = 0
+        if self.unsynced:
+            self.logfile.fsync()
+            self.unsynced = False
+
+    def close(self):
+        if self.logfile is not None:
+            self.flush()
+            if self.fsync_policy.kind != 'none':
+                self.fsync()
+            self.logfile.close()
+            self.logfile = None
+
+class CaptureLogger(FrameLogger):
+    """
+    Logger that writes version 2 captures: nanosecond timestamps, a peer
+    table instead of the address in every frame, and an index alongside
+    each file for seeking by time and peer.  See capturefile.py for the
+    format.  Batching, flushing and rotation work as for FrameLogger.
+    """
+    def _open(self):
+        self.logfile = capturefile.CaptureWriter(self.outfilename, self.rotation)
+        log.info("Opened '%s' for logging (logfmt=capture)", self.outfilename)
+
+    def _append(self, conn, data, time_ns):
+        self.logfile.add((conn.addr, conn.port), data, time_ns)
+
+    def _batched(self):
+        return len(self.logfile)
+
+    def _write_batch(self):
+        return self.logfile.flush()
+
+class HexLogger(Logger):
     """
     Logger that writes hexdump-formatted data.  E.g.:
 
     2021-11-14 20:01:50.958 127.0.0.1:60910:
         00000000: 6C 6B 6A 0D 0A                                    lkj..
+
+    Each block of data is written with one write(), so a rotated segment
+    never starts partway through one.
     """
-    def __init__(self, outfilename):
+    def __init__(self, outfilename, rotation=capturefile.RotationOptions()):
         self.outfilename = outfilename
+        self.rotation = rotation
         self.logfile = None
+        self.tick_interval = self._rotation_tick_interval(rotation)
+        self.time_second = None
+        self.time_prefix = ''
 
-    def log(self, sock, data):
+    def log(self, conn, data, time_ns):
         if self.logfile is None:
-            self.logfile = open(self.outfilename, 'w')
+            self.logfile = capturefile.RotatingFile(self.outfilename, self.rotation)
             log.info("Opened '%s' for logging (logfmt=hexdump)", self.outfilename)
 
-        # Generate timestamp
-        now = time.time()
-        time_str = time.strftime('%Y-%m-%d %H:%M:%S.',
-                                 time.localtime(now))
-        # Tack on subseconds
-        subsec = now - int(now)
-        msec = int(subsec * 1000)
-        time_str += f'{msec:03d} '
-
-        # Tack on sender host and port
-        self.logfile.write(time_str)
-        addr, port = sock.getpeername()
-        self.logfile.write(f'{addr}:{port}:\n')
-
-        # Finally, output an indented hexdump of the data
-        for line in hexdump.hexdump(data, result='generator'):
-            self.logfile.write('\t' + line + '\n')
+        # Timestamp.  The part up to the seconds only changes once a second.
+        second, nsec = divmod(time_ns, 1_000_000_000)
+        if second != self.time_second:
+            self.time_second = second
+            self.time_prefix = time.strftime('%Y-%m-%d %H:%M:%S.', time.localtime(second))
+        msec = nsec // 1_000_000
+
+        # Sender host and port, then an indented hexdump of the data
+        header = f'{self.time_prefix}{msec:03d} {conn.addr}:{conn.port}:\n'
+        self.logfile.write(header.encode() + hexformat.hexdump_bytes(data, '\t'))
+
+    def tick(self):
+        self._close_segment_if_due()
+
+    def close(self):
+        if self.logfile is not None:
+            self.logfile.close()
+
+class PluginLogger(Logger):
+    """
+    Wraps a psh_ plugin module.  The hub passes loggers a memoryview into a
+    shared, reusable recv buffer; plugins are given their own bytes copy so
+    they can keep it and use the full bytes API.
+
+    Plugins run on the log writer thread (see LoggerThread), so the socket
+    may already have been closed; plugins are passed the Connection, whose
+    getpeername() still works, as the sock argument.
+    """
+    def __init__(self, module):
+        self.module = module
+
+    def log(self, conn, data, time_ns):
+        self.module.log(conn, bytes(data))
+
+class LoggerThread(Logger):
+    """
+    Runs a Logger on a background writer thread, so that a slow disk (or
+    HexLogger's formatting) doesn't add latency to forwarding.
+
+    log() copies the data, with the time it was called (the receive time),
+    onto a queue holding at most max_bytes; all of the wrapped logger's
+    methods run on the writer thread.  When the queue is full, overflow
+    'block' waits for room and 'drop' discards the data and counts it in
+    the connection's log_dropped counter.
+    """
+    def __init__(self, logger, max_bytes=LOG_QUEUE_DEFAULT, overflow='block'):
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.tick_interval = logger.tick_interval
+        self.items = collections.deque()  # (nbytes, method, args)
+        self.queued_bytes = 0
+        self.condition = threading.Condition()
+        self.dropping = False
+        self.failed = False
+        # (Daemon, so that an error exit doesn't hang waiting for it; a normal
+        # shutdown calls close(), which drains the queue.)
+        self.thread = threading.Thread(target=self._run, name='log writer', daemon=True)
+        self.thread.start()
+
+    def log(self, conn, data):
+        if self.failed:
+            return
+        time_ns = time.time_ns()
+        nbytes = len(data)
+        with self.condition:
+            while self.queued_bytes and self.queued_bytes + nbytes > self.max_bytes:
+                if self.overflow == 'drop':
+                    if not self.dropping:
+                        log.warning("Log queue exceeded %d bytes; dropping data", self.max_bytes)
+                        self.dropping = True
+                    conn.log_dropped += nbytes
+                    return
+                self.condition.wait()
+            self.dropping = False
+            self._put(nbytes, self.logger.log, (conn, bytes(data), time_ns))
+
+    def tick(self):
+        with self.condition:
+            self._put(0, self.logger.tick, ())
+
+    def close(self):
+        with self.condition:
+            self._put(0, None, ())
+        self.thread.join()
+
+    def _put(self, nbytes, method, args):
+        # (Caller holds self.condition.)
+        self.items.append((nbytes, method, args))
+        self.queued_bytes += nbytes
+        self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.items:
+                    self.condition.wait()
+                nbytes, method, args = self.items.popleft()
+                self.queued_bytes -= nbytes
+                self.condition.notify_all()
+
+            if method is None:
+                break
+            if self.failed:
+                continue
+            try:
+                method(*args)
+            except Exception as exc:
+                log.error("Logging stopped: %s", str(exc))
+                self.failed = True
+
+        try:
+            self.logger.close()
+        except Exception as exc:
+            log.error("Couldn't close log file: %s", str(exc))
 
 def get_logger(args):
+    """
+    Returns the Logger selected by args.  File loggers run on a LoggerThread.
+    """
+    logger = get_file_logger(args)
+    if not args.logfilename:
+        return logger
+    return LoggerThread(logger, args.log_queue, args.log_overflow)
+
+def get_file_logger(args):
     if args.logfilename:
 
         if args.timestamp:
@@ -588,95 +2761,702 @@ def get_logger(args):
                 log.error("Plugin %s has no log() function.", args.logplugin)
                 sys.exit(1)
 
-            return plugin_module
+            return PluginLogger(plugin_module)
 
 
         # No plugin; just use one of the default file loggers.
+        rotation = capturefile.RotationOptions(max_bytes=args.log_rotate_size or 0,
+                                               interval=args.log_rotate_interval or 0,
+                                               keep=args.log_keep,
+                                               compress=args.log_compress)
+        try:
+            capturefile.check_codec(rotation.compress)
+        except capturefile.CodecError as exc:
+            log.error('%s', str(exc))
+            sys.exit(1)
+
         if args.logfmt == 'raw':
-            return RawLogger(logfilename)
+            return RawLogger(logfilename, rotation)
         if args.logfmt == 'frames':
-            return FrameLogger(logfilename)
+            return FrameLogger(logfilename, args.log_batch, args.log_flush, args.log_fsync,
+                               rotation)
+        if args.logfmt == 'capture':
+            return CaptureLogger(logfilename, args.log_batch, args.log_flush, args.log_fsync,
+                                 rotation)
         if args.logfmt == 'hexdump':
-            return HexLogger(logfilename)
+            return HexLogger(logfilename, rotation)
 
     # Logging to file is not enabled.  Main always calls logger.log(), so we
     # supply a do-nothing logger in this case.
-    class DummyLogger:
-        def log(self, sock, data):
-            pass
+    return Logger()
 
-    return DummyLogger()
+class HubProtocol(asyncio.Protocol):
+    """
+    One connection of the asyncio engine, accepted by an AsyncSocketServer
+    or made by an AsyncSocketClient (the owner).  conn is its Connection,
+    shown with name if given.
+    """
+    def __init__(self, hub, owner, name=None):
+        self.hub = hub
+        self.owner = owner
+        self.name = name
+        self.transport = None
+        self.sock = None
+        self.conn = None
+        self.dropping = False
+        self.decoder = hub.options.framing() if hub.options.framing else None
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        peername = transport.get_extra_info('peername')
+        if not self.owner.accepts(peername):
+            transport.abort()
+            return
+        self.sock = transport.get_extra_info('socket')
+        self.conn = self.hub.stats_table.add(self.sock, peername, self.name, self.owner.endpoint)
+        transport.set_write_buffer_limits(high=self.hub.options.high_water_mark)
+        self.hub.add(self)
+        self.owner.connection_made(self)
+
+    def data_received(self, data):
+        if self.owner.direction == 'send':
+            # Read only so that the peer closing is noticed; discarded.
+            return
+        self.hub.data_received(self, data)
 
-def main(args):
-    hex_printer = HexdumpPrinter()
-    stats_table = SocketStatsTable()
+    def connection_lost(self, exc):
+        if self.conn is not None:
+            # (Otherwise it was rejected in connection_made.)
+            self.hub.remove(self)
+            self.owner.connection_lost(self, exc)
+        if not self.closed.done():
+            # (The future is cancelled if the client's task was cancelled
+            # while waiting on it.)
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.hub.pause(self)
+
+    def resume_writing(self):
+        self.hub.resume(self)
+
+class AsyncSocketServer:
+    """
+    asyncio counterpart of SocketServer.  Like SocketServer, it stops
+    listening once max_connections are connected and listens again when
+    one of them disconnects.
+    """
+    def __init__(self, hub, host, port, max_connections, direction=DIRECTION_DEFAULT,
+                 ip_filter=None):
+        self.hub = hub
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.direction = direction
+        self.ip_filter = ip_filter
+        self.endpoint = hub.stats_table.endpoint('listen', f'{host}:{port}')
+        self.protocols = set()
+        self.server = None
+        self.relisten_task = None  # Listening again after max_connections
+        self.keep_running = True
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: HubProtocol(self.hub, self),
+                                               self.host, self.port,
+                                               family=socket.AF_INET)
+
+    def accepts(self, peername):
+        """Returns False (and counts it) if peername isn't allowed to connect."""
+        if self.ip_filter is None or self.ip_filter.allowed(peername[0]):
+            return True
+        self.endpoint.rejected += 1
+        return False
+
+    def connection_made(self, protocol):
+        self.protocols.add(protocol)
+        log.info('Accepted connection from: %s', protocol.conn.name)
+
+        if len(self.protocols) >= self.max_connections and self.server is not None:
+            msg = "Maximum connections (%d) reached on port %d"
+            log.info(msg, self.max_connections, self.port)
+            self.server.close()
+            self.server = None
+
+    def connection_lost(self, protocol, exc):
+        self.protocols.discard(protocol)
+        log.info("Client disconnected (%s)", protocol.conn.name)
+        if self.server is None and self.keep_running and self.relisten_task is None:
+            self.relisten_task = asyncio.ensure_future(self._relisten())
+
+    async def _relisten(self):
+        try:
+            while True:
+                try:
+                    await self.start()
+                    return
+                except OSError as exc:
+                    log.error("Couldn't listen on %s:%d again (%s); retrying",
+                              self.host, self.port, str(exc))
+                await asyncio.sleep(RELISTEN_DELAY)
+        finally:
+            self.relisten_task = None
+
+    def shutdown(self):
+        self.keep_running = False
+        if self.relisten_task is not None:
+            self.relisten_task.cancel()
+        if self.server is not None:
+            self.server.close()
+        for protocol in list(self.protocols):
+            protocol.transport.close()
+
+class AsyncSocketClient:
+    """
+    asyncio counterpart of SocketClient.  Connecting and reconnecting is a
+    coroutine rather than a thread or timer callbacks.
+    """
+    def __init__(self, hub, host, port, auto_reconnect=True, direction=DIRECTION_DEFAULT):
+        self.hub = hub
+        self.host = host
+        self.port = port
+        self.auto_reconnect = auto_reconnect
+        self.direction = direction
+        self.endpoint = hub.stats_table.endpoint('remote', f'{host}:{port}')
+        self.protocol = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        name = f'{self.host}:{self.port}'
+        connect_attempts = 0
+        while True:
+            # Initially retry quickly (10Hz), then back off (1/10Hz).
+            connect_attempts += 1
+            timeout = min(RECONNECT_DELAY_MAX, (.1 * connect_attempts))
+            try:
+                _transport, protocol = await asyncio.wait_for(
+                    loop.create_connection(lambda: HubProtocol(self.hub, self, name),
+                                           self.host, self.port),
+                    timeout)
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(timeout)
+                continue
+
+            connect_attempts = 0
+            await protocol.closed
+            if not self.auto_reconnect:
+                break
+
+    def accepts(self, peername):
+        return True
+
+    def connection_made(self, protocol):
+        self.protocol = protocol
+        log.info("Connected to %s:%d", self.host, self.port)
+
+    def connection_lost(self, protocol, exc):
+        self.protocol = None
+        if exc is None:
+            log.info("Client disconnected (%s:%d)", self.host, self.port)
+        else:
+            log.info("Client disconnected (exc) (%s:%d) (%s)", self.host, self.port, str(exc))
+
+    def shutdown(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.protocol is not None:
+            self.protocol.transport.close()
+
+class AsyncHub:
+    """
+    asyncio implementation of the hub, selected with --engine asyncio.
+    Uses uvloop if it is installed.
+
+    Connections are asyncio Protocols, so the hub can also be embedded in
+    an asyncio application:
+
+        hub = AsyncHub(SocketStatsTable(args), get_logger(args), ConnectionOptions())
+        await hub.listen('0.0.0.0', 1234, 10)
+        hub.connect('foo.com', 1234)
+        ...
+        hub.shutdown()
+
+    Outbound data is buffered by each transport.  Once a transport holds
+    more than options.high_water_mark bytes, options.slow_policy applies as
+    in the reactor engine, except that drop-oldest behaves like drop-newest
+    because data already handed to a transport can't be taken back.  Bytes
+    are counted in tx_bytes when they are handed to the transport.
+
+    The recv sizing options don't apply; asyncio does its own reads.
+    options.framing does; each protocol gets its own decoder.
+
+    What send-only connections' peers send is discarded (it is only read
+    so that their closing is noticed), and nothing is written to recv-only
+    connections.
+    """
+    def __init__(self, stats_table, logger, options, hex_printer=None):
+        self.stats_table = stats_table
+        self.logger = logger
+        self.options = options
+        self.hex_printer = hex_printer
+        self.connections = {}  # HubProtocol -> None, used as an ordered set
+        # The connections data is sent to (not recv-only) and read from (not
+        # send-only), kept as they come and go rather than checked per chunk
+        self.subscribers = {}
+        self.sources = {}
+        self.paused = set()  # Protocols over their high-water mark (backpressure)
+        self.servers = []
+        self.clients = []
+
+    async def listen(self, host, port, max_connections, direction=DIRECTION_DEFAULT,
+                     ip_filter=None):
+        server = AsyncSocketServer(self, host, port, max_connections, direction, ip_filter)
+        await server.start()
+        self.servers.append(server)
+        return server
+
+    def connect(self, host, port, auto_reconnect=True, direction=DIRECTION_DEFAULT):
+        client = AsyncSocketClient(self, host, port, auto_reconnect, direction)
+        client.start()
+        self.clients.append(client)
+        return client
+
+    def shutdown(self):
+        for item in self.clients + self.servers:
+            item.shutdown()
+
+    def sockets(self):
+        return [protocol.sock for protocol in self.connections]
+
+    def add(self, protocol):
+        self.connections[protocol] = None
+        direction = protocol.owner.direction
+        if direction != 'recv':
+            self.subscribers[protocol] = None
+        if direction != 'send':
+            self.sources[protocol] = None
+        if self.paused and direction != 'send':
+            protocol.transport.pause_reading()
+
+    def remove(self, protocol):
+        self.connections.pop(protocol, None)
+        self.subscribers.pop(protocol, None)
+        self.sources.pop(protocol, None)
+        self.stats_table.remove(protocol.sock)
+        self.resume(protocol)
+
+    def pause(self, protocol):
+        if self.options.slow_policy != 'backpressure':
+            return
+        if not self.paused:
+            log.info("Send queue full; pausing reads (backpressure)")
+            for other in self.sources:
+                other.transport.pause_reading()
+        self.paused.add(protocol)
+
+    def resume(self, protocol):
+        if protocol not in self.paused:
+            return
+        self.paused.discard(protocol)
+        if not self.paused:
+            log.info("Send queues drained; resuming reads")
+            for other in self.sources:
+                if not other.transport.is_closing():
+                    other.transport.resume_reading()
+
+    def data_received(self, source, data):
+        if source.decoder is None:
+            source.conn.received(len(data), 1)
+            self._distribute(source, data)
+            return
+
+        try:
+            frames = source.decoder.feed(data)
+        except framing.FrameError as exc:
+            log.warning("Framing error, disconnecting (%s) (%s)", source.conn.name, str(exc))
+            source.transport.abort()
+            return
+        source.conn.received(len(data), len(frames))
+        for frame in frames:
+            self._distribute(source, frame)
+
+    def _distribute(self, source, data):
+        # Distribute received data to all other connections
+        for protocol in self.subscribers:
+            if protocol is not source:
+                self._send(protocol, data)
+
+        self.logger.log(source.conn, data)
+
+        if self.hex_printer is not None:
+            self.hex_printer.show(source.conn, data)
+
+    def _send(self, protocol, data):
+        transport = protocol.transport
+        queued = transport.get_write_buffer_size()
+        policy = self.options.slow_policy
+        if queued + len(data) > self.options.high_water_mark and policy != 'backpressure':
+            if policy == 'disconnect':
+                log.warning("Send queue to %s exceeded %d bytes; disconnecting",
+                            protocol.conn.name, self.options.high_water_mark)
+                transport.abort()
+                return
+
+            if not protocol.dropping:
+                log.warning("Send queue to %s exceeded %d bytes; dropping data (%s)",
+                            protocol.conn.name, self.options.high_water_mark, policy)
+                protocol.dropping = True
+            protocol.conn.tx_dropped += len(data)
+            return
+
+        protocol.dropping = False
+        transport.write(data)
+        protocol.conn.sent(len(data), 1)
+        protocol.conn.tx_queued = transport.get_write_buffer_size()
+
+async def async_main(args, options):
+    hex_printer = HexdumpPrinter(args) if args.statusfmt == 'hexdump' else None
+    stats_table = SocketStatsTable(args)
+    logger = get_logger(args)
+    hub = AsyncHub(stats_table, logger, options, hex_printer)
+
+    for arg in args.local:
+        listen_host, listen_port, max_connections, direction = validate_listen_arg(arg)
+        try:
+            await hub.listen(listen_host, listen_port, max_connections, direction,
+                             args.ip_filter)
+        except OSError as exc:
+            msg = "Couldn't bind to %s:%d (%s)"
+            log.error(msg, listen_host, listen_port, str(exc))
+            sys.exit(1)
+        log.info("Serving on %s:%d (max_connections:%d, direction:%s)",
+                 listen_host, listen_port, max_connections, direction)
+
+    for arg in args.remote:
+        host, port, auto_reconnect, direction = validate_remote_arg(arg)
+        hub.connect(host, port, auto_reconnect, direction)
+        msg = "Connecting to %s:%d (auto_reconnect:%s, direction:%s)"
+        log.info(msg, host, port, auto_reconnect, direction)
+
+    async def tick_logger():
+        while True:
+            await asyncio.sleep(logger.tick_interval)
+            logger.tick()
+
+    if logger.tick_interval:
+        asyncio.get_running_loop().create_task(tick_logger())
+
+    metrics_server = None
+    if args.metrics:
+        host, port = args.metrics
+        try:
+            metrics_server = await serve_metrics(host, port, stats_table)
+        except OSError as exc:
+            log.error("Couldn't bind to %s:%d (%s)", host, port, str(exc))
+            sys.exit(1)
+        log.info("Serving metrics on http://%s:%d/metrics", host, port)
+
+    if args.ip_filter is not None:
+        watch_ip_filter(args.ip_filter)
+
+    log.info("Hub running (asyncio).  Press ^C to exit.")
+    try:
+        while True:
+            await asyncio.sleep(stats_table.show_delay)
+            stats_table.update_rates()
+            if args.statusfmt == 'table':
+                stats_table.show()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        hub.shutdown()
+        logger.close()
+        if hex_printer is not None:
+            hex_printer.close()
+
+def run_asyncio(args, options):
+    if args.route:
+        log.error("--route requires --engine reactor")
+        sys.exit(1)
+
+    try:
+        import uvloop
+    except ImportError:
+        log.info("Using the asyncio event loop (install uvloop for a faster one)")
+    else:
+        log.info("Using the uvloop event loop")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    try:
+        asyncio.run(async_main(args, options))
+    except KeyboardInterrupt:
+        pass
+
+def run_reactor(args, options, worker=None):
+    """
+    Runs the hub on the built-in Reactor.  In --workers mode, worker is the
+    Worker this process is; otherwise None.
+    """
     show_hex = args.statusfmt == 'hexdump'
+    hex_printer = HexdumpPrinter(args) if show_hex else None
+    stats_table = SocketStatsTable(args)
     show_table = args.statusfmt == 'table'
 
-    logger = get_logger(args)
+    if worker is not None and args.logfilename:
+        # Each worker logs what it receives to its own file
+        root, ext = os.path.splitext(args.logfilename)
+        args.logfilename = f'{root}.w{worker.index}{ext}'
 
+    logger = get_logger(args)
     servers = []
+    clients = []
+    links = []
+
+    def on_readable(sock, mask):
+        owner = registry.owner(sock)
+        if owner is None:
+            return
+
+        chunks = owner.service_readable(sock)
+        if chunks:
+            # Data from another worker was already logged by that worker
+            conn = None
+            if owner not in links:
+                conn = stats_table.get(sock)
+
+            # Distribute received data to all other connections (or those
+            # the --route rules send it to).  Chunks are shared by
+            # reference, not copied, by each peer's send queue.
+            if router is None:
+                for item in subscribers:
+                    item.distribute(chunks, sock)
+            else:
+                for item, item_chunks in router.route(conn, chunks):
+                    item.distribute(item_chunks, sock)
+
+            if owner not in links:
+                for link in links:
+                    link.distribute(chunks, sock)
+
+            for chunk in chunks:
+                if conn is not None:
+                    logger.log(conn, chunk.view)
+
+                    if show_hex:
+                        hex_printer.show(conn, chunk.view)
+
+                if chunk.release():
+                    # Already sent to every peer (or there are none)
+                    stats_table.residency.record(time.monotonic_ns() - chunk.recv_ns)
+
+    reactor = Reactor(stats_table.busy_times)
+    registry = SocketRegistry(reactor, on_readable)
+    buffer_pool = BufferPool()
+
     for arg in args.local:
-        listen_host, listen_port, max_connections = validate_listen_arg(arg)
-        server = SocketServer(listen_host, listen_port, max_connections, stats_table)
+        listen_host, listen_port, max_connections, direction = validate_listen_arg(arg)
+        server = SocketServer(listen_host, listen_port, max_connections, stats_table,
+                              registry, options, buffer_pool,
+                              reuse_port=worker is not None, direction=direction,
+                              ip_filter=args.ip_filter)
         servers.append(server)
-        log.info("Serving on %s:%d (max_connections:%d)",
-                 listen_host, listen_port, max_connections)
-
-    clients = []
-    for arg in args.remote:
-        host, port, auto_reconnect = validate_remote_arg(arg)
-        client = SocketClient(host, port, stats_table, auto_reconnect)
+        log.info("Serving on %s:%d (max_connections:%d, direction:%s)",
+                 listen_host, listen_port, max_connections, direction)
+
+    for n, arg in enumerate(args.remote):
+        host, port, auto_reconnect, direction = validate_remote_arg(arg)
+        if worker is not None and not worker.owns_remote(n):
+            continue
+        client = SocketClient(host, port, stats_table, registry, options, buffer_pool,
+                              auto_reconnect, direction)
         clients.append(client)
-        msg = "Connecting to %s:%d (auto_reconnect:%s)"
-        log.info(msg, host, port, auto_reconnect)
+        msg = "Connecting to %s:%d (auto_reconnect:%s, direction:%s)"
+        log.info(msg, host, port, auto_reconnect, direction)
+
+    # Received data is never sent to recv-only endpoints' connections
+    subscribers = [item for item in servers + clients if item.direction != 'recv']
+    router = RoutingTable(args.route, servers + clients) if args.route else None
+
+    send_only = [item for item in servers + clients if item.direction == 'send']
+    if send_only:
+        def check_send_only():
+            for item in send_only:
+                item.check_send_only()
+
+        reactor.call_every(SEND_ONLY_CHECK_INTERVAL, check_send_only)
+
+    if logger.tick_interval:
+        reactor.call_every(logger.tick_interval, logger.tick)
+    reactor.call_every(RATE_INTERVAL, stats_table.update_rates)
+    if args.ip_filter is not None:
+        watch_ip_filter(args.ip_filter)
+
+    metrics_server = None
+    if args.metrics:
+        metrics_server = MetricsServer(*args.metrics, stats_table, reactor)
+        log.info("Serving metrics on http://%s:%d/metrics", *args.metrics)
+
+    if worker is None:
+        if show_table:
+            reactor.call_every(stats_table.show_delay,
+                               stats_table.show)
+        log.info("Hub running.  Press ^C to exit.")
+    else:
+        for peer_index, sock in worker.link_sockets.items():
+            links.append(WorkerLink(sock, peer_index, registry, options, buffer_pool))
+        if show_table:
+            reactor.call_every(stats_table.show_delay,
+                               lambda: worker.report(stats_table.rows()))
+
+        def on_parent_exit(sock, mask):
+            # The parent never sends anything; readable means it went away.
+            log.info("Worker %d: parent process exited; shutting down", worker.index)
+            reactor.unregister(sock)
+            reactor.keep_running = False
+
+        reactor.register(worker.stats_sock, selectors.EVENT_READ, on_parent_exit)
+        log.info("Worker %d running.", worker.index)
 
-    log.info("Hub running.  Press ^C to exit.")
-    keep_running = True
-    select_timeout = .1
     try:
-        while keep_running:
-            time.sleep(.1)
-
-            # Build a list of all the sockets to be waited on with select()
-            select_sockets = flatten([l.sockets() for l in servers])
-            select_sockets += flatten([c.sockets for c in clients])
-            if not select_sockets:
-                time.sleep(select_timeout)
-                continue
+        reactor.run()
+    except KeyboardInterrupt:
+        pass
+
+    # Shut down socket connections
+    for item in clients + servers:
+        item.shutdown()
+    if metrics_server is not None:
+        metrics_server.close()
+    reactor.close()
+    logger.close()
+    if hex_printer is not None:
+        hex_printer.close()
+
+def run_workers(args, options):
+    """
+    --workers mode.  Forks args.workers processes that each run the hub with
+    SO_REUSEPORT listen sockets, connected to each other in a full mesh of
+    Unix socketpairs (see WorkerLink).  Remotes are divided between the
+    workers.  This process only gathers the workers' stats and shows them
+    as one table.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+        log.error("--workers requires SO_REUSEPORT and fork() (Linux, BSD, macOS)")
+        sys.exit(1)
+    if args.engine != 'reactor':
+        log.error("--workers requires --engine reactor")
+        sys.exit(1)
+    if args.metrics:
+        log.error("--metrics can't be used with --workers")
+        sys.exit(1)
+    if args.route:
+        log.error("--route can't be used with --workers")
+        sys.exit(1)
+
+    count = args.workers
+    link_pairs = {}  # (worker index, peer index) -> socket
+    for i in range(count):
+        for j in range(i + 1, count):
+            link_pairs[i, j], link_pairs[j, i] = socket.socketpair()
+
+    stats_socks = {}  # socket -> worker index
+    pids = []
+    for index in range(count):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # Worker process.  Keep only this worker's sockets.
+            parent_sock.close()
+            for sock in stats_socks:
+                sock.close()
+            link_sockets = {}
+            for (i, j), sock in link_pairs.items():
+                if i == index:
+                    link_sockets[j] = sock
+                else:
+                    sock.close()
+            run_reactor(args, options, Worker(index, count, link_sockets, child_sock))
+            return
 
-            # Wait for some data to arrive, or for a client to connect to one
-            # of our listening sockets.
-            rlist, _wlist, _xlist = select.select(select_sockets,
-                                                  [],
-                                                  [],
-                                                  select_timeout)
-            for sock in rlist:
-                data = None
-                for item in servers + clients:
-                    data = item.service_readable(sock)
-                    if data:
-                        break
-
-                if data:
-                    # Distribute received data to all other connections
-                    for item in servers + clients:
-                        item.distribute(data)
-
-                    logger.log(sock, data)
+        child_sock.close()
+        stats_socks[parent_sock] = index
+        pids.append(pid)
 
-                    if show_hex:
-                        hex_printer.show(sock, data)
+    for sock in link_pairs.values():
+        sock.close()
+
+    stats_table = SocketStatsTable(args)
+    reactor = Reactor()
+    latest_rows = {}  # worker index -> rows
+    pending = collections.defaultdict(bytearray)
+
+    def on_stats(sock, mask):
+        index = stats_socks[sock]
+        data = sock.recv(65536)
+        if not data:
+            log.info("Worker %d exited", index)
+            reactor.unregister(sock)
+            sock.close()
+            latest_rows.pop(index, None)
+            del stats_socks[sock]
+            if not stats_socks:
+                reactor.keep_running = False
+            return
 
-            if show_table:
-                stats_table.show(select_sockets)
+        buf = pending[index]
+        buf += data
+        while b'\n' in buf:
+            line, _, rest = bytes(buf).partition(b'\n')
+            latest_rows[index] = json.loads(line)
+            buf[:] = rest
 
+    for sock in stats_socks:
+        reactor.register(sock, selectors.EVENT_READ, on_stats)
+
+    if args.statusfmt == 'table':
+        reactor.call_every(stats_table.show_delay,
+                           lambda: stats_table.show_rows(flatten(latest_rows.values())))
+
+    log.info("Hub running with %d workers.  Press ^C to exit.", count)
+    try:
+        reactor.run()
     except KeyboardInterrupt:
-        # Shut down socket connections and threads
-        for item in clients + servers:
-            item.shutdown()
+        # ^C in a terminal reaches the workers too; this covers a signal
+        # sent only to this process.
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    for pid in pids:
+        os.waitpid(pid, 0)
 
-def parse_args():
+def on_sigterm(signum, frame):
+    # Shut down the same way as for ^C, so that log files are closed cleanly
+    raise KeyboardInterrupt
+
+def main(args):
+    signal.signal(signal.SIGTERM, on_sigterm)
+    options = ConnectionOptions(high_water_mark=args.send_hwm,
+                                slow_policy=args.slow_policy,
+                                recv_size=args.recv_size,
+                                recv_adaptive=args.recv_adaptive,
+                                read_budget=args.read_budget,
+                                framing=args.framing)
+    if args.workers > 1:
+        run_workers(args, options)
+    elif args.engine == 'asyncio':
+        run_asyncio(args, options)
+    else:
+        run_reactor(args, options)
+
+def parse_args(argv=None):
     descr = "Python TCP Socket Hub - Distributes data to connected clients."
     descr += "  If no options are specified, listens for up to 10 connections on localhost:1234"
 
@@ -684,18 +3464,43 @@ def parse_args():
                                      # )
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    # Create a group so that we can require at least one --listen or --remote arg
-    group = parser.add_mutually_exclusive_group(required=True)
-
-    help_msg = ("Local interface and port to serve connections on.  host:port[:max_connections]. \
+    # At least one --local or --remote arg is required (checked below)
+    help_msg = ("Local interface and port to serve connections on.  \
+                host:port[:max_connections][:direction] direction:both/recv/send.  recv \
+                connections are only received from and send connections only sent to.  \
                 Option may be specified multiple times.")
-    group.add_argument("-l", "--local", action='append', default=[],
-                       help=help_msg)
+    parser.add_argument("-l", "--local", action='append', default=[],
+                        help=help_msg)
 
-    help_msg = ("Remote host to connect to.  host:port[:auto_reconnect] auto_reconnect:true/false. \
+    help_msg = ("Remote host to connect to.  host:port[:auto_reconnect][:direction] \
+                 auto_reconnect:true/false direction:both/recv/send (as for -l). \
                  Option may be specified multiple times.")
-    group.add_argument("-r", "--remote", action='append', default=[],
-                       help=help_msg)
+    parser.add_argument("-r", "--remote", action='append', default=[],
+                        help=help_msg)
+
+    help_msg = ("File of networks allowed to connect to the -l ports, in CIDR notation (IPv4 or \
+                IPv6), one per line.  If given, other addresses are rejected.  The most \
+                specific matching --ip-allow or --ip-deny rule applies.  Both files are \
+                re-read when they change.")
+    parser.add_argument("--ip-allow", metavar='FILE',
+                        help=help_msg)
+
+    help_msg = ("File of networks not allowed to connect to the -l ports, as for --ip-allow.  \
+                Rejected connections are counted in the endpoint's rejected stat.")
+    parser.add_argument("--ip-deny", metavar='FILE',
+                        help=help_msg)
+
+    help_msg = ("Event loop implementation.  reactor: built-in selectors (epoll/kqueue) loop. \
+                asyncio: asyncio protocols, using uvloop if it is installed.")
+    parser.add_argument("--engine", default='reactor', choices=['reactor', 'asyncio'],
+                        help=help_msg)
+
+    help_msg = ("Number of worker processes.  Each worker listens on every -l port using \
+                SO_REUSEPORT, and data is passed between workers so that every connection \
+                still sees all data.  max_connections applies per worker.  Requires \
+                --engine reactor on Linux/BSD/macOS.")
+    parser.add_argument("--workers", default=1, type=int,
+                        help=help_msg)
 
     parser.add_argument("--status", default='True',
                        help="Display status messages during program operation.")
@@ -706,28 +3511,164 @@ def parse_args():
     parser.add_argument("--color", default='True',
                         help="Enable colored output")
 
+    help_msg = ("With --statusfmt hexdump, show at most this many bytes of hexdump each \
+                second (per worker).  Chunks over the limit are counted in a summary line \
+                instead.  Accepts K/M/G suffixes.  0 for no limit.")
+    parser.add_argument("--hex-bytes-per-sec", default='0', type=validate_limit,
+                        help=help_msg)
+
+    help_msg = ("With --statusfmt hexdump, show at most this many lines of hexdump each \
+                second (per worker).  0 for no limit.")
+    parser.add_argument("--hex-lines-per-sec", default=HEX_LINES_PER_SEC_DEFAULT, type=int,
+                        help=help_msg)
+
+    help_msg = ("With --statusfmt hexdump, show only the first N bytes of each chunk.  \
+                Accepts K/M/G suffixes.  0 shows whole chunks.")
+    parser.add_argument("--hex-head", default='0', type=validate_limit, metavar='N',
+                        help=help_msg)
+
+    help_msg = ("With --statusfmt hexdump, show only one in K of the chunks from each \
+                connection.")
+    parser.add_argument("--hex-sample", default=1, type=int, metavar='K',
+                        help=help_msg)
+
+    help_msg = ("Show only the N connections with the highest rate (tx + rx bytes/sec) in the \
+                stats table.  0 shows them all.")
+    parser.add_argument("--table-top", default=0, type=int, metavar='N',
+                        help=help_msg)
+
+    help_msg = ("If True and the log goes to a terminal, redraw the stats table in place \
+                instead of logging a new one every second.")
+    parser.add_argument("--table-inplace", default='False',
+                        help=help_msg)
+
+    help_msg = ("Serve per-connection and per-endpoint stats in the Prometheus text format \
+                at http://host:port/metrics.  Not available with --workers.")
+    parser.add_argument("--metrics", default=None, type=validate_metrics_arg,
+                        metavar='HOST:PORT', help=help_msg)
+
+    help_msg = ("Maximum bytes queued for sending to each connection before --slow-policy \
+                applies, counting the whole recv buffer that queued data is in (at most 4x \
+                its length).  Accepts K/M/G suffixes.")
+    parser.add_argument("--send-hwm", default=str(SEND_HWM_DEFAULT), type=validate_size,
+                        help=help_msg)
+
+    help_msg = ("What to do when a connection's send queue exceeds --send-hwm: drop the oldest \
+                queued data, drop the newest data, disconnect the slow consumer, or pause reading \
+                from all sources until it catches up.")
+    parser.add_argument("--slow-policy", default=SLOW_POLICY_DEFAULT, choices=SLOW_POLICIES,
+                        help=help_msg)
+
+    help_msg = ("Bytes requested per recv().  With --recv-adaptive, the starting size. \
+                Accepts K/M/G suffixes.")
+    parser.add_argument("--recv-size", default=str(RECV_SIZE_DEFAULT), type=validate_size,
+                        help=help_msg)
+
+    help_msg = ("If True, grow the recv() size while reads keep filling the buffer and shrink \
+                it again when traffic slows down.")
+    parser.add_argument("--recv-adaptive", default='True',
+                        help=help_msg)
+
+    help_msg = ("Maximum bytes read from one connection each time it becomes readable, so \
+                one busy source can't starve the others.  Accepts K/M/G suffixes.")
+    parser.add_argument("--read-budget", default=str(READ_BUDGET_DEFAULT), type=validate_size,
+                        help=help_msg)
+
+    help_msg = ("Distribute whole frames instead of bytes as they arrive.  none, \
+                length:N[:little] (N-byte length header), line, crlf, delim:HEX, fixed:N, \
+                sync:HEX[:N] (sync word + N-byte length).  A frame is never split or \
+                interleaved with other data, and is dropped whole by the drop policies.")
+    parser.add_argument("--framing", default='none', type=validate_framing,
+                        help=help_msg)
+
+    help_msg = ("Send DEST (a -l or -r host:port) only the data matching all of the \
+                FILTERs: source=HOST:PORT (received through that -l or -r), addr=IP (from that \
+                peer address), prefix=HEX or topic=TEXT (starting with those bytes; each frame \
+                with --framing, otherwise each chunk as received).  Repeat a filter to match \
+                any of its values, and the option for more rules per DEST.  A DEST with no rules \
+                gets everything.  Requires --engine reactor.")
+    parser.add_argument("--route", nargs='+', action='append', default=[],
+                        metavar=('DEST', 'FILTER'), help=help_msg)
+
     parser.add_argument("-o", "--logfilename", default=None,
                         help="Output filename for logging")
 
     parser.add_argument("-t", "--timestamp", default='True',
                         help="If True, filenames will be prepended with yyyymmdd_hhmmss_")
 
+    help_msg = ("--logfmt frames/capture: bytes of frames buffered in memory before they are \
+                written to the file.  Accepts K/M/G suffixes.")
+    parser.add_argument("--log-batch", default=str(LOG_BATCH_DEFAULT), type=validate_size,
+                        help=help_msg)
+
+    help_msg = ("--logfmt frames/capture: when buffered frames are also written before \
+                --log-batch is reached.  none, interval:SECONDS or frames:N.")
+    parser.add_argument("--log-flush", default=LOG_FLUSH_DEFAULT, type=validate_log_policy,
+                        help=help_msg)
+
+    help_msg = ("--logfmt frames/capture: when the log file is fsync()ed to disk.  none, \
+                interval:SECONDS or frames:N.")
+    parser.add_argument("--log-fsync", default=LOG_FSYNC_DEFAULT, type=validate_log_policy,
+                        help=help_msg)
+
+    help_msg = ("Start a new log file segment once the current one holds this many bytes \
+                (before compression; a segment may overshoot by one write, e.g. one \
+                --log-batch).  Segments are named <root>.NNNNNN<ext>.  Accepts K/M/G suffixes.")
+    parser.add_argument("--log-rotate-size", default=None, type=validate_size,
+                        help=help_msg)
+
+    help_msg = ("Start a new log file segment every this many seconds.")
+    parser.add_argument("--log-rotate-interval", default=None, type=float,
+                        help=help_msg)
+
+    help_msg = ("Keep only the newest N log file segments (0 keeps them all).  Segments left \
+                by an earlier run count too; numbering carries on after them.")
+    parser.add_argument("--log-keep", default=0, type=int,
+                        help=help_msg)
+
+    help_msg = ("Compress log files as they are written.  zstd needs the zstandard \
+                package and lz4 the lz4 package.")
+    parser.add_argument("--log-compress", default='none', choices=list(capturefile.CODECS),
+                        help=help_msg)
+
+    help_msg = ("Logging runs on a separate thread.  Maximum bytes waiting to be logged \
+                before --log-overflow applies.  Accepts K/M/G suffixes.")
+    parser.add_argument("--log-queue", default=str(LOG_QUEUE_DEFAULT), type=validate_size,
+                        help=help_msg)
+
+    help_msg = ("What to do when the log queue is full: block forwarding until the logger \
+                catches up, or drop the data from the log (counted in log_dropped).")
+    parser.add_argument("--log-overflow", default='block', choices=LOG_OVERFLOW_POLICIES,
+                        help=help_msg)
+
     log_group = parser.add_mutually_exclusive_group(required=False)
 
-    log_group.add_argument("--logfmt", default='raw', choices=['raw', 'frames', 'hexdump'],
-                           help="Log file format.")
+    help_msg = ("Log file format.  capture: indexed, nanosecond-timestamped frames (see \
+                capturefile.py); frames: the older, unindexed frame format.")
+    log_group.add_argument("--logfmt", default='raw',
+                           choices=['raw', 'frames', 'capture', 'hexdump'],
+                           help=help_msg)
 
     help_msg = ("Plugin name.  A python module named psh_<name> containing a log(sock, data) \
                 function.")
     log_group.add_argument("--logplugin",
                            help=help_msg)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if not args.local and not args.remote:
+        parser.error("at least one of the arguments -l/--local -r/--remote is required")
+    if args.hex_lines_per_sec < 0 or args.hex_sample < 1:
+        parser.error("--hex-lines-per-sec must be 0 or more and --hex-sample at least 1")
 
     # Convert the bool arg strings to bool
     args.log = validate_bool(args.status)
     args.color = validate_bool(args.color)
     args.timestamp = validate_bool(args.timestamp)
+    args.recv_adaptive = validate_bool(args.recv_adaptive)
+    args.table_inplace = validate_bool(args.table_inplace)
+    args.route = [validate_route_arg(values) for values in args.route]
+    args.ip_filter = get_ip_filter(args.ip_allow, args.ip_deny)
 
     return args
 